@@ -0,0 +1,289 @@
+"""Warbler's JSON API, version 1, at /api/v1.
+
+    GET /timeline                   the logged-in user's home timeline *
+    GET /users/<id>                 a profile
+    GET /users/<id>/messages        a user's messages, newest first
+    GET /users/<id>/likes           messages a user has liked, latest first *
+    GET /users/<id>/followers       users following them, latest first *
+    GET /users/<id>/following       users they follow, latest first *
+    GET /messages/<id>              a message
+
+* Logged in only (401 otherwise), like the site's own pages for them.
+
+Lists come as {"data": [...], "next": cursor}; pass the cursor back as
+`?before=` for the next page (it's null on the last one). `?limit=` sets
+the page size, up to API_MAX_LIMIT. `?fields=id,text` returns only those
+fields, and only those columns are read from the database.
+
+Rows are read as plain column tuples, not ORM objects, and turned straight
+into dicts. Requests are authenticated by the same session as the site.
+"""
+
+from functools import wraps
+from operator import attrgetter
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+
+import timeline
+from models import db, Message, User, follow_list, follow_states
+from pagination import decode_cursor, older_than, split_page
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MESSAGE_COLUMNS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'like_count': Message.like_count,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'user_image_url': User.image_url,
+}
+
+USER_COLUMNS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}
+
+# Fields worked out per viewer rather than read from a column
+MESSAGE_COMPUTED = ('liked',)
+USER_COMPUTED = ('followed',)
+
+# How fields are read from a row, where it isn't just the column by name
+FORMATTERS = {
+    'timestamp': lambda row: row.timestamp.isoformat() + 'Z',
+}
+
+
+def viewer_required(f):
+    """401 for anonymous requests."""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.user:
+            abort(401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def json_error(err):
+    return jsonify(error=err.description), err.code
+
+
+# By code, as the app's own 404 page would otherwise win
+for code in (400, 401, 404):
+    api.register_error_handler(code, json_error)
+
+
+##############################################################################
+# Request arguments
+
+
+def requested_fields(columns, computed):
+    """The `?fields=` of this request (default: all of them); unknown
+    fields are a 400."""
+
+    raw = request.args.get('fields')
+    if not raw:
+        return list(columns) + list(computed)
+    fields = [name.strip() for name in raw.split(',') if name.strip()]
+    unknown = set(fields) - set(columns) - set(computed)
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def page_limit(default):
+    """`?limit=`, between 1 and API_MAX_LIMIT."""
+
+    limit = request.args.get('limit', default, type=int)
+    return min(max(limit, 1), current_app.config['API_MAX_LIMIT'])
+
+
+def before_arg():
+    """The decoded `?before=` cursor, or None; malformed cursors are a 400.
+    """
+
+    token = request.args.get('before')
+    if not token:
+        return None
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400, "Invalid cursor")
+
+
+def select(columns, fields, always=('id',)):
+    """Labelled columns for `fields`, plus `always` (for paging)."""
+
+    names = [name for name in columns if name in fields or name in always]
+    return [columns[name].label(name) for name in names]
+
+
+##############################################################################
+# Serializing
+
+
+def serialize(rows, fields, computed=None):
+    """Dicts of `fields` from `rows` of labelled columns; `computed` maps
+    fields that aren't columns to functions of the row."""
+
+    computed = computed or {}
+    getters = [computed.get(name) or FORMATTERS.get(name)
+               or attrgetter(name) for name in fields]
+    return [dict(zip(fields, [get(row) for get in getters]))
+            for row in rows]
+
+
+def message_dicts(rows, fields):
+    """Messages as dicts, with whether the viewer liked them."""
+
+    computed = {}
+    if 'liked' in fields:
+        liked = timeline.liked_message_ids(
+            g.user.id if g.user else None, [row.id for row in rows])
+        computed['liked'] = lambda row: row.id in liked
+    return serialize(rows, fields, computed)
+
+
+def user_dicts(rows, fields):
+    """Users as dicts, with whether the viewer follows them."""
+
+    computed = {}
+    if 'followed' in fields:
+        followed = follow_states(g.user.id if g.user else None,
+                                 [row.id for row in rows])
+        computed['followed'] = lambda row: followed[row.id]
+    return serialize(rows, fields, computed)
+
+
+def require_user(user_id):
+    """404 unless there's a user `user_id`."""
+
+    if not db.session.query(User.id).filter(User.id == user_id).scalar():
+        abort(404, "No such user")
+
+
+##############################################################################
+# Messages
+
+
+def message_page(query, fields):
+    """A page of `query`'s messages, newest first, after `?before=`."""
+
+    before = before_arg()
+    if before:
+        query = query.filter(older_than(Message.timestamp, Message.id,
+                                        before))
+    limit = page_limit(current_app.config['TIMELINE_PAGE_SIZE'])
+    rows = (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+    rows, next_cursor = split_page(rows, limit, timeline.sort_key)
+    return jsonify(data=message_dicts(rows, fields), next=next_cursor)
+
+
+@api.route('/timeline')
+@viewer_required
+def home_timeline():
+    """The logged-in user's home timeline."""
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_COMPUTED)
+    limit = page_limit(current_app.config['TIMELINE_PAGE_SIZE'])
+    rows = timeline.home_timeline(
+        g.user.id, current_app.config['TIMELINE_FANOUT_LIMIT'],
+        limit=limit + 1, before=before_arg(),
+        columns=select(MESSAGE_COLUMNS, fields, ('id', 'timestamp')))
+    rows, next_cursor = split_page(rows, limit, timeline.sort_key)
+    return jsonify(data=message_dicts(rows, fields), next=next_cursor)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+    require_user(user_id)
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_COMPUTED)
+    columns = select(MESSAGE_COLUMNS, fields, ('id', 'timestamp'))
+    return message_page(
+        timeline.message_query(columns).filter(Message.user_id == user_id),
+        fields)
+
+
+@api.route('/users/<int:user_id>/likes')
+@viewer_required
+def user_likes(user_id):
+    """Messages a user has liked, most recently liked first."""
+    require_user(user_id)
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_COMPUTED)
+    limit = page_limit(current_app.config['TIMELINE_PAGE_SIZE'])
+    rows = timeline.liked_messages(user_id, limit + 1, before=before_arg(),
+                                   columns=select(MESSAGE_COLUMNS, fields))
+    rows, next_cursor = split_page(rows, limit,
+                                   lambda row: (row.liked_at, row.id))
+    return jsonify(data=message_dicts(rows, fields), next=next_cursor)
+
+
+@api.route('/messages/<int:message_id>')
+def message(message_id):
+    """A message."""
+    fields = requested_fields(MESSAGE_COLUMNS, MESSAGE_COMPUTED)
+    row = (timeline.message_query(select(MESSAGE_COLUMNS, fields))
+           .filter(Message.id == message_id)
+           .first())
+    if row is None:
+        abort(404, "No such message")
+    return jsonify(data=message_dicts([row], fields)[0])
+
+
+##############################################################################
+# Users
+
+
+@api.route('/users/<int:user_id>')
+def user(user_id):
+    """A user's profile."""
+    fields = requested_fields(USER_COLUMNS, USER_COMPUTED)
+    row = (db.session
+           .query(*select(USER_COLUMNS, fields))
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        abort(404, "No such user")
+    return jsonify(data=user_dicts([row], fields)[0])
+
+
+def user_page(user_id, followers):
+    """A page of the users `user_id` follows (or who follow them), most
+    recently followed first."""
+
+    require_user(user_id)
+    fields = requested_fields(USER_COLUMNS, USER_COMPUTED)
+    limit = page_limit(current_app.config['USERS_PAGE_SIZE'])
+    rows = follow_list(user_id, select(USER_COLUMNS, fields),
+                       followers=followers, limit=limit + 1,
+                       before=before_arg())
+    rows, next_cursor = split_page(rows, limit,
+                                   lambda row: (row.followed_at, row.id))
+    return jsonify(data=user_dicts(rows, fields), next=next_cursor)
+
+
+@api.route('/users/<int:user_id>/followers')
+@viewer_required
+def followers(user_id):
+    """Users following a user, most recent first."""
+    return user_page(user_id, followers=True)
+
+
+@api.route('/users/<int:user_id>/following')
+@viewer_required
+def following(user_id):
+    """Users a user follows, most recent first."""
+    return user_page(user_id, followers=False)
@@ -1,9 +1,28 @@
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, url_for, abort, make_response, Response)
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm, PasswordForm
-from models import db, connect_db, User, Message, Like
+from models import (db, connect_db, User, Message, Follows, DeletionJob,
+                    follow_states, follow_list, like_message, unlike_message,
+                    increment_counters, repair_counters)
+from passwords import hasher, HasherBusy
+from metrics import metrics
+from assets import assets
+from deletions import deletions
+from fragments import fragments
+from api import api
+from events import events, author_channel
+from responses import compress, stream_template
+from slowlog import slow_queries
+import principal
+import httpcache
+from principal import load_current_user, forget_principal
+import timeline
+from search import user_search, message_search
+from pagination import decode_cursor, older_than, split_page
 from functools import wraps
 
 CURR_USER_KEY = "curr_user"
@@ -14,11 +33,108 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Read replicas (comma-separated URLs) for the read-only pages, which stay on
+# the primary for this many seconds after a visitor's own write; see
+# routing.py
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url]
+app.config['REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Connection pool of each engine: connections kept open, extra ones allowed
+# under load, how long to wait for one, and their maximum age (seconds).
+# Connections are checked (pre-pinged) as they're taken from the pool.
+app.config['SQLALCHEMY_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = int(
+    os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = int(
+    os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['SQLALCHEMY_POOL_RECYCLE'] = int(
+    os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['SQLALCHEMY_POOL_PRE_PING'] = (
+    os.environ.get('DB_POOL_PRE_PING', '1') == '1')
+# Replicas' pools are sized separately, if set
+if 'DB_REPLICA_POOL_SIZE' in os.environ:
+    app.config['SQLALCHEMY_REPLICA_POOL_OPTIONS'] = {
+        'pool_size': int(os.environ['DB_REPLICA_POOL_SIZE'])}
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Authors with more followers than this aren't fanned out into home
+# timelines on write; their messages are merged in when the feed is read.
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+# Messages per timeline page; later pages load as the user scrolls.
+app.config['TIMELINE_PAGE_SIZE'] = int(
+    os.environ.get('TIMELINE_PAGE_SIZE', 20))
+app.config['USERS_PAGE_SIZE'] = int(os.environ.get('USERS_PAGE_SIZE', 30))
+app.config['AUTOCOMPLETE_LIMIT'] = 8
+# bcrypt work factor, and the process pool hashing runs in (see passwords.py)
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+if 'PASSWORD_HASH_WORKERS' in os.environ:
+    app.config['PASSWORD_HASH_WORKERS'] = int(
+        os.environ['PASSWORD_HASH_WORKERS'])
+if 'PASSWORD_HASH_MAX_PENDING' in os.environ:
+    app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+        os.environ['PASSWORD_HASH_MAX_PENDING'])
+# How long (seconds) and for how many users the logged-in user's basics are
+# cached between requests (see principal.py)
+app.config['PRINCIPAL_CACHE_TTL'] = int(
+    os.environ.get('PRINCIPAL_CACHE_TTL', 30))
+app.config['PRINCIPAL_CACHE_SIZE'] = int(
+    os.environ.get('PRINCIPAL_CACHE_SIZE', 10000))
+# Serve per-request metrics at /metrics, to scrapers sending this bearer
+# token if it's set (see metrics.py)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Send a Server-Timing header (SQL, template and total time) with responses
+app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING') == '1'
+# Log SQL slower than this many ms (0 for off); sample EXPLAIN (ANALYZE,
+# BUFFERS) plans of slow SELECTs to a file if one is given (see slowlog.py)
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 250))
+app.config['SLOW_QUERY_EXPLAIN_FILE'] = os.environ.get(
+    'SLOW_QUERY_EXPLAIN_FILE')
+app.config['SLOW_QUERY_EXPLAIN_SAMPLE'] = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE', 0.1))
+# How live updates get between processes: 'local' (one process only) or
+# 'postgres' (LISTEN/NOTIFY); see events.py. gunicorn.conf.py makes it
+# 'postgres' when there's more than one worker.
+app.config['EVENTS_BROKER'] = os.environ.get('EVENTS_BROKER', 'local')
+app.config['EVENTS_HEARTBEAT'] = int(os.environ.get('EVENTS_HEARTBEAT', 15))
+# Most authors one /events stream may name (a profile page names one)
+app.config['EVENTS_MAX_AUTHORS'] = int(
+    os.environ.get('EVENTS_MAX_AUTHORS', 10))
+# Largest page size clients of the JSON API may ask for (see api.py)
+app.config['API_MAX_LIMIT'] = int(os.environ.get('API_MAX_LIMIT', 100))
+# Compress responses of at least this many bytes (see responses.py)
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+# Deleted accounts and messages are purged in the background this many rows
+# at a time, with a pause (seconds) between batches; see deletions.py
+app.config['DELETION_BATCH_SIZE'] = int(
+    os.environ.get('DELETION_BATCH_SIZE', 1000))
+app.config['DELETION_PAUSE'] = float(os.environ.get('DELETION_PAUSE', 0.1))
+# Rendered message cards kept in this process (how many, for how long in
+# seconds); see fragments.py
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+# Where `python assets.py build` put the fingerprinted static files
+app.config['ASSETS_DIST'] = os.environ.get(
+    'ASSETS_DIST', os.path.join(app.root_path, 'static', 'dist'))
 # toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+metrics.init_app(app)
+slow_queries.init_app(app)
+hasher.init_app(app)
+principal.init_app(app)
+assets.init_app(app)
+compress.init_app(app)
+httpcache.init_app(app)
+app.register_blueprint(api)
+events.init_app(app, db.get_engine(app))
+deletions.init_app(app)
+fragments.init_app(app)
 
 
 ##############################################################################
@@ -35,6 +151,48 @@ def login_required(f):
     return decorated_function
 
 
+##############################################################################
+# Timeline pagination
+
+
+def cursor_arg():
+    """The decoded `?before=` cursor of this request, or None.
+
+    Malformed cursors are a 400.
+    """
+    token = request.args.get('before')
+    if not token:
+        return None
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+def render_timeline(template, messages, next_cursor, **context):
+    """Render a page of timeline messages, loaded with their authors.
+
+    Full pages are streamed (see responses.py). Infinite-scroll fetches
+    from warbler.js only get the message items, with the URL of the
+    following page in an X-Next-Page header.
+    """
+    items = timeline.build_items(messages, g.user.id if g.user else None)
+    next_page = None
+    if next_cursor:
+        args = dict(request.args.items(), before=next_cursor)
+        next_page = url_for(request.endpoint, **request.view_args, **args)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        resp = make_response(
+            render_template('messages/_items.html', items=items))
+        if next_page:
+            resp.headers['X-Next-Page'] = next_page
+        return resp
+
+    return stream_template(template, items=items, next_page=next_page,
+                           **context)
+
+
 ##############################################################################
 # User signup/login/logout
 
@@ -43,11 +201,22 @@ def login_required(f):
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY])
+        if g.user is None:
+            # Account is gone; don't look it up again on every request
+            del session[CURR_USER_KEY]
     else:
         g.user = None
 
 
+@app.after_request
+def forget_changed_user(resp):
+    """Let the logged-in user see their own changes straight away."""
+    if g.get('user') and request.method == 'POST':
+        forget_principal(g.user.id)
+    return resp
+
+
 def do_login(user):
     """Log in user."""
     session[CURR_USER_KEY] = user.id
@@ -59,6 +228,18 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+# What the user cards of follower lists show
+USER_CARD_COLUMNS = [User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio]
+
+
+def followed_by_viewer(users):
+    """Which of `users` the logged-in user follows, for their Follow/Unfollow
+    buttons, as a dict of user id -> bool."""
+    return follow_states(g.user.id if g.user else None,
+                         [user.id for user in users])
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -94,6 +275,8 @@ def login():
         user = User.authenticate(form.username.data,
                                  form.password.data)
         if user:
+            # Saves the password hash if it was upgraded
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -114,47 +297,111 @@ def logout():
 
 
 @app.route('/users')
+@db.reads_from_replica
 def list_users():
     """Page with listing of users.
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    a 'page' param for the page of results.
     """
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = app.config['USERS_PAGE_SIZE']
+    offset = (page - 1) * page_size
+    # One extra row tells us whether there's a next page
     if not search:
-        users = User.query.all()
+        users = (User
+                 .query
+                 .order_by(User.id)
+                 .offset(offset)
+                 .limit(page_size + 1)
+                 .all())
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-    return render_template('users/index.html', users=users)
+        users = user_search().search(search, limit=page_size + 1,
+                                     offset=offset)
+    users, has_next = users[:page_size], len(users) > page_size
+    return httpcache.conditional(
+        lambda: render_template('users/index.html', users=users,
+                                search=search, page=page, has_next=has_next,
+                                followed=followed_by_viewer(users)),
+        [(user.id, user.version) for user in users], has_next)
+
+
+@app.route('/users/autocomplete')
+def users_autocomplete():
+    """JSON list of users whose username starts with the 'q' param, for the
+    navbar search box."""
+    search = request.args.get('q', '').strip()
+    if not search:
+        return jsonify([])
+    users = user_search().autocomplete(search,
+                                       app.config['AUTOCOMPLETE_LIMIT'])
+    return jsonify([dict(id=id, username=username, image_url=image_url)
+                    for id, username, image_url in users])
 
 
 @app.route('/users/<int:user_id>')
+@db.reads_from_replica
 def users_show(user_id):
     """Show user profile."""
     user = User.query.get_or_404(user_id)
+    before = cursor_arg()
+    page_size = app.config['TIMELINE_PAGE_SIZE']
     # snagging messages in order from the database
     # user.messages won't be in order by default
     messages = (Message
                 .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
+                .options(joinedload(Message.user))
+                .filter(Message.user_id == user_id))
+    if before:
+        messages = messages.filter(
+            older_than(Message.timestamp, Message.id, before))
+    messages = (messages
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(page_size + 1)
                 .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = split_page(messages, page_size,
+                                       timeline.sort_key)
+    return httpcache.conditional(
+        lambda: render_timeline('users/show.html', messages, next_cursor,
+                                user=user,
+                                followed=followed_by_viewer([user])),
+        user.id, user.version,
+        [(message.id, message.version) for message in messages])
+
+
+def render_follow_list(template, user, followers):
+    """Render a page of `user`'s followees (or followers), most recently
+    followed first, with only the columns their cards need."""
+    page_size = app.config['USERS_PAGE_SIZE']
+    users = follow_list(user.id, USER_CARD_COLUMNS, followers=followers,
+                        limit=page_size + 1, before=cursor_arg())
+    users, next_cursor = split_page(users, page_size,
+                                    lambda row: (row.followed_at, row.id))
+    next_page = None
+    if next_cursor:
+        next_page = url_for(request.endpoint, user_id=user.id,
+                            before=next_cursor)
+    return stream_template(template, user=user, users=users,
+                           next_page=next_page,
+                           followed=followed_by_viewer(users + [user]))
 
 
 @app.route('/users/<int:user_id>/following')
 @login_required
+@db.reads_from_replica
 def show_following(user_id):
     """Show list of people this user is following."""
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_follow_list('users/following.html', user, followers=False)
 
 
 @app.route('/users/<int:user_id>/followers')
 @login_required
+@db.reads_from_replica
 def users_followers(user_id):
     """Show list of followers of this user."""
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_follow_list('users/followers.html', user, followers=True)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -162,7 +409,15 @@ def users_followers(user_id):
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
     followee = User.query.get_or_404(follow_id)
-    g.user.following.append(followee)
+    db.session.add(Follows(user_being_followed_id=g.user.id,
+                           user_following_id=followee.id))
+    db.session.flush()
+    increment_counters(User, g.user.id, following_count=1)
+    increment_counters(User, followee.id, followers_count=1)
+    timeline.backfill(g.user.id, followee.id,
+                      app.config['TIMELINE_FANOUT_LIMIT'])
+    timeline.followers_changed(followee.id, 1,
+                               app.config['TIMELINE_FANOUT_LIMIT'])
     db.session.commit()
     return redirect(f"/users/{g.user.id}/following")
 
@@ -171,8 +426,19 @@ def add_follow(follow_id):
 @login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
-    followee = User.query.get(follow_id)
-    g.user.following.remove(followee)
+    followee = User.query.get_or_404(follow_id)
+    deleted = (Follows.query
+               .filter_by(user_being_followed_id=g.user.id,
+                          user_following_id=followee.id)
+               .delete())
+    # Only if they were following (not a repeated or double-submitted
+    # unfollow)
+    if deleted:
+        increment_counters(User, g.user.id, following_count=-1)
+        increment_counters(User, followee.id, followers_count=-1)
+        timeline.remove_followee(g.user.id, followee.id)
+        timeline.followers_changed(followee.id, -1,
+                                   app.config['TIMELINE_FANOUT_LIMIT'])
     db.session.commit()
     return redirect(f"/users/{g.user.id}/following")
 
@@ -180,8 +446,16 @@ def stop_following(follow_id):
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
 @login_required
 def messages_liked_list(user_id):
-    """Show page displaying messages a user has liked"""
-    return render_template('users/liked-messages.html', user=g.user)
+    """Show page displaying messages a user has liked, most recently liked
+    first"""
+    page_size = app.config['TIMELINE_PAGE_SIZE']
+    rows = timeline.liked_messages(g.user.id, page_size + 1,
+                                   before=cursor_arg())
+    rows, next_cursor = split_page(rows, page_size,
+                                   lambda row: (row.liked_at, row[0].id))
+    return render_timeline('users/liked-messages.html',
+                           [message for message, liked_at in rows],
+                           next_cursor, user=g.user)
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -200,6 +474,7 @@ def profile():
             user.bio = form.bio.data
             db.session.add(user)
             db.session.commit()
+            forget_principal(user.id)
             flash(f"{user.username} your changes were successful!")
             return redirect(f"/users/{user.id}")
         flash("Invalid credentials.", 'danger')
@@ -217,6 +492,7 @@ def new_pass():
         if user:
             user.password = user.new_pwd(form.new_pwd.data)
         db.session.commit()
+        forget_principal(g.user.id)
         flash("Password updated!", 'success')
         return redirect(f"users/{user.id}")
     return render_template('users/password.html', form=form)
@@ -225,10 +501,13 @@ def new_pass():
 @app.route('/users/delete', methods=["POST"])
 @login_required
 def delete_user():
-    """Delete user."""
+    """Delete user: they're hidden at once, and their messages, likes and
+    follows are purged in the background."""
     do_logout()
-    db.session.delete(g.user)
+    deletions.delete_user(g.user.id)
     db.session.commit()
+    forget_principal(g.user.id)
+    flash("Your account has been deleted.", "success")
     return redirect("/signup")
 
 
@@ -240,57 +519,154 @@ def delete_user():
 @login_required
 def messages_add():
     """ """
-    msg = Message(text=request.form["text"])
-    g.user.messages.append(msg)
+    msg = Message(text=request.form["text"], user_id=g.user.id)
+    db.session.add(msg)
+    db.session.flush()
+    increment_counters(User, g.user.id, messages_count=1)
+    timeline.fan_out_message(msg, app.config['TIMELINE_FANOUT_LIMIT'])
     db.session.commit()
+    events.publish(author_channel(g.user.id), 'warble',
+                   dict(id=msg.id, user_id=g.user.id, text=msg.text))
     referrer = request.headers.get("Referer")
     if referrer != f"/users/{g.user.id}":
         return f"/users/{g.user.id}"
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by text, best matches first.
+    Takes the search terms in a 'q' param in querystring.
+    """
+    search = request.args.get('q', '').strip()
+    if not search:
+        return render_template('messages/search.html', items=[],
+                               search=search)
+
+    page_size = app.config['TIMELINE_PAGE_SIZE']
+    results = message_search().search(search, limit=page_size + 1,
+                                      before=cursor_arg())
+    results, next_cursor = split_page(results, page_size,
+                                      lambda row: (row[1], row[0].id))
+    return render_timeline('messages/search.html',
+                           [msg for msg, score in results], next_cursor,
+                           search=search)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@db.reads_from_replica
 def messages_show(message_id):
     """Show a message."""
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+    return httpcache.conditional(
+        lambda: render_template('messages/show.html', message=msg),
+        msg.id, msg.version, msg.user.id, msg.user.version)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
 @login_required
 def messages_destroy(message_id):
-    """Delete a message."""
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    """Delete a message (see messages_destroy_many)."""
+    if not deletions.delete_messages(g.user.id, [message_id]):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
     db.session.commit()
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/messages/delete', methods=["POST"])
+@login_required
+def messages_destroy_many():
+    """Delete the user's messages in the 'message_id' form values.
+
+    They're hidden at once, and purged in the background; returns 202 with
+    the deletion's status URL as JSON.
+    """
+    message_ids = request.form.getlist('message_id', type=int)
+    if not message_ids:
+        abort(400)
+    job = deletions.delete_messages(g.user.id, message_ids)
+    if job is None:
+        abort(404)
+    db.session.commit()
+    status_url = url_for('deletion_status', job_id=job.id)
+    return jsonify(id=job.id, status=status_url), 202, {'Location': status_url}
+
+
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 @login_required
 def messages_like(message_id):
-    """Logic for liking a message"""
-    like = Like(message_id=message_id, user_id=g.user.id)
-    db.session.add(like)
+    """Like a message; returns its like count as JSON."""
+    liked = like_message(g.user.id, message_id)
+    if liked is None:
+        abort(404)
     db.session.commit()
-    message = Message.query.get(message_id)
-    amount = len(message.likes)
-    return jsonify(amount)
+    publish_like_count(message_id, liked)
+    return jsonify(liked.like_count)
 
 
 @app.route('/messages/<int:message_id>/unlike', methods=["POST"])
 @login_required
 def messages_un_like(message_id):
-    """Logic for unliking a message"""
-    likes = (Like
-             .query
-             .filter(Like.user_id == g.user.id)
-             .filter(Like.message_id == message_id)
-             .first())
-    db.session.delete(likes)
+    """Unlike a message; returns its like count as JSON."""
+    unliked = unlike_message(g.user.id, message_id)
+    if unliked is None:
+        abort(404)
     db.session.commit()
-    message = Message.query.get(message_id)
-    amount = len(message.likes)
-    return jsonify(amount)
+    publish_like_count(message_id, unliked)
+    return jsonify(unliked.like_count)
+
+
+def publish_like_count(message_id, change):
+    """Tell live pages showing `message_id` its new like count."""
+    events.publish(author_channel(change.author_id), 'likes',
+                   dict(id=message_id, like_count=change.like_count))
+
+
+@app.route('/deletions/<int:job_id>')
+def deletion_status(job_id):
+    """JSON progress of a background deletion.
+
+    Anyone may follow an account's (its owner is logged out by then);
+    deletions of messages are their author's to see.
+    """
+    job = DeletionJob.query.get_or_404(job_id)
+    if job.kind == 'messages' and not (g.user and g.user.id == job.user_id):
+        abort(404)
+    finished_at = job.finished_at and job.finished_at.isoformat() + 'Z'
+    return jsonify(id=job.id, kind=job.kind, state=job.state,
+                   rows_deleted=job.rows_deleted,
+                   created_at=job.created_at.isoformat() + 'Z',
+                   finished_at=finished_at)
+
+
+##############################################################################
+# Live updates
+
+
+@app.route('/events')
+def live_events():
+    """Server-Sent Events stream of new warbles and like counts.
+
+    For the authors given as 'user' params (a profile page), at most
+    EVENTS_MAX_AUTHORS of them, or else the logged-in user and everyone they
+    follow (the home page).
+    """
+    authors = set(request.args.getlist('user', type=int))
+    if len(authors) > app.config['EVENTS_MAX_AUTHORS']:
+        abort(400)
+    if not authors:
+        if not g.user:
+            abort(401)
+        authors = [g.user.id] + [id for id, in (
+            db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == g.user.id))]
+    # Subscribe now, so nothing published from here on is missed
+    subscription = events.subscribe(map(author_channel, authors))
+    return Response(events.stream(subscription),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 ##############################################################################
@@ -298,42 +674,57 @@ def messages_un_like(message_id):
 
 
 @app.route('/')
+@db.reads_from_replica
 def homepage():
     """Show homepage:
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees, a page at a time
     """
     if g.user:
-        ids = [user.id for user in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages, user=g.user)
+        page_size = app.config['TIMELINE_PAGE_SIZE']
+        messages = timeline.home_timeline(
+            g.user.id, app.config['TIMELINE_FANOUT_LIMIT'],
+            limit=page_size + 1, before=cursor_arg())
+        messages, next_cursor = split_page(messages, page_size,
+                                           timeline.sort_key)
+        return render_timeline('home.html', messages, next_cursor,
+                               user=g.user)
     else:
-        return render_template('home-anon.html')
+        return httpcache.conditional(
+            lambda: render_template('home-anon.html'),
+            last_modified=httpcache.started_at)
+
+
+@app.cli.command('repair-counters')
+def repair_counters_command():
+    """Recompute all denormalized counters from scratch."""
+    repair_counters()
+    db.session.commit()
 
 
 @app.errorhandler(404)
 def show_404_page(err):
-    return render_template("404.html")
+    return render_template("404.html"), 404
+
+
+@app.errorhandler(HasherBusy)
+def show_busy_page(err):
+    """Too many logins at once: ask the client to retry shortly."""
+    resp = make_response("Warbler is busy, please try again in a moment.",
+                         503)
+    resp.headers['Retry-After'] = '1'
+    return resp
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that haven't said otherwise (see httpcache.conditional) may be
+# kept by the browser, but must be revalidated before each use and never
+# shared. Static files keep Flask's own caching headers.
 
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(resp):
+    """Default pages to private, always-revalidated caching."""
+    if 'Cache-Control' not in resp.headers:
+        resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp
@@ -0,0 +1,221 @@
+"""Static assets for Warbler: vendoring, fingerprinting and serving.
+
+Run from the repo root:
+
+    python assets.py vendor     # refetch the pinned third-party files
+    python assets.py build      # fingerprint and precompress static/
+
+Third-party CSS and JS (Bootstrap, whose bundle includes Popper, and
+jQuery) are pinned in VENDOR and kept in static/vendor/, so pages don't
+depend on a CDN.
+
+`build` copies every file under static/ to static/dist/ with a hash of
+its contents in the name (style.css -> style.3f2a9c1b7e.css), rewriting
+the /static/ URLs in stylesheets to match, and writes gzip and (if the
+brotli package is installed) brotli variants of the compressible ones,
+plus manifest.json mapping each original name to its fingerprinted one.
+
+In the app, `static_url('stylesheets/style.css')` gives the fingerprinted
+URL, served by /assets/ in the best encoding the client accepts with a
+year-long immutable Cache-Control. Without a build (e.g. in development)
+it falls back to the plain /static/ URL.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import urllib.request
+
+from flask import request, send_file, url_for
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: builds just skip the .br variants
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, 'static')
+DIST = os.path.join(STATIC, 'dist')
+MANIFEST = os.path.join(DIST, 'manifest.json')
+
+VENDOR = {
+    'vendor/bootstrap.min.css':
+        'https://unpkg.com/bootstrap@4.5.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap.bundle.min.js':
+        'https://unpkg.com/bootstrap@4.5.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/jquery.min.js':
+        'https://unpkg.com/jquery@3.5.1/dist/jquery.min.js',
+}
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html'}
+# Not worth a compressed copy below this many bytes
+MIN_COMPRESS_SIZE = 512
+ONE_YEAR = 365 * 24 * 60 * 60
+
+_SOURCE_MAP = re.compile(rb'\n?(?://|/\*)# sourceMappingURL=.*$', re.M)
+_CSS_URL = re.compile(r'''url\((['"]?)/static/([^'")?#]+)''')
+
+
+def vendor(static=STATIC):
+    """Download the pinned VENDOR files into `static`."""
+
+    for name, url in VENDOR.items():
+        with urllib.request.urlopen(url) as resp:
+            content = resp.read()
+        # The source maps aren't vendored, so don't point browsers at them
+        content = _SOURCE_MAP.sub(b'', content)
+        path = os.path.join(static, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        print(f"{name}: {len(content)} bytes from {url}")
+
+
+def build(static=STATIC, dist=None):
+    """Fingerprint and precompress everything in `static` into `dist`
+    (default: static/dist/), returning the manifest."""
+
+    dist = dist or os.path.join(static, 'dist')
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+
+    names = []
+    for root, dirs, files in os.walk(static):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.join(root, d) != dist)
+        names.extend(os.path.relpath(os.path.join(root, name), static)
+                     .replace(os.sep, '/')
+                     for name in sorted(files))
+
+    # Stylesheets last, so the URLs they refer to are already fingerprinted
+    manifest = {}
+    for name in sorted(names, key=lambda name: name.endswith('.css')):
+        with open(os.path.join(static, name), 'rb') as f:
+            content = f.read()
+        if name.endswith('.css'):
+            content = _rewrite_css_urls(content, manifest)
+        manifest[name] = _write_variants(dist, name, content)
+
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def fingerprinted(name, content):
+    """`name` with a hash of `content` before its extension."""
+
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def _rewrite_css_urls(content, manifest):
+    def replace(match):
+        quote, name = match.groups()
+        if name in manifest:
+            return f"url({quote}/assets/{manifest[name]}"
+        return match.group(0)
+
+    return _CSS_URL.sub(replace, content.decode()).encode()
+
+
+def _write_variants(dist, name, content):
+    hashed = fingerprinted(name, content)
+    path = os.path.join(dist, hashed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    if (os.path.splitext(name)[1] in COMPRESSIBLE
+            and len(content) >= MIN_COMPRESS_SIZE):
+        # mtime=0 so rebuilding unchanged files gives identical output
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(content))
+    return hashed
+
+
+class Assets:
+    """Serves a build's fingerprinted files at /assets/ and gives
+    templates `static_url()`."""
+
+    def __init__(self):
+        self.manifest = {}
+        self.dist = DIST
+
+    def init_app(self, app):
+        """Load the manifest from ASSETS_DIST (default static/dist/), if
+        there's been a build, and add the route and template helper."""
+
+        self.dist = app.config.get('ASSETS_DIST', DIST)
+        self.load()
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'static_url')
+
+    def load(self):
+        try:
+            with open(os.path.join(self.dist, 'manifest.json')) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def url(self, filename):
+        """URL of static file `filename`: fingerprinted if it's built."""
+
+        hashed = self.manifest.get(filename)
+        if hashed is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=hashed)
+
+    def serve(self, filename):
+        path = safe_join(self.dist, filename)
+        if path is None or not os.path.isfile(path):
+            raise NotFound()
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        accepted = request.accept_encodings
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[candidate] and os.path.isfile(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+
+        resp = send_file(path, mimetype=mimetype, conditional=True)
+        if encoding:
+            resp.headers['Content-Encoding'] = encoding
+        resp.vary.add('Accept-Encoding')
+        resp.headers['Cache-Control'] = (
+            f'public, max-age={ONE_YEAR}, immutable')
+        return resp
+
+
+assets = Assets()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['vendor', 'build'])
+    args = parser.parse_args()
+
+    if args.command == 'vendor':
+        vendor()
+    else:
+        manifest = build()
+        if brotli is None:
+            print("brotli isn't installed; built gzip variants only",
+                  file=sys.stderr)
+        print(f"{len(manifest)} files fingerprinted into {DIST}")
+
+
+if __name__ == '__main__':
+    main()
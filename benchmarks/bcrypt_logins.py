@@ -0,0 +1,81 @@
+"""Benchmark password checks per second, inline vs. the hashing pool.
+
+Run from the repo root, e.g.:
+
+    python -m benchmarks.bcrypt_logins --logins 200 --concurrency 16
+
+"before" checks passwords inline on a single thread, the way one sync
+worker used to serve logins inside the request; "after" sends them from
+`--concurrency` threads through the PasswordHasher process pool. Checks
+refused because the pool's queue was full are counted as fast-failed
+rather than served.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import HasherBusy, PasswordHasher, hash_password
+
+PASSWORD = "correct horse battery staple"
+
+
+def run(hasher, hashed, logins, concurrency):
+    """Check `logins` passwords from `concurrency` threads.
+
+    Returns (served per second, number fast-failed).
+    """
+
+    def login(_):
+        try:
+            return hasher.check(hashed, PASSWORD)
+        except HasherBusy:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as threads:
+        results = list(threads.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+
+    served = sum(1 for result in results if result)
+    return served / elapsed, results.count(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="bcrypt work factor (default 12)")
+    parser.add_argument('--logins', type=int, default=100,
+                        help="password checks per run (default 100)")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="simultaneous login threads for the pool "
+                             "(default 16)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="hashing processes (default one per CPU)")
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help="pool queue limit (default four per worker)")
+    args = parser.parse_args()
+
+    cores = os.cpu_count()
+    hashed = hash_password(PASSWORD, args.rounds)
+    cases = [
+        ("before (inline)", PasswordHasher(args.rounds, workers=0,
+                                           max_pending=args.logins), 1),
+        ("after (pool)", PasswordHasher(args.rounds, workers=args.workers,
+                                        max_pending=args.max_pending),
+         args.concurrency),
+    ]
+
+    print(f"{args.logins} logins, {args.concurrency} concurrent to the "
+          f"pool, cost {args.rounds}, {cores} cores")
+    for label, hasher, concurrency in cases:
+        # Start any pool processes before timing
+        hasher.check(hashed, PASSWORD)
+        rate, rejected = run(hasher, hashed, args.logins, concurrency)
+        print(f"{label:16} {rate:8.1f} logins/sec {rate / cores:8.1f} "
+              f"per core {rejected:6} fast-failed")
+
+
+if __name__ == '__main__':
+    main()
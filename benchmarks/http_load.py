@@ -0,0 +1,396 @@
+"""Load-test Warbler over HTTP with a realistic mix of traffic.
+
+Run from the repo root, e.g.:
+
+    python -m benchmarks.http_load --load --users 10000 --messages 100000 \\
+        --requests 5000 --concurrency 16 --mode socket
+
+Boots `app` against --database-url (which must exist; --load first fills
+it with generated data of the given size, replacing what's there). Clients
+log in as a random sample of users and browse the home feed, profiles and
+search, like and unlike, follow and unfollow, and post, the mix weighted
+by MIX. Clients run either in-process through Flask's test client or over
+a local socket to a threaded server.
+
+Per route, this reports p50/p95/p99 latency, requests/sec and SQL queries
+per request. Results are saved as JSON (see --out), and --baseline prints
+the change against an earlier run, so regressions can be diffed between
+commits. Runs are repeatable for a given --seed and dataset. Posts and
+follows do change the data, though, so reload between comparisons.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from math import ceil
+from urllib.parse import urlencode
+
+# Route label: relative weight of each kind of visit
+MIX = {
+    'home': 40,
+    'profile': 20,
+    'message': 5,
+    'search': 10,
+    'users': 5,
+    'like': 10,
+    'follow': 5,
+    'post': 5,
+}
+
+SEARCH_WORDS = ["people", "game", "history", "change", "story", "water",
+                "music", "government", "money", "world", "night", "family"]
+
+QUERIES_HEADER = 'X-Bench-Queries'
+
+
+def percentile(sorted_values, p):
+    """The `p`th percentile (nearest rank) of already-sorted values."""
+
+    if not sorted_values:
+        return None
+    return sorted_values[max(ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def count_queries(app, engine):
+    """Send the number of SQL statements each request ran back in an
+    X-Bench-Queries header."""
+
+    from sqlalchemy import event
+
+    local = threading.local()
+
+    def count(*args):
+        local.count = getattr(local, 'count', 0) + 1
+
+    def reset():
+        local.count = 0
+
+    def report(resp):
+        # A streamed page may still run queries as it renders, so render
+        # it now for them to count
+        if resp.is_streamed:
+            resp.make_sequence()
+        resp.headers[QUERIES_HEADER] = str(getattr(local, 'count', 0))
+        return resp
+
+    event.listen(engine, 'before_cursor_execute', count)
+    # Ahead of the app's own hooks, so loading the logged-in user counts
+    app.before_request_funcs.setdefault(None, []).insert(0, reset)
+    app.after_request(report)
+
+
+class TestClient:
+    """Requests through Flask's test client, in this thread."""
+
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, cookie, data=None):
+        resp = self.client.open(path, method=method, data=data,
+                                headers={'Cookie': cookie})
+        return resp.status_code, resp.headers.get(QUERIES_HEADER)
+
+
+class SocketClient:
+    """Requests over HTTP to a server on localhost."""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, path, cookie, data=None):
+        headers = {'Cookie': cookie}
+        body = None
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request(method, path, body, headers)
+        resp = self.conn.getresponse()
+        resp.read()
+        return resp.status, resp.getheader(QUERIES_HEADER)
+
+
+class Visitor:
+    """One simulated user's visits, chosen from `rng`."""
+
+    def __init__(self, rng, actor_id, cookie, max_user_id, max_message_id):
+        self.rng = rng
+        self.actor_id = actor_id
+        self.cookie = cookie
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+
+    def visit(self):
+        """Requests for a random visit, as [(label, method, path, data)]."""
+
+        kind = self.rng.choices(list(MIX), list(MIX.values()))[0]
+        return getattr(self, kind)()
+
+    def home(self):
+        return [('home', 'GET', '/', None)]
+
+    def profile(self):
+        return [('profile', 'GET', f"/users/{self.user()}", None)]
+
+    def message(self):
+        return [('message', 'GET', f"/messages/{self.message_id()}", None)]
+
+    def search(self):
+        word = self.rng.choice(SEARCH_WORDS)
+        return [('search', 'GET', f"/messages/search?q={word}", None)]
+
+    def users(self):
+        word = self.rng.choice(SEARCH_WORDS)[:3]
+        return [('users', 'GET', f"/users?q={word}", None)]
+
+    def like(self):
+        message_id = self.message_id()
+        return [('like', 'POST', f"/messages/{message_id}/like", None),
+                ('unlike', 'POST', f"/messages/{message_id}/unlike", None)]
+
+    def follow(self):
+        from models import follow_states
+
+        user_id = self.user()
+        if user_id == self.actor_id or follow_states(
+                self.actor_id, [user_id])[user_id]:
+            return self.profile()
+        return [('follow', 'POST', f"/users/follow/{user_id}", None),
+                ('unfollow', 'POST', f"/users/stop-following/{user_id}",
+                 None)]
+
+    def post(self):
+        text = " ".join(self.rng.choices(SEARCH_WORDS, k=8))
+        return [('post', 'POST', '/messages/new', {'text': text})]
+
+    def user(self):
+        return self.rng.randint(1, self.max_user_id)
+
+    def message_id(self):
+        return self.rng.randint(1, self.max_message_id)
+
+
+def load_data(args):
+    """Generate a dataset of the requested size and bulk-load it."""
+
+    from app import app
+    from loader import Loader
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run([
+            sys.executable, 'generator/create_csvs.py', '--out', out,
+            '--seed', str(args.seed), '--workers', str(args.workers),
+            '--users', str(args.users), '--messages', str(args.messages),
+            '--follows', str(args.follows), '--likes', str(args.likes),
+        ], check=True)
+        from models import db
+        with app.app_context():
+            with db.engine.connect() as connection:
+                loader = Loader(connection)
+                tables = ['users', 'messages', 'follows', 'likes']
+                loader.start(tables)
+                for table in tables:
+                    with open(os.path.join(out, f"{table}.csv"),
+                              newline='') as source:
+                        loader.load(table, source)
+                loader.finish(app.config['TIMELINE_FANOUT_LIMIT'])
+
+
+def run(args):
+    """Drive the traffic; returns {label: [(seconds, status, queries)]}."""
+
+    from flask.sessions import SecureCookieSessionInterface
+    from app import app, CURR_USER_KEY
+    from models import db, User, Message
+
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    count_queries(app, db.engine)
+
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+        dataset = dict(users=User.query.count(),
+                       messages=Message.query.count())
+    if not max_user_id or not max_message_id:
+        sys.exit("No users or messages to browse; run with --load first")
+
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+
+    def cookie(user_id):
+        value = serializer.dumps({CURR_USER_KEY: user_id})
+        return f"{app.session_cookie_name}={value}"
+
+    server = None
+    if args.mode == 'socket':
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    lock = threading.Lock()
+
+    def client_thread(index, visits, record):
+        rng = random.Random(f"{args.seed}:{index}")
+        client = (SocketClient(server.server_port) if server
+                  else TestClient(app))
+        for _ in range(visits):
+            actor = rng.randint(1, max_user_id)
+            visitor = Visitor(rng, actor, cookie(actor), max_user_id,
+                              max_message_id)
+            with app.app_context():
+                visit = visitor.visit()
+            for label, method, path, data in visit:
+                start = time.perf_counter()
+                status, queries = client.request(method, path,
+                                                 visitor.cookie, data)
+                elapsed = time.perf_counter() - start
+                if record:
+                    with lock:
+                        results.setdefault(label, []).append(
+                            (elapsed, status, int(queries or 0)))
+
+    def drive(visits, record):
+        per_client = ceil(visits / args.concurrency)
+        threads = [threading.Thread(target=client_thread,
+                                    args=(i, per_client, record))
+                   for i in range(args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    drive(args.warmup, record=False)
+    elapsed = drive(args.requests, record=True)
+    if server:
+        server.shutdown()
+    return dataset, elapsed, results
+
+
+def summarize(dataset, elapsed, results, args):
+    """The JSON-able report for a run."""
+
+    def stats(samples):
+        times = sorted(seconds * 1000 for seconds, _, _ in samples)
+        return dict(
+            requests=len(samples),
+            errors=sum(1 for _, status, _ in samples if status >= 500),
+            requests_per_sec=round(len(samples) / elapsed, 1),
+            p50_ms=round(percentile(times, 50), 2),
+            p95_ms=round(percentile(times, 95), 2),
+            p99_ms=round(percentile(times, 99), 2),
+            queries_per_request=round(
+                sum(queries for _, _, queries in samples) / len(samples), 2),
+        )
+
+    everything = [sample for samples in results.values()
+                  for sample in samples]
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(
+        commit=commit,
+        finished=datetime.now().isoformat(timespec='seconds'),
+        mode=args.mode,
+        concurrency=args.concurrency,
+        seed=args.seed,
+        dataset=dataset,
+        seconds=round(elapsed, 2),
+        total=stats(everything),
+        routes={label: stats(samples)
+                for label, samples in sorted(results.items())},
+    )
+
+
+def print_report(report, baseline=None):
+    columns = ['requests', 'requests_per_sec', 'p50_ms', 'p95_ms', 'p99_ms',
+               'queries_per_request', 'errors']
+    print(f"{report['total']['requests']} requests in {report['seconds']}s, "
+          f"{report['concurrency']} concurrent ({report['mode']}), "
+          f"dataset {report['dataset']}")
+    print(f"{'route':10}" + "".join(f"{column:>20}" for column in columns))
+    rows = list(report['routes'].items()) + [('total', report['total'])]
+    for label, stats in rows:
+        old = None
+        if baseline:
+            old = (baseline['total'] if label == 'total'
+                   else baseline['routes'].get(label))
+        cells = []
+        for column in columns:
+            cell = f"{stats[column]}"
+            if old and old.get(column):
+                change = (stats[column] - old[column]) / old[column] * 100
+                cell += f" ({change:+.0f}%)"
+            cells.append(f"{cell:>20}")
+        print(f"{label:10}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default='postgresql:///warbler-bench',
+                        help="database to run against "
+                             "(default postgresql:///warbler-bench)")
+    parser.add_argument('--load', action='store_true',
+                        help="generate and load a fresh dataset first")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=200000)
+    parser.add_argument('--likes', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes for generating data (default 1)")
+    parser.add_argument('--mode', choices=['inprocess', 'socket'],
+                        default='inprocess',
+                        help="test client in-process, or HTTP to a local "
+                             "threaded server (default inprocess)")
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="visits to time (default 2000)")
+    parser.add_argument('--warmup', type=int, default=100,
+                        help="untimed visits first (default 100)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="simultaneous clients (default 8)")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--out', default=None,
+                        help="JSON file for results (default "
+                             "benchmarks/results/<commit>-<time>.json)")
+    parser.add_argument('--baseline', default=None,
+                        help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    # app reads its database from the environment when imported
+    os.environ['DATABASE_URL'] = args.database_url
+
+    if args.load:
+        load_data(args)
+    dataset, elapsed, results = run(args)
+    report = summarize(dataset, elapsed, results, args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    out = args.out or os.path.join(
+        'benchmarks', 'results',
+        f"{report['commit'] or 'nogit'}-"
+        f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
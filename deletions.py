@@ -0,0 +1,331 @@
+"""Deleting accounts and messages without holding up the request.
+
+Deleting an account used to load and cascade every one of its messages,
+likes and follows inside the request. Now the request only tombstones
+the rows (sets their deleted_at), which hides them from every query at
+once (see `models.hide_tombstoned`), and records a DeletionJob. Once the
+request commits, the job is queued, and a worker purges what's left: in
+transactions of at most DELETION_BATCH_SIZE rows each, with
+DELETION_PAUSE seconds between them so other writes get a look in,
+keeping other users' and messages' counters in step as it goes.
+
+`LocalQueue` runs jobs on a thread in this process, and when it starts
+picks up any a restart left unfinished. Anything with its `put` can
+stand in, e.g. one feeding a separate worker process. Batches lock the
+rows they delete, so a job being run twice does no harm.
+
+GET /deletions/<id> reports a job's progress.
+"""
+
+import logging
+import time
+from datetime import datetime
+from queue import Queue
+from threading import Lock, Thread
+
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from models import (db, DeletionJob, Follows, Like, Message, TimelineEntry,
+                    User, increment_counters)
+from timeline import followers_changed
+
+logger = logging.getLogger('warbler.deletions')
+
+users = User.__table__
+messages = Message.__table__
+likes = Like.__table__
+follows = Follows.__table__
+timeline_entries = TimelineEntry.__table__
+
+
+class LocalQueue:
+    """Runs jobs, one at a time, on a thread of this process: `run(job_id)`
+    each one, starting with those `unfinished()` returns."""
+
+    def __init__(self, run, unfinished):
+        self.run = run
+        self.unfinished = unfinished
+        self._queue = Queue()
+        self._queued = set()
+        self._lock = Lock()
+        self._worker = None
+
+    def put(self, job_id):
+        with self._lock:
+            if self._worker is None:
+                # Started on first use, so it runs in the worker, not a
+                # parent that forks
+                self._worker = Thread(target=self._work, daemon=True,
+                                      name='warbler-deletions')
+                self._worker.start()
+            self._put(job_id)
+
+    def join(self):
+        """Wait until every queued job has been run."""
+
+        self._queue.join()
+
+    def _put(self, job_id):
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put(job_id)
+
+    def _work(self):
+        try:
+            unfinished = self.unfinished()
+        except Exception:
+            logger.exception("couldn't look for unfinished deletions")
+            unfinished = []
+        with self._lock:
+            for job_id in unfinished:
+                self._put(job_id)
+        while True:
+            job_id = self._queue.get()
+            try:
+                self.run(job_id)
+            finally:
+                with self._lock:
+                    self._queued.discard(job_id)
+                self._queue.task_done()
+
+
+class Deletions:
+    """Tombstones accounts and messages, and purges them in the
+    background."""
+
+    def __init__(self):
+        self.app = None
+        self.queue = LocalQueue(self._run, self._unfinished)
+
+    def init_app(self, app):
+        """Purge DELETION_BATCH_SIZE rows at a time, pausing DELETION_PAUSE
+        seconds between batches."""
+
+        app.config.setdefault('DELETION_BATCH_SIZE', 1000)
+        app.config.setdefault('DELETION_PAUSE', 0.1)
+        self.app = app
+
+    def delete_user(self, user_id):
+        """Tombstone `user_id`, and purge them once this transaction
+        commits. Returns the DeletionJob."""
+
+        (User.query
+         .filter(User.id == user_id)
+         .update({User.deleted_at: datetime.utcnow(),
+                  User.version: User.version + 1},
+                 synchronize_session=False))
+        return self._add_job('user', user_id)
+
+    def delete_messages(self, user_id, message_ids):
+        """Tombstone those of `message_ids` that `user_id` wrote, and purge
+        them once this transaction commits. Returns the DeletionJob, or
+        None if there weren't any."""
+
+        deleted = (Message.query
+                   .filter(Message.id.in_(message_ids),
+                           Message.user_id == user_id,
+                           Message.deleted_at.is_(None))
+                   .update({Message.deleted_at: datetime.utcnow(),
+                            Message.version: Message.version + 1},
+                           synchronize_session=False))
+        if not deleted:
+            return None
+        increment_counters(User, user_id, messages_count=-deleted)
+        return self._add_job('messages', user_id)
+
+    def join(self):
+        """Wait for queued jobs to finish (for tests)."""
+
+        self.queue.join()
+
+    def _add_job(self, kind, user_id):
+        job = DeletionJob(kind=kind, user_id=user_id)
+        db.session.add(job)
+        db.session.flush()
+        db.session.info.setdefault('deletion_jobs', []).append(job.id)
+        return job
+
+    def _unfinished(self):
+        with self.app.app_context():
+            return unfinished_jobs()
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                purge(job_id)
+            except Exception:
+                db.session.rollback()
+                logger.exception("deletion job %s failed", job_id)
+                (DeletionJob.query
+                 .filter(DeletionJob.id == job_id)
+                 .update({DeletionJob.state: 'failed'}))
+                db.session.commit()
+
+
+deletions = Deletions()
+
+
+@event.listens_for(Session, 'after_commit')
+def _queue_jobs(session):
+    for job_id in session.info.pop('deletion_jobs', ()):
+        deletions.queue.put(job_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_jobs(session):
+    session.info.pop('deletion_jobs', None)
+
+
+def unfinished_jobs():
+    """Ids of jobs that are queued, or were running when the process
+    stopped."""
+
+    rows = (db.session
+            .query(DeletionJob.id)
+            .filter(DeletionJob.state.in_(['queued', 'running']))
+            .order_by(DeletionJob.id))
+    return [id for id, in rows]
+
+
+##############################################################################
+# Purging
+
+
+def purge(job_id):
+    """Run DeletionJob `job_id` to the end, a batch per transaction."""
+
+    job = DeletionJob.query.get(job_id)
+    if job is None or job.state == 'done':
+        return
+    job.state = 'running'
+    db.session.commit()
+
+    if job.kind == 'user':
+        steps = [purge_messages(job.user_id),
+                 purge_likes(job.user_id),
+                 purge_follows(job.user_id),
+                 purge_followers(job.user_id),
+                 purge_timeline(job.user_id)]
+    else:
+        steps = [purge_messages(job.user_id, tombstoned_only=True)]
+
+    pause = current_app.config['DELETION_PAUSE']
+    for step in steps:
+        for deleted in step:
+            job.rows_deleted = DeletionJob.rows_deleted + deleted
+            db.session.commit()
+            time.sleep(pause)
+
+    if job.kind == 'user':
+        db.session.execute(users.delete().where(users.c.id == job.user_id))
+    job.state = 'done'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _batch(query):
+    """Up to DELETION_BATCH_SIZE of the first column of `query`, locked
+    for deletion."""
+
+    query = query.limit(current_app.config['DELETION_BATCH_SIZE'])
+    return [row[0] for row in db.session.execute(query.with_for_update())]
+
+
+def purge_messages(user_id, tombstoned_only=False):
+    """Delete `user_id`'s (tombstoned) messages, with their likes and
+    timeline entries, yielding the rows deleted per batch."""
+
+    query = select([messages.c.id]).where(messages.c.user_id == user_id)
+    if tombstoned_only:
+        query = query.where(messages.c.deleted_at.isnot(None))
+    while True:
+        ids = _batch(query)
+        if not ids:
+            return
+        # Each liker may have liked several of them
+        liked = (select([func.count()])
+                 .where(likes.c.user_id == users.c.id)
+                 .where(likes.c.message_id.in_(ids))
+                 .as_scalar())
+        db.session.execute(
+            users.update()
+            .where(users.c.id.in_(select([likes.c.user_id])
+                                  .where(likes.c.message_id.in_(ids))))
+            .values(likes_count=users.c.likes_count - liked,
+                    version=users.c.version + 1))
+        deleted = sum(db.session.execute(statement).rowcount for statement in (
+            likes.delete().where(likes.c.message_id.in_(ids)),
+            timeline_entries.delete()
+            .where(timeline_entries.c.message_id.in_(ids)),
+            messages.delete().where(messages.c.id.in_(ids)),
+        ))
+        yield deleted
+
+
+def purge_likes(user_id):
+    """Delete `user_id`'s likes, yielding the rows deleted per batch."""
+
+    query = select([likes.c.message_id]).where(likes.c.user_id == user_id)
+    while True:
+        ids = _batch(query)
+        if not ids:
+            return
+        increment_counters(Message, ids, like_count=-1)
+        yield db.session.execute(
+            likes.delete()
+            .where(likes.c.user_id == user_id)
+            .where(likes.c.message_id.in_(ids))).rowcount
+
+
+def purge_follows(user_id):
+    """Delete whom `user_id` follows, yielding the rows deleted per batch.
+    """
+
+    query = (select([follows.c.user_following_id])
+             .where(follows.c.user_being_followed_id == user_id))
+    while True:
+        ids = _batch(query)
+        if not ids:
+            return
+        increment_counters(User, ids, followers_count=-1)
+        deleted = db.session.execute(
+            follows.delete()
+            .where(follows.c.user_being_followed_id == user_id)
+            .where(follows.c.user_following_id.in_(ids))).rowcount
+        followers_changed(ids, -1, current_app.config['TIMELINE_FANOUT_LIMIT'])
+        yield deleted
+
+
+def purge_followers(user_id):
+    """Delete who follows `user_id`, yielding the rows deleted per batch.
+    """
+
+    query = (select([follows.c.user_being_followed_id])
+             .where(follows.c.user_following_id == user_id))
+    while True:
+        ids = _batch(query)
+        if not ids:
+            return
+        increment_counters(User, ids, following_count=-1)
+        yield db.session.execute(
+            follows.delete()
+            .where(follows.c.user_following_id == user_id)
+            .where(follows.c.user_being_followed_id.in_(ids))).rowcount
+
+
+def purge_timeline(user_id):
+    """Delete `user_id`'s home timeline, yielding the rows deleted per
+    batch."""
+
+    query = (select([timeline_entries.c.message_id])
+             .where(timeline_entries.c.user_id == user_id))
+    while True:
+        ids = _batch(query)
+        if not ids:
+            return
+        yield db.session.execute(
+            timeline_entries.delete()
+            .where(timeline_entries.c.user_id == user_id)
+            .where(timeline_entries.c.message_id.in_(ids))).rowcount
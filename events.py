@@ -0,0 +1,204 @@
+"""Live updates for Warbler, pushed to browsers as Server-Sent Events.
+
+Routes publish events on channels (new warbles and like counts go out on
+"author:<id>" for the message's author) and each open /events stream
+subscribes to the channels of the authors on its page.
+
+The broker passes events between them. `LocalBroker` keeps subscriptions
+in this process, which is enough for a single worker. `PostgresBroker`
+shares events between processes (e.g. several gunicorn workers) over
+Postgres's LISTEN/NOTIFY: publishing NOTIFYs, and a listener thread in
+each process hands what it hears to that process's subscribers. Any
+object with the same publish/subscribe methods can stand in, e.g. one
+backed by Redis. EVENTS_BROKER picks one ('local' or 'postgres').
+
+Streams spend nearly all their time waiting, so serve them from an async
+worker (see gunicorn.conf.py); a sync worker would be tied up by each
+open page.
+"""
+
+import json
+import logging
+import select
+import time
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+from sqlalchemy import func
+
+logger = logging.getLogger('warbler.events')
+
+NOTIFY_CHANNEL = 'warbler_events'
+
+
+class Subscription:
+    """Events on some channels, queued for one stream."""
+
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = channels
+        self.queue = Queue(maxsize)
+        self.closed = False
+
+    def put(self, event, data):
+        try:
+            self.queue.put_nowait((event, data))
+        except Full:
+            # Too far behind: drop it, and let the client reconnect
+            self.close()
+
+    def get(self, timeout):
+        """The next (event, data), or None after `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Publish/subscribe between the requests of this process."""
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = Lock()
+        self._subscriptions = defaultdict(set)
+
+    def publish(self, channel, event, data):
+        """Send (`event`, `data`) to `channel`'s subscribers."""
+
+        self.deliver(channel, event, data)
+
+    def deliver(self, channel, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event, data)
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, set(channels), self.queue_size)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[channel]
+
+
+class PostgresBroker(LocalBroker):
+    """Publish/subscribe between processes through LISTEN/NOTIFY."""
+
+    def __init__(self, engine, queue_size=100):
+        super().__init__(queue_size)
+        self.engine = engine
+        self._listener = None
+
+    def publish(self, channel, event, data):
+        payload = json.dumps([channel, event, data])
+        with self.engine.connect() as connection:
+            connection.execution_options(autocommit=True).execute(
+                func.pg_notify(NOTIFY_CHANNEL, payload).select())
+
+    def subscribe(self, channels):
+        # Started on first use, so it runs in the worker, not a parent
+        # that forks
+        with self._lock:
+            if self._listener is None:
+                self._listener = Thread(target=self._listen, daemon=True,
+                                        name='warbler-events-listener')
+                self._listener.start()
+        return super().subscribe(channels)
+
+    def _listen(self):
+        while True:
+            try:
+                connection = self.engine.raw_connection()
+                try:
+                    self._relay(connection.connection)
+                finally:
+                    connection.close()
+            except Exception:
+                logger.exception("event listener lost its connection")
+                time.sleep(1)
+
+    def _relay(self, connection):
+        # End the transaction the pool's pre-ping may have begun
+        connection.rollback()
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+        while True:
+            if select.select([connection], [], [], 30) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                notify = connection.notifies.pop(0)
+                channel, event, data = json.loads(notify.payload)
+                self.deliver(channel, event, data)
+
+
+class Events:
+    """The app's broker, and SSE streams of its subscriptions."""
+
+    def __init__(self):
+        self.broker = LocalBroker()
+        self.heartbeat = 15
+        self.retry_ms = 3000
+
+    def init_app(self, app, engine=None):
+        """Set up the EVENTS_BROKER ('local', or 'postgres' on `engine`),
+        with EVENTS_QUEUE_SIZE events queued per stream at most and a
+        keep-alive every EVENTS_HEARTBEAT seconds."""
+
+        queue_size = app.config.get('EVENTS_QUEUE_SIZE', 100)
+        if app.config.get('EVENTS_BROKER', 'local') == 'postgres':
+            self.broker = PostgresBroker(engine, queue_size)
+        else:
+            self.broker = LocalBroker(queue_size)
+        self.heartbeat = app.config.get('EVENTS_HEARTBEAT', 15)
+
+    def publish(self, channel, event, data):
+        try:
+            self.broker.publish(channel, event, data)
+        except Exception:
+            # Live updates are a nicety; never fail the write over them
+            logger.exception("couldn't publish %s on %s", event, channel)
+
+    def subscribe(self, channels):
+        return self.broker.subscribe(channels)
+
+    def stream(self, subscription):
+        """The SSE body for `subscription`, with comment lines as
+        keep-alives (which also notice clients that have gone)."""
+
+        try:
+            yield f"retry: {self.retry_ms}\n\n"
+            while not subscription.closed:
+                item = subscription.get(self.heartbeat)
+                if item is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            subscription.close()
+
+
+def author_channel(user_id):
+    return f"author:{user_id}"
+
+
+events = Events()
@@ -0,0 +1,136 @@
+"""Cached message cards for Warbler's message lists.
+
+Every list of warbles (home timeline, profiles, liked messages, search)
+renders each message as the same `<li>` card, whoever is looking, apart
+from the like button. So `message_card(item, viewer)` renders
+messages/_card.html once per message version and keeps it, keyed on the
+message's id, version and like count, a hash of the author fields the card
+shows (not the author's version, which every follow, like and post of
+theirs bumps) and a hash of the template so a deploy that changes it
+starts afresh. Any change makes a new key, so nothing is ever
+invalidated.
+
+The card is stored with both states of its like button, split at SLOT
+markers (user text is escaped, so it can't contain one); the viewer's
+button, or none, is put back in by string concatenation. A page of cards
+is then mostly joining cached strings.
+
+Cards are kept in a bounded in-process LRU (FRAGMENT_CACHE_SIZE entries,
+FRAGMENT_CACHE_TTL seconds), and optionally behind that in a `backend`
+shared by processes: any object with `get(key)` and `set(key, value)` for
+string values, e.g. a memcached or Redis client.
+"""
+
+import hashlib
+import logging
+
+from markupsafe import Markup
+
+from cache import TTLCache
+
+logger = logging.getLogger('warbler.fragments')
+
+CARD_TEMPLATE = 'messages/_card.html'
+
+# What the card shows of its author
+AUTHOR_FIELDS = ('id', 'username', 'image_url')
+
+# Separates the parts of a stored card: before the like button, the
+# button to unlike, the button to like, and after it
+SLOT = '<!--like-button-->'
+
+
+class Fragments:
+    """Renders message cards through the cache."""
+
+    def __init__(self):
+        self.app = None
+        self.local = TTLCache(maxsize=10000, ttl=3600)
+        self.backend = None
+        self._prefix = None
+
+    def init_app(self, app, backend=None):
+        """Size the local cache from FRAGMENT_CACHE_SIZE and
+        FRAGMENT_CACHE_TTL, share cards through `backend` if given, and add
+        the `message_card` template helper."""
+
+        self.local.maxsize = app.config.get('FRAGMENT_CACHE_SIZE', 10000)
+        self.local.ttl = app.config.get('FRAGMENT_CACHE_TTL', 3600)
+        self.backend = backend
+        self.app = app
+        self._prefix = None
+        app.add_template_global(self.message_card, 'message_card')
+
+    def message_card(self, item, viewer=None):
+        """The card for TimelineItem `item`, as seen by `viewer` (the
+        logged-in user, or None)."""
+
+        before, unlike, like, after = self.parts(item.message, item.author)
+        if viewer is None or item.message.user_id == viewer.id:
+            button = ''
+        elif item.liked:
+            button = unlike
+        else:
+            button = like
+        return Markup(before + button + after)
+
+    def parts(self, message, author):
+        """The viewer-independent parts of `message`'s card."""
+
+        key = (f"{self.prefix}:{message.id}:{message.version}:"
+               f"{message.like_count}:{author_stamp(author)}")
+        card = self.local.get(key)
+        if card is None:
+            card = self._shared_get(key)
+            if card is None:
+                card = self.app.jinja_env.get_template(CARD_TEMPLATE).render(
+                    msg=message, author=author, slot=Markup(SLOT))
+                self._shared_set(key, card)
+            card = card.split(SLOT)
+            self.local.set(key, card)
+        return card
+
+    @property
+    def prefix(self):
+        """Cache key prefix, changing with the card template."""
+
+        if self._prefix is None:
+            env = self.app.jinja_env
+            source, _, _ = env.loader.get_source(env, CARD_TEMPLATE)
+            digest = hashlib.sha1(source.encode()).hexdigest()[:10]
+            self._prefix = f"card:{digest}"
+        return self._prefix
+
+    def clear(self):
+        self.local.clear()
+
+    def _shared_get(self, key):
+        if self.backend is None:
+            return None
+        try:
+            card = self.backend.get(key)
+        except Exception:
+            # The shared cache is only an optimisation
+            logger.exception("couldn't read %s from the fragment cache", key)
+            return None
+        if isinstance(card, bytes):
+            card = card.decode()
+        return card
+
+    def _shared_set(self, key, card):
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, card)
+        except Exception:
+            logger.exception("couldn't write %s to the fragment cache", key)
+
+
+def author_stamp(author):
+    """Short hash of the AUTHOR_FIELDS of `author`."""
+
+    fields = '\0'.join(str(getattr(author, name)) for name in AUTHOR_FIELDS)
+    return hashlib.sha1(fields.encode()).hexdigest()[:12]
+
+
+fragments = Fragments()
@@ -2,29 +2,69 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --likes 20000000 --workers 8 --out /tmp/big
+
+then load them with loader.py.
+
+Output depends only on the flags and --seed, not on --workers: rows are
+made in fixed-size blocks, each from its own seeded RNG, written to part
+files and stitched together in order. Memory use doesn't grow with the
+row counts, and nothing is fetched over the network.
+
+Follows and likes are skewed the way real traffic is. A few users have
+most of the followers and a few messages most of the likes (both follow
+Zipf's law), and the users who post most are also the ones who follow and
+like most.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, power_law_rank, power_law_share, Shuffle
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'user_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 2000
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# Timestamps run up to here, so output doesn't depend on when it's made
+END_DATE = datetime(2019, 5, 1)
 
-# Generate random profile image URLs to use for users
+# Rank r is r ** -exponent as likely to be followed/liked as rank 1
+POPULARITY_EXPONENT = 1.0
+# ... and makes that share of the posts, follows and likes
+ACTIVITY_EXPONENT = 0.5
+
+# Users/messages per block of work
+BLOCK_SIZE = 100000
+
+# Faker is slow (up to 0.3ms a value), so each block draws from pools of
+# this many of its values
+FAKER_POOL_SIZE = 1000
+
+HERE = os.path.dirname(os.path.abspath(__file__))
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +72,171 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followee, user_following_id=follower))
+# Collected once from splashbase.co, so generating needs no network
+with open(os.path.join(HERE, 'header_images.txt')) as header_images:
+    header_image_urls = header_images.read().split()
+
+Plan = namedtuple('Plan', [
+    'users', 'messages', 'follows', 'likes', 'seed',
+    'popular_users', 'active_users', 'popular_messages',
+])
+
+
+def pool(make):
+    return [make() for _ in range(FAKER_POOL_SIZE)]
+
+
+def users(plan, fake, rng, ids):
+    names, domains = pool(fake.user_name), pool(fake.free_email_domain)
+    bios, cities = pool(fake.sentence), pool(fake.city)
+    for id in ids:
+        # The id suffix keeps usernames (and so emails) unique
+        username = f"{rng.choice(names)}.{id}"
+        yield [
+            f"{username}@{rng.choice(domains)}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            rng.choice(bios),
+            rng.choice(header_image_urls),
+            rng.choice(cities),
+        ]
+
+
+def messages(plan, fake, rng, ids):
+    sentences = pool(fake.sentence)
+    for id in ids:
+        author = plan.active_users(
+            power_law_rank(rng, plan.users, ACTIVITY_EXPONENT))
+        text = " ".join(rng.choices(sentences, k=rng.randint(1, 4)))
+        yield [
+            text[:MAX_WARBLER_LENGTH],
+            get_random_datetime(rng=rng, now=END_DATE),
+            author,
+        ]
+
+
+def follows(plan, fake, rng, ids):
+    for follower in ids:
+        count = min(power_law_share(plan.active_users.rank(follower),
+                                    plan.users, plan.follows,
+                                    ACTIVITY_EXPONENT),
+                    plan.users - 1)
+        for followee in distinct(rng, count, plan.popular_users,
+                                 exclude=follower):
+            yield [follower, followee]
+
+
+def likes(plan, fake, rng, ids):
+    for user in ids:
+        count = min(power_law_share(plan.active_users.rank(user),
+                                    plan.users, plan.likes,
+                                    ACTIVITY_EXPONENT),
+                    plan.messages)
+        for message in distinct(rng, count, plan.popular_messages):
+            yield [message, user]
+
+
+def distinct(rng, count, shuffle, exclude=None):
+    """`count` different ids from `shuffle`, the popular ones likelier."""
+
+    if count > shuffle.n // 4:
+        # Too many for rejection sampling to be quick; the range is small
+        ids = [id for id in range(1, shuffle.n + 1) if id != exclude]
+        return rng.sample(ids, count)
+
+    chosen = set()
+    while len(chosen) < count:
+        id = shuffle(power_law_rank(rng, shuffle.n, POPULARITY_EXPONENT))
+        if id != exclude:
+            chosen.add(id)
+    return chosen
+
+
+TABLES = {
+    # name: (headers, rows for a range of ids, how many ids there are)
+    'users': (USERS_CSV_HEADERS, users, lambda plan: plan.users),
+    'messages': (MESSAGES_CSV_HEADERS, messages, lambda plan: plan.messages),
+    'follows': (FOLLOWS_CSV_HEADERS, follows, lambda plan: plan.users),
+    'likes': (LIKES_CSV_HEADERS, likes, lambda plan: plan.users),
+}
+
+
+def write_block(plan, table, block, ids, path):
+    """Write `table`'s rows for `ids` to `path`; returns the row count."""
+
+    block_seed = f"{plan.seed}:{table}:{block}"
+    rng = random.Random(block_seed)
+    fake = Faker()
+    fake.seed_instance(block_seed)
+
+    _, make_rows, _ = TABLES[table]
+    rows = make_rows(plan, fake, rng, ids)
+    count = 0
+    with open(path, 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed, same data (default 'warbler')")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes to generate with (default 1)")
+    parser.add_argument('--out', default=HERE,
+                        help="directory for the CSVs (default generator/)")
+    args = parser.parse_args()
+
+    if args.follows > args.users * (args.users - 1):
+        parser.error("more follows than pairs of users")
+    if args.likes > args.users * args.messages:
+        parser.error("more likes than users x messages")
+
+    rng = random.Random(args.seed)
+    plan = Plan(args.users, args.messages, args.follows, args.likes,
+                args.seed,
+                popular_users=Shuffle(rng, max(args.users, 1)),
+                active_users=Shuffle(rng, max(args.users, 1)),
+                popular_messages=Shuffle(rng, max(args.messages, 1)))
+
+    os.makedirs(args.out, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=args.out) as parts:
+        for table, (headers, _, count_ids) in TABLES.items():
+            last = count_ids(plan)
+            jobs = [
+                (plan, table, block,
+                 range(first, min(first + BLOCK_SIZE, last + 1)),
+                 os.path.join(parts, f"{table}.{block:06}.csv"))
+                for block, first in enumerate(range(1, last + 1, BLOCK_SIZE))
+            ]
+
+            start = time.perf_counter()
+            if args.workers > 1:
+                with Pool(args.workers) as pool:
+                    count = sum(pool.starmap(write_block, jobs))
+            else:
+                count = sum(write_block(*job) for job in jobs)
+
+            with open(os.path.join(args.out, f"{table}.csv"), 'w',
+                      newline='') as out:
+                csv.writer(out).writerow(headers)
+                for *_, path in jobs:
+                    with open(path, newline='') as part:
+                        shutil.copyfileobj(part, out)
+                    os.remove(path)
+
+            elapsed = time.perf_counter() - start
+            print(f"{table}: {count} rows in {elapsed:.1f}s "
+                  f"({count / elapsed:,.0f} rows/sec)")
+
+
+if __name__ == '__main__':
+    main()
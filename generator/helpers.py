@@ -1,14 +1,75 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from itertools import accumulate
+from math import gcd
 
+# Relative activity by hour of day: quiet overnight, busiest in the evening
+HOURLY_WEIGHTS = [3, 2, 1, 1, 1, 2, 3, 5, 6, 6, 6, 7,
+                  8, 7, 6, 6, 7, 8, 9, 10, 10, 9, 7, 5]
+_HOURS = range(24)
+_CUMULATIVE_HOURLY_WEIGHTS = list(accumulate(HOURLY_WEIGHTS))
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def get_random_datetime(year_gap=2, rng=random, now=None):
+    """Get a random datetime within the last few years.
+
+    Later days are likelier than earlier ones, as on a growing site, and
+    the time of day follows HOURLY_WEIGHTS. `rng` is the random.Random to
+    draw from and `now` the end of the range (default: the current time).
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    # Square root of a uniform draw: density rising linearly towards `now`
+    days = int((now - then).days * rng.random() ** 0.5)
+    hour = rng.choices(_HOURS, cum_weights=_CUMULATIVE_HOURLY_WEIGHTS)[0]
+    seconds = hour * 3600 + rng.uniform(0, 3600)
+
+    return (then.replace(hour=0, minute=0, second=0, microsecond=0)
+            + timedelta(days=days, seconds=seconds))
+
+
+def power_law_rank(rng, n, exponent=1.0):
+    """Random rank in 1..n, with rank r about r ** -exponent as likely as
+    rank 1 (Zipf's law for an exponent of 1)."""
+
+    u = rng.random()
+    if exponent == 1:
+        x = (n + 1) ** u
+    else:
+        x = (1 + u * ((n + 1) ** (1 - exponent) - 1)) ** (1 / (1 - exponent))
+    return min(int(x), n)
+
+
+def power_law_share(rank, n, total, exponent):
+    """Rank `rank`'s share of `total`, split over ranks 1..n in proportion
+    to rank ** -exponent (0 <= exponent < 1). Shares sum to exactly `total`.
+    """
+
+    def cumulative(r):
+        return int(total * (r / n) ** (1 - exponent))
+
+    return cumulative(rank) - cumulative(rank - 1)
+
+
+class Shuffle:
+    """A seeded bijection on 1..n that's cheap in time and memory (an
+    affine map mod n), for handing out ranks to ids at random."""
+
+    def __init__(self, rng, n):
+        self.n = n
+        self.step = rng.randrange(1, n) if n > 1 else 1
+        while gcd(self.step, n) != 1:
+            self.step += 1
+        self.offset = rng.randrange(n)
+        self.inverse_step = pow(self.step, -1, n) if n > 1 else 1
+
+    def __call__(self, rank):
+        """The id given `rank`."""
+        return ((rank - 1) * self.step + self.offset) % self.n + 1
 
-    return datetime.fromtimestamp(random_timestamp)
+    def rank(self, id):
+        """The rank given to `id`."""
+        return ((id - 1 - self.offset) * self.inverse_step) % self.n + 1
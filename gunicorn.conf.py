@@ -0,0 +1,62 @@
+"""gunicorn settings for Warbler (see Procfile).
+
+Workers are gevent-based, so each can hold thousands of idle /events
+streams (see events.py) while still serving ordinary requests. Set
+GUNICORN_WORKER_CLASS=sync to go back to one request per worker.
+
+With more than one worker, live updates have to cross processes, so
+EVENTS_BROKER defaults to 'postgres', and setting it to 'local' stops
+gunicorn from starting rather than leaving some streams deaf.
+"""
+
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+if workers > 1:
+    # Read by app.py, which each worker imports after this
+    os.environ.setdefault('EVENTS_BROKER', 'postgres')
+# Open connections (mostly event streams) per gevent worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS',
+                                        10000))
+
+
+def on_starting(server):
+    check_events_broker(server.cfg.workers,
+                        os.environ.get('EVENTS_BROKER', 'local'))
+
+
+def check_events_broker(workers, broker):
+    """Refuse an in-process events broker shared by several workers."""
+
+    if workers > 1 and broker == 'local':
+        raise RuntimeError(
+            f"EVENTS_BROKER=local can't reach across {workers} workers; "
+            "use EVENTS_BROKER=postgres or WEB_CONCURRENCY=1")
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        make_psycopg2_green()
+
+
+def make_psycopg2_green():
+    """Have psycopg2 wait on the database through gevent, so a query
+    yields to the worker's other connections instead of blocking them."""
+
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import OperationalError, extensions
+
+    def wait(connection, timeout=None):
+        while True:
+            state = connection.poll()
+            if state == extensions.POLL_OK:
+                return
+            if state == extensions.POLL_READ:
+                wait_read(connection.fileno(), timeout=timeout)
+            elif state == extensions.POLL_WRITE:
+                wait_write(connection.fileno(), timeout=timeout)
+            else:
+                raise OperationalError(f"Bad result from poll: {state!r}")
+
+    extensions.set_wait_callback(wait)
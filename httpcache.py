@@ -0,0 +1,109 @@
+"""Conditional GETs for Warbler's pages.
+
+Users and messages carry a version stamp that's bumped by every write to
+the row (see models.py). A page built from some rows gets a weak ETag
+derived from their ids and versions, the viewer's own version (which
+covers their likes, follows and navbar), the URL, whether it's an
+infinite-scroll fetch, and the app's templates and static files. A
+client sending a matching If-None-Match gets a 304 without the page being
+rendered.
+
+Pages are sent with `Cache-Control: no-cache`, so browsers (and, for
+anonymous pages, shared caches) keep them but revalidate on each use:
+content is never stale, and unchanged pages cost a few small queries.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from flask import g, make_response, request, session
+
+from assets import assets
+from models import db, User
+from principal import forget_principal, load_current_user
+
+# Changes whenever the templates or static files do, so a deploy
+# invalidates every ETag
+salt = ''
+# Last-Modified for pages that depend only on the templates
+started_at = datetime.utcnow().replace(microsecond=0)
+
+
+def init_app(app):
+    """Derive the ETag salt from the contents of `app`'s templates and
+    the asset manifest (pages link to fingerprinted files)."""
+
+    global salt, started_at
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in sorted(os.walk(folder)):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, folder).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(json.dumps(assets.manifest, sort_keys=True).encode())
+    salt = digest.hexdigest()
+    started_at = datetime.utcnow().replace(microsecond=0)
+
+
+def viewer_stamp():
+    """(id, version) of the logged-in user, or None if logged out.
+
+    The version is read from the database, not the principal cache; if
+    the cached principal turns out to be stale it's reloaded, so the page
+    is rendered from the same version its ETag names.
+    """
+
+    if not g.user:
+        return None
+    version = (db.session
+               .query(User.version)
+               .filter(User.id == g.user.id)
+               .scalar())
+    if version != g.user.version:
+        forget_principal(g.user.id)
+        g.user = load_current_user(g.user.id)
+    return g.user.id, version
+
+
+def etag(*parts):
+    """Weak ETag value for this request's page, built from `parts`."""
+
+    key = repr((salt, request.full_path,
+                request.headers.get('X-Requested-With'), viewer_stamp(),
+                parts))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def conditional(render, *parts, last_modified=None):
+    """Answer 304 if the client's copy of the page built from `parts`
+    is current, else the response from `render()`.
+
+    `parts` are ids and version stamps of everything shown on the page
+    beyond the viewer themselves. Pages with pending flash messages are
+    always rendered, since rendering is what shows and clears them.
+    """
+
+    if '_flashes' in session:
+        return make_response(render())
+
+    tag = etag(*parts)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(tag)
+    else:
+        fresh = (last_modified is not None
+                 and request.if_modified_since is not None
+                 and last_modified <= request.if_modified_since)
+
+    resp = make_response('', 304) if fresh else make_response(render())
+    resp.set_etag(tag, weak=True)
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    resp.headers['Cache-Control'] = ('private, no-cache' if g.user
+                                     else 'public, no-cache')
+    resp.vary.update(('Cookie', 'X-Requested-With'))
+    return resp
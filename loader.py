@@ -0,0 +1,294 @@
+"""Bulk-load Warbler data from CSV files.
+
+Run from the repo root, e.g.:
+
+    python loader.py                        # generator/*.csv, from scratch
+    python loader.py users=big/users.csv messages=- < big/messages.csv
+    python loader.py --resume ...           # carry on after an interruption
+
+Each source is read a chunk at a time, so memory use doesn't grow with
+the file. On PostgreSQL chunks go through COPY FROM STDIN, with the loaded
+tables' secondary indexes and foreign keys dropped for the load and rebuilt
+at the end; other databases (SQLite, for local testing) get chunked
+executemany INSERTs.
+
+Rows without an `id` column are numbered by their line in the source, the
+way the generator's follows refer to users. Every chunk commits together
+with a note of how far its source has got, so --resume skips what's
+already in and picks up from the next chunk. Once everything is in,
+sequences are reset and counters, search documents and timelines are
+rebuilt.
+"""
+
+import argparse
+import csv
+import io
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from models import db, repair_counters
+from schema import Migrator
+from search import message_search
+from timeline import rebuild_timelines
+
+SOURCES = [
+    ('users', 'generator/users.csv'),
+    ('messages', 'generator/messages.csv'),
+    ('follows', 'generator/follows.csv'),
+    ('likes', 'generator/likes.csv'),
+]
+
+CHUNK_ROWS = 50000
+
+
+class Loader:
+    """Loads CSV rows into tables over `connection`, resumably."""
+
+    def __init__(self, connection, chunk_rows=CHUNK_ROWS, out=sys.stdout):
+        self.connection = connection
+        self.chunk_rows = chunk_rows
+        self.out = out
+        self.postgres = connection.dialect.name == 'postgresql'
+
+    def start(self, tables):
+        """Create an empty schema and get `tables` ready for a fresh load."""
+
+        with self.connection.begin():
+            self.connection.execute("DROP TABLE IF EXISTS load_progress")
+            self.connection.execute("DROP TABLE IF EXISTS load_deferred")
+        db.metadata.drop_all(self.connection)
+        # Built by the migrator, so every migration is recorded as applied
+        with self.connection.begin():
+            self.connection.execute("DROP TABLE IF EXISTS schema_migrations")
+        Migrator(self.connection).upgrade()
+        with self.connection.begin():
+            self.connection.execute(
+                "CREATE TABLE load_progress (name VARCHAR PRIMARY KEY, "
+                "rows_done INTEGER NOT NULL, finished INTEGER NOT NULL)")
+            self.connection.execute(
+                "CREATE TABLE load_deferred (position INTEGER PRIMARY KEY, "
+                "create_sql TEXT NOT NULL)")
+            if self.postgres:
+                self._defer_constraints(tables)
+
+    def load(self, table_name, source):
+        """Load CSV text from the file object `source` into `table_name`,
+        skipping rows a previous attempt already loaded."""
+
+        table = db.metadata.tables[table_name]
+        done, finished = self._progress(table_name)
+        if finished:
+            self.out.write(f"{table_name}: already loaded\n")
+            return
+
+        reader = csv.reader(source)
+        columns = next(reader)
+        numbered = 'id' in table.c and 'id' not in columns
+        if numbered:
+            columns = ['id'] + columns
+        rows = islice(reader, done, None)
+
+        start, loaded = time.perf_counter(), 0
+        while True:
+            chunk = list(islice(rows, self.chunk_rows))
+            if not chunk:
+                break
+            if numbered:
+                chunk = [[done + n] + row
+                         for n, row in enumerate(chunk, start=1)]
+            with self.connection.begin():
+                if self.postgres:
+                    self._copy(table, columns, chunk)
+                else:
+                    self._insert(table, columns, chunk)
+                done += len(chunk)
+                self._set_progress(table_name, done, 0)
+            loaded += len(chunk)
+            self._report(table_name, loaded, start)
+
+        with self.connection.begin():
+            self._set_progress(table_name, done, 1)
+        self._report(table_name, loaded, start, final=True)
+
+    def finish(self, fanout_limit):
+        """Rebuild what the load put off, then derived data (timelines
+        are fanned out for authors with up to `fanout_limit` followers).
+
+        GIN indexes are put back last, after the derived data, so filling
+        in the search documents doesn't update them row by row; the other
+        indexes go first, as the recounts look rows up by them.
+        """
+
+        self._replay_deferred(gin=False)
+
+        if self.postgres:
+            with self.connection.begin():
+                self._reset_sequences()
+                self.connection.execute("ANALYZE")
+
+        # The load bypassed the write paths, so fill in counters, search
+        # documents and timelines now
+        repair_counters()
+        message_search().reindex()
+        rebuild_timelines(fanout_limit)
+        db.session.commit()
+
+        self._replay_deferred(gin=True)
+
+        with self.connection.begin():
+            self.connection.execute("DROP TABLE load_progress")
+            self.connection.execute("DROP TABLE load_deferred")
+
+    def _replay_deferred(self, gin):
+        """Run the load_deferred statements that build GIN indexes, or
+        those that don't, in order."""
+
+        deferred = self.connection.execute(
+            "SELECT position, create_sql FROM load_deferred "
+            "ORDER BY position").fetchall()
+        for position, create_sql in deferred:
+            if (' USING gin ' in create_sql) != gin:
+                continue
+            start = time.perf_counter()
+            with self.connection.begin():
+                self.connection.execute(create_sql)
+                self.connection.execute(
+                    db.text("DELETE FROM load_deferred "
+                            "WHERE position = :position"),
+                    position=position)
+            self.out.write(f"{create_sql} "
+                           f"({time.perf_counter() - start:.1f}s)\n")
+
+    def _copy(self, table, columns, chunk):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(chunk)
+        buf.seek(0)
+        quote = self.connection.dialect.identifier_preparer.quote
+        cursor = self.connection.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {quote(table.name)} ({', '.join(map(quote, columns))}) "
+            f"FROM STDIN WITH (FORMAT csv)", buf)
+
+    def _insert(self, table, columns, chunk):
+        converters = [_converter(table.c[column]) for column in columns]
+        self.connection.execute(table.insert(), [
+            {column: convert(value)
+             for column, convert, value in zip(columns, converters, row)}
+            for row in chunk
+        ])
+
+    def _progress(self, table_name):
+        row = self.connection.execute(
+            db.text("SELECT rows_done, finished FROM load_progress "
+                    "WHERE name = :name"), name=table_name).first()
+        if row is None:
+            with self.connection.begin():
+                self.connection.execute(
+                    db.text("INSERT INTO load_progress VALUES (:name, 0, 0)"),
+                    name=table_name)
+            return 0, 0
+        return row
+
+    def _set_progress(self, table_name, rows_done, finished):
+        self.connection.execute(
+            db.text("UPDATE load_progress SET rows_done = :rows_done, "
+                    "finished = :finished WHERE name = :name"),
+            name=table_name, rows_done=rows_done, finished=finished)
+
+    def _defer_constraints(self, tables):
+        """Swap the foreign keys and non-unique indexes on `tables` for
+        rows in load_deferred that put them back."""
+
+        foreign_keys = self.connection.execute(db.text("""
+            SELECT format('ALTER TABLE %s DROP CONSTRAINT %I',
+                          conrelid::regclass, conname),
+                   format('ALTER TABLE %s ADD CONSTRAINT %I %s',
+                          conrelid::regclass, conname,
+                          pg_get_constraintdef(oid))
+            FROM pg_constraint
+            WHERE contype = 'f' AND conrelid::regclass::text = ANY(:tables)
+        """), tables=list(tables)).fetchall()
+        indexes = self.connection.execute(db.text("""
+            SELECT format('DROP INDEX %s', indexrelid::regclass),
+                   pg_get_indexdef(indexrelid)
+            FROM pg_index
+            WHERE NOT indisunique AND indrelid::regclass::text = ANY(:tables)
+        """), tables=list(tables)).fetchall()
+
+        # Put indexes back before the foreign keys that check against them
+        for position, (drop_sql, create_sql) in enumerate(
+                indexes + foreign_keys):
+            self.connection.execute(drop_sql)
+            self.connection.execute(
+                db.text("INSERT INTO load_deferred "
+                        "VALUES (:position, :create_sql)"),
+                position=position, create_sql=create_sql)
+
+    def _reset_sequences(self):
+        for table in db.metadata.sorted_tables:
+            if 'id' in table.c and table.c.id.autoincrement is not False:
+                self.connection.execute(db.text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', "
+                    f"'id'), coalesce(max(id), 0) + 1, false) "
+                    f"FROM {table.name}"))
+
+    def _report(self, table_name, loaded, start, final=False):
+        elapsed = time.perf_counter() - start
+        rate = loaded / elapsed if elapsed else 0
+        label = "done" if final else "..."
+        self.out.write(f"{table_name}: {loaded} rows in {elapsed:.1f}s "
+                       f"({rate:,.0f} rows/sec) {label}\n")
+
+
+def _converter(column):
+    """Turn CSV text into a value SQLite will take for `column`."""
+
+    if isinstance(column.type, db.DateTime):
+        return lambda value: datetime.fromisoformat(value) if value else None
+    return lambda value: value if value != '' else None
+
+
+def _source(spec):
+    table, _, path = spec.partition('=')
+    if not path:
+        raise argparse.ArgumentTypeError(
+            f"expected TABLE=PATH, got {spec!r}")
+    if table not in db.metadata.tables:
+        raise argparse.ArgumentTypeError(f"no table called {table!r}")
+    return table, path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sources', nargs='*', type=_source,
+                        metavar='TABLE=PATH',
+                        help="CSV to load into TABLE, - for stdin "
+                             "(default: the generator/ CSVs)")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help=f"rows per COPY/commit (default {CHUNK_ROWS})")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted load instead of "
+                             "starting from an empty database")
+    args = parser.parse_args()
+    sources = args.sources or SOURCES
+
+    from app import app
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            loader = Loader(connection, args.chunk_rows)
+            if not args.resume:
+                loader.start([table for table, _ in sources])
+            for table, path in sources:
+                if path == '-':
+                    loader.load(table, sys.stdin)
+                else:
+                    with open(path, newline='') as source:
+                        loader.load(table, source)
+            loader.finish(app.config['TIMELINE_FANOUT_LIMIT'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""Per-request performance metrics for Warbler.
+
+Every request's latency, response size, SQL statements (count and time)
+and template render time are recorded per endpoint; streamed responses
+are recorded once their body has been sent. Database pools report their
+checkout waits and connections in use (see routing.py). With SERVER_TIMING
+on, each response also carries a Server-Timing header, so the browser's
+network panel shows the same breakdown.
+
+/metrics serves them in the Prometheus text format once METRICS_ENABLED is
+on, and is a 404 until then. With METRICS_TOKEN set too, scrapers must
+send `Authorization: Bearer <token>` or get a 403.
+
+Metrics are kept per process; under gunicorn, scrape each worker (or run
+one) to see them all.
+"""
+
+import hmac
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from flask import (Response, abort, before_render_template, current_app, g,
+                   has_app_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+POOL_WAIT_BUCKETS = (.0001, .001, .005, .01, .05, .1, .5, 1, 5)
+
+
+class Histogram:
+    """Counts of observations at or below each bucket's upper bound."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """(name, labels, value) lines for Prometheus, buckets cumulative."""
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f"{name}_bucket", dict(labels, le=str(bound)), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class RequestTimings:
+    """What one request has spent so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0
+        self.render_seconds = 0
+        self.render_start = None
+
+
+class Metrics:
+    """Collects request metrics for an app and serves them at /metrics."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._engine_hooked = False
+        self.pools = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)
+            self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+            self.response_size = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+            self.sql_statements = defaultdict(int)
+            self.sql_seconds = defaultdict(float)
+            self.render_seconds = defaultdict(float)
+            self.pool_wait = defaultdict(
+                lambda: Histogram(POOL_WAIT_BUCKETS))
+
+    def init_app(self, app):
+        """Hook into `app`'s requests, template rendering and SQL, and add
+        the /metrics endpoint. SERVER_TIMING turns the header on;
+        METRICS_ENABLED and METRICS_TOKEN guard the endpoint."""
+
+        app.config.setdefault('SERVER_TIMING', False)
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_TOKEN', None)
+        # Ahead of the app's own hooks, so they're timed too
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+        if not self._engine_hooked:
+            event.listen(Engine, 'before_cursor_execute', self._sql_started)
+            event.listen(Engine, 'after_cursor_execute', self._sql_finished)
+            self._engine_hooked = True
+
+    def view(self):
+        if not current_app.config['METRICS_ENABLED']:
+            abort(404)
+        token = current_app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(
+                request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(403)
+        return Response(self.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        with self._lock:
+            families = [
+                ('warbler_requests_total', 'counter',
+                 "Requests handled.",
+                 [(labels(('endpoint', 'method', 'status'), key), value)
+                  for key, value in self.requests.items()]),
+                ('warbler_request_duration_seconds', 'histogram',
+                 "Time from the first before_request hook to the response.",
+                 [(labels(('endpoint', 'method'), key), histogram)
+                  for key, histogram in self.latency.items()]),
+                ('warbler_response_size_bytes', 'histogram',
+                 "Response body sizes, as sent.",
+                 [(labels(('endpoint',), (key,)), histogram)
+                  for key, histogram in self.response_size.items()]),
+                ('warbler_sql_statements_total', 'counter',
+                 "SQL statements run while handling requests.",
+                 [(labels(('endpoint',), (key,)), value)
+                  for key, value in self.sql_statements.items()]),
+                ('warbler_sql_seconds_total', 'counter',
+                 "Time spent running SQL statements.",
+                 [(labels(('endpoint',), (key,)), value)
+                  for key, value in self.sql_seconds.items()]),
+                ('warbler_template_render_seconds_total', 'counter',
+                 "Time spent rendering templates.",
+                 [(labels(('endpoint',), (key,)), value)
+                  for key, value in self.render_seconds.items()]),
+                ('warbler_db_pool_wait_seconds', 'histogram',
+                 "Time spent waiting to check out a database connection.",
+                 [(labels(('engine',), (key,)), histogram)
+                  for key, histogram in self.pool_wait.items()]),
+                ('warbler_db_pool_checked_out', 'gauge',
+                 "Database connections currently checked out.",
+                 [(labels(('engine',), (key,)), pool.checkedout())
+                  for key, pool in self.pools.items()]),
+            ]
+
+        lines = []
+        for name, kind, help, series in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for series_labels, value in sorted(
+                    series, key=lambda s: sorted(s[0].items())):
+                if isinstance(value, Histogram):
+                    for sample in value.samples(name, series_labels):
+                        lines.append(format_sample(*sample))
+                else:
+                    lines.append(format_sample(name, series_labels, value))
+        return "\n".join(lines) + "\n"
+
+    def track_pool(self, engine, pool):
+        """Report `pool`'s checked-out connections as `engine`'s."""
+
+        with self._lock:
+            self.pools[engine] = pool
+
+    def observe_pool_wait(self, engine, seconds):
+        with self._lock:
+            self.pool_wait[engine].observe(seconds)
+
+    def _start(self):
+        g._request_timings = RequestTimings()
+
+    def _finish(self, resp):
+        timings = g.get('_request_timings')
+        if timings is None:
+            return resp
+        key = request.endpoint or 'none', request.method, resp.status_code
+
+        if current_app.config['SERVER_TIMING']:
+            # For streamed responses, what was spent before the first byte
+            resp.headers['Server-Timing'] = server_timing(
+                timings, time.perf_counter() - timings.start)
+
+        if resp.is_streamed:
+            # Rendering (and any SQL it does) goes on as the body is sent,
+            # so the request is recorded once the body is done
+            resp.response = self._record_when_sent(resp.response, timings,
+                                                   key)
+        else:
+            g.pop('_request_timings')
+            self._record(timings, key, resp.calculate_content_length())
+        return resp
+
+    def _record_when_sent(self, body, timings, key):
+        size = 0
+        try:
+            for chunk in body:
+                size += len(chunk.encode() if isinstance(chunk, str)
+                            else chunk)
+                yield chunk
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+            self._record(timings, key, size)
+
+    def _record(self, timings, key, size):
+        elapsed = time.perf_counter() - timings.start
+        endpoint, method, status = key
+        with self._lock:
+            self.requests[endpoint, method, status] += 1
+            self.latency[endpoint, method].observe(elapsed)
+            if size is not None:
+                self.response_size[endpoint].observe(size)
+            self.sql_statements[endpoint] += timings.sql_statements
+            self.sql_seconds[endpoint] += timings.sql_seconds
+            self.render_seconds[endpoint] += timings.render_seconds
+
+    def _render_started(self, sender, template, context, **extra):
+        timings = _current_timings()
+        if timings:
+            timings.render_start = time.perf_counter()
+
+    def _render_finished(self, sender, template, context, **extra):
+        timings = _current_timings()
+        if timings and timings.render_start is not None:
+            timings.render_seconds += time.perf_counter() - timings.render_start
+            timings.render_start = None
+
+    def _sql_started(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        if _current_timings():
+            context._metrics_start = time.perf_counter()
+
+    def _sql_finished(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        timings = _current_timings()
+        start = getattr(context, '_metrics_start', None)
+        if timings and start is not None:
+            timings.sql_statements += 1
+            timings.sql_seconds += time.perf_counter() - start
+
+
+def labels(names, values):
+    return dict(zip(names, map(str, values)))
+
+
+def format_sample(name, sample_labels, value):
+    pairs = ",".join(f'{label}="{_escape(label_value)}"'
+                     for label, label_value in sample_labels.items())
+    return f"{name}{{{pairs}}} {value}" if pairs else f"{name} {value}"
+
+
+def server_timing(timings, elapsed):
+    """Server-Timing header value for a request's timings."""
+
+    return ", ".join([
+        f'sql;dur={timings.sql_seconds * 1000:.1f};'
+        f'desc="{timings.sql_statements} queries"',
+        f'render;dur={timings.render_seconds * 1000:.1f}',
+        f'total;dur={elapsed * 1000:.1f}',
+    ])
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _current_timings():
+    return g.get('_request_timings') if has_app_context() else None
+
+
+metrics = Metrics()
@@ -0,0 +1,154 @@
+"""Bring the original `db.create_all()` schema up to the models of the time,
+filling in the new columns and tables from the existing rows.
+
+- users.messages_count, following_count, followers_count, likes_count and
+  messages.like_count: denormalized relationship sizes, recounted here
+- users.version, messages.version: version stamps, starting at 1
+- timeline_entries: materialized home timelines, rebuilt here from the
+  follows and messages (each timeline's BACKFILL_LIMIT newest entries,
+  leaving out authors with more than TIMELINE_FANOUT_LIMIT followers)
+- messages.search_vector: full-text documents, built here, with their GIN
+  index (PostgreSQL only)
+- users (lower(username) text_pattern_ops), and a pg_trgm GIN index of
+  usernames where the extension is available: username search
+  (PostgreSQL only)
+"""
+
+import os
+
+from models import db
+from schema import add_column, create_index, drop_column, drop_index
+from timeline import BACKFILL_LIMIT, REBUILD_BATCH_SIZE
+
+transactional = False
+
+# As app.py reads it
+FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+
+# search.MESSAGE_SEARCH_CONFIG
+SEARCH_CONFIG = 'english'
+
+COUNTERS = [
+    ('users', 'messages_count',
+     "SELECT count(*) FROM messages WHERE messages.user_id = users.id"),
+    ('users', 'following_count',
+     "SELECT count(*) FROM follows "
+     "WHERE follows.user_being_followed_id = users.id"),
+    ('users', 'followers_count',
+     "SELECT count(*) FROM follows "
+     "WHERE follows.user_following_id = users.id"),
+    ('users', 'likes_count',
+     "SELECT count(*) FROM likes WHERE likes.user_id = users.id"),
+    ('messages', 'like_count',
+     "SELECT count(*) FROM likes WHERE likes.message_id = messages.id"),
+]
+
+INDEXES = [
+    ('ix_timeline_entries_user_timestamp', 'timeline_entries',
+     'user_id, timestamp, message_id', None),
+]
+
+SEARCH_INDEXES = [
+    ('ix_messages_search_vector', 'messages', 'search_vector', 'gin'),
+    ('ix_users_username_prefix', 'users',
+     'lower(username) text_pattern_ops', None),
+    ('ix_users_username_trgm', 'users', 'username gin_trgm_ops', 'gin'),
+]
+
+CREATE_TIMELINE_ENTRIES = """
+    CREATE TABLE IF NOT EXISTS timeline_entries (
+        user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        message_id INTEGER NOT NULL
+            REFERENCES messages (id) ON DELETE CASCADE,
+        author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+        timestamp TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, message_id)
+    )
+"""
+
+# As timeline.rebuild_timelines, for the followers from :first to :last
+REBUILD_TIMELINES = """
+    INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+    SELECT user_id, message_id, author_id, timestamp FROM (
+        SELECT follows.user_being_followed_id AS user_id,
+               messages.id AS message_id,
+               messages.user_id AS author_id,
+               messages.timestamp AS timestamp,
+               row_number() OVER (
+                   PARTITION BY follows.user_being_followed_id
+                   ORDER BY messages.timestamp DESC, messages.id DESC
+               ) AS rank
+        FROM follows
+        JOIN messages ON messages.user_id = follows.user_following_id
+        WHERE follows.user_being_followed_id BETWEEN :first AND :last
+          AND follows.user_following_id NOT IN (
+              SELECT id FROM users WHERE followers_count > :fanout_limit)
+    ) AS ranked
+    WHERE rank <= :backfill_limit
+"""
+
+
+def upgrade(connection):
+    postgres = connection.dialect.name == 'postgresql'
+
+    for table, column, count in COUNTERS:
+        add_column(connection, table, column, "INTEGER NOT NULL DEFAULT 0")
+        connection.execute(f"UPDATE {table} SET {column} = ({count})")
+    for table in ('users', 'messages'):
+        add_column(connection, table, 'version', "INTEGER NOT NULL DEFAULT 1")
+
+    connection.execute(CREATE_TIMELINE_ENTRIES)
+    for name, table, columns, using in INDEXES:
+        create_index(connection, name, table, columns, using=using)
+    rebuild_timelines(connection)
+
+    add_column(connection, 'messages', 'search_vector',
+               'TSVECTOR' if postgres else 'TEXT')
+    if not postgres:
+        return
+
+    connection.execute(db.text(
+        "UPDATE messages SET search_vector = to_tsvector(:config, text) "
+        "WHERE search_vector IS NULL"), config=SEARCH_CONFIG)
+    trigrams = connection.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar()
+    if trigrams:
+        connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, table, columns, using in SEARCH_INDEXES:
+        if trigrams or 'gin_trgm_ops' not in columns:
+            create_index(connection, name, table, columns, using=using)
+
+
+def downgrade(connection):
+    for name, table, columns, using in SEARCH_INDEXES:
+        drop_index(connection, name)
+    drop_column(connection, 'messages', 'search_vector')
+
+    for name, table, columns, using in INDEXES:
+        drop_index(connection, name)
+    connection.execute("DROP TABLE IF EXISTS timeline_entries")
+
+    for table in ('messages', 'users'):
+        drop_column(connection, table, 'version')
+    for table, column, count in reversed(COUNTERS):
+        drop_column(connection, table, column)
+
+
+def rebuild_timelines(connection):
+    """Refill timeline_entries, REBUILD_BATCH_SIZE followers at a time."""
+
+    connection.execute("DELETE FROM timeline_entries")
+    last = 0
+    while True:
+        batch = [user_id for (user_id,) in connection.execute(db.text(
+            "SELECT DISTINCT user_being_followed_id FROM follows "
+            "WHERE user_being_followed_id > :last "
+            "ORDER BY user_being_followed_id LIMIT :batch_size"),
+            last=last, batch_size=REBUILD_BATCH_SIZE)]
+        if not batch:
+            return
+        connection.execute(
+            db.text(REBUILD_TIMELINES), first=batch[0], last=batch[-1],
+            fanout_limit=FANOUT_LIMIT, backfill_limit=BACKFILL_LIMIT)
+        last = batch[-1]
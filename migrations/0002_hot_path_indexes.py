@@ -0,0 +1,29 @@
+"""Indexes for the hot read paths.
+
+- messages (user_id, timestamp DESC, id): a profile's messages, newest
+  first, and the celebrity messages merged into home timelines
+- follows (user_following_id): who follows a user (follower lists and
+  fan-out), the reverse of the primary key
+- likes (user_id, message_id): a user's likes, the reverse of the primary
+  key
+"""
+
+from schema import create_index, drop_index
+
+transactional = False
+
+INDEXES = [
+    ('ix_messages_user_timestamp', 'messages', 'user_id, timestamp DESC, id'),
+    ('ix_follows_user_following_id', 'follows', 'user_following_id'),
+    ('ix_likes_user_message', 'likes', 'user_id, message_id'),
+]
+
+
+def upgrade(connection):
+    for name, table, columns in INDEXES:
+        create_index(connection, name, table, columns)
+
+
+def downgrade(connection):
+    for name, table, columns in INDEXES:
+        drop_index(connection, name)
@@ -0,0 +1,50 @@
+"""Tombstones for deleted users and messages, and their purge jobs.
+
+- users.deleted_at, messages.deleted_at: set when deleted, after which
+  they're hidden until purged in the background (see deletions.py)
+- deletion_jobs: the progress of each purge
+- partial indexes of the tombstoned users and messages, which every
+  message query and each purge batch look up
+- timeline_entries (message_id): for deleting a batch of messages' entries
+"""
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text
+
+from schema import add_column, create_index, drop_column, drop_index
+
+transactional = False
+
+deletion_jobs = Table(
+    'deletion_jobs', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('kind', Text, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Column('state', Text, nullable=False, server_default='queued'),
+    Column('rows_deleted', Integer, nullable=False, server_default='0'),
+    Column('created_at', DateTime, nullable=False),
+    Column('finished_at', DateTime),
+)
+
+INDEXES = [
+    ('ix_users_tombstoned', 'users', 'id', 'deleted_at IS NOT NULL'),
+    ('ix_messages_tombstoned', 'messages', 'user_id',
+     'deleted_at IS NOT NULL'),
+    ('ix_timeline_entries_message_id', 'timeline_entries', 'message_id',
+     None),
+]
+
+
+def upgrade(connection):
+    add_column(connection, 'users', 'deleted_at', 'TIMESTAMP')
+    add_column(connection, 'messages', 'deleted_at', 'TIMESTAMP')
+    deletion_jobs.create(connection, checkfirst=True)
+    for name, table, columns, where in INDEXES:
+        create_index(connection, name, table, columns, where)
+
+
+def downgrade(connection):
+    for name, table, columns, where in INDEXES:
+        drop_index(connection, name)
+    deletion_jobs.drop(connection, checkfirst=True)
+    drop_column(connection, 'messages', 'deleted_at')
+    drop_column(connection, 'users', 'deleted_at')
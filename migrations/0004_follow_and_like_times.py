@@ -0,0 +1,47 @@
+"""When each follow and like was made, for lists ordered by recency.
+
+- follows.created_at, likes.created_at: existing rows get the time of the
+  migration (on PostgreSQL 11+ adding a column with a stable default
+  doesn't rewrite the table)
+- follows (user_being_followed_id, created_at DESC, user_following_id):
+  whom a user follows, most recent first
+- follows (user_following_id, created_at DESC, user_being_followed_id):
+  who follows a user, most recent first
+- likes (user_id, created_at DESC, message_id): a user's likes, most
+  recent first
+- follows (user_following_id) from 0002 is dropped, as the second index
+  above serves every lookup it did
+"""
+
+from schema import add_column, create_index, drop_column, drop_index
+
+transactional = False
+
+INDEXES = [
+    ('ix_follows_user_being_followed_created', 'follows',
+     'user_being_followed_id, created_at DESC, user_following_id'),
+    ('ix_follows_user_following_created', 'follows',
+     'user_following_id, created_at DESC, user_being_followed_id'),
+    ('ix_likes_user_created', 'likes', 'user_id, created_at DESC, message_id'),
+]
+
+
+def upgrade(connection):
+    now = 'CURRENT_TIMESTAMP'
+    if connection.dialect.name == 'postgresql':
+        now = "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+    for table in ('follows', 'likes'):
+        add_column(connection, table, 'created_at',
+                   f"TIMESTAMP NOT NULL DEFAULT {now}")
+    for name, table, columns in INDEXES:
+        create_index(connection, name, table, columns)
+    drop_index(connection, 'ix_follows_user_following_id')
+
+
+def downgrade(connection):
+    create_index(connection, 'ix_follows_user_following_id', 'follows',
+                 'user_following_id')
+    for name, table, columns in INDEXES:
+        drop_index(connection, name)
+    drop_column(connection, 'likes', 'created_at')
+    drop_column(connection, 'follows', 'created_at')
@@ -1,12 +1,36 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query, object_session
+from sqlalchemy.sql.expression import FunctionElement
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from pagination import older_than
+from passwords import hasher
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+
+class utcnow(FunctionElement):
+    """The current UTC time, as a column default for rows inserted other
+    than through the ORM (raw SQL, COPY)."""
+
+    type = db.DateTime()
+
+
+@compiles(utcnow, 'postgresql')
+def _pg_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # SQLite's is UTC already
+    return "CURRENT_TIMESTAMP"
 
 
 class Follows(db.Model):
@@ -26,12 +50,25 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # When the follow began; follower lists are ordered by it
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
 
 class Like(db.Model):
     """User who've liked messages relationship."""
 
     __tablename__ = 'likes'
 
+    # A user's likes (the primary key leads with the message)
+    __table_args__ = (
+        db.Index('ix_likes_user_message', 'user_id', 'message_id'),
+    )
+
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete="cascade"),
@@ -44,6 +81,49 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    # When the message was liked; liked-messages lists are ordered by it
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a follower's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -90,6 +170,52 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized relationship sizes, kept in step by the routes that
+    # change them (see `increment_counters`) and by `repair_counters`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by every change to the row, so pages showing it can be
+    # revalidated cheaply (see httpcache.py)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # When the account was deleted. From then on it's hidden from queries
+    # (see `hide_tombstoned`) until it's purged (see deletions.py).
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -118,14 +244,12 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return follow_states(other_user.id, [self.id])[self.id]
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return follow_states(self.id, [other_user.id])[other_user.id]
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -134,13 +258,17 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
             email=email,
             password=hashed_pwd,
             image_url=image_url,
+            messages_count=0,
+            following_count=0,
+            followers_count=0,
+            likes_count=0,
         )
 
         db.session.add(user)
@@ -155,13 +283,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made at a different work factor than the
+        configured one it's replaced; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -169,7 +302,7 @@ class User(db.Model):
     @classmethod
     def new_pwd(cls, password):
         """ """
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
         return hashed_pwd
 
 
@@ -191,7 +324,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -200,9 +333,338 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by every change to the row (see User.version)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # When the message was deleted (see User.deleted_at)
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Full-text search document, filled in on PostgreSQL (see search.py)
+    search_vector = db.deferred(db.Column(
+        TSVECTOR().with_variant(db.Text, 'sqlite'),
+    ))
+
     user = db.relationship('User')
 
-    likes = db.relationship('Like')
+    likes = db.relationship(
+        'Like',
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+
+# A user's messages, newest first
+db.Index('ix_messages_user_timestamp',
+         Message.user_id, Message.timestamp.desc(), Message.id)
+
+# A user's followees, followers and likes, most recent first
+db.Index('ix_follows_user_being_followed_created',
+         Follows.user_being_followed_id, Follows.created_at.desc(),
+         Follows.user_following_id)
+db.Index('ix_follows_user_following_created',
+         Follows.user_following_id, Follows.created_at.desc(),
+         Follows.user_being_followed_id)
+db.Index('ix_likes_user_created',
+         Like.user_id, Like.created_at.desc(), Like.message_id)
+
+# Tombstoned rows, which every message query and purge batch looks up
+db.Index('ix_users_tombstoned', User.id,
+         postgresql_where=User.deleted_at.isnot(None),
+         sqlite_where=User.deleted_at.isnot(None))
+db.Index('ix_messages_tombstoned', Message.user_id,
+         postgresql_where=Message.deleted_at.isnot(None),
+         sqlite_where=Message.deleted_at.isnot(None))
+
+
+class DeletionJob(db.Model):
+    """The purge of a tombstoned account, or of some of a user's
+    tombstoned messages (see deletions.py)."""
+
+    __tablename__ = 'deletion_jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # 'user' or 'messages'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Whose account or messages; not a foreign key, as the job outlives
+    # the account
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # 'queued', 'running', 'done' or 'failed'
+    state = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+        server_default='queued',
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+def increment_counters(model, id, **deltas):
+    """Add `deltas` to counter columns of `model` row `id`, e.g.
+    increment_counters(User, 1, followers_count=1).
+
+    `id` may also be a query or list of ids, to adjust many rows at once.
+
+    Done as a single `col = col + n` UPDATE in the current transaction, so
+    concurrent requests can't lose each other's changes. The rows' version
+    stamps are bumped too.
+    """
+
+    if isinstance(id, int):
+        rows = model.query.filter(model.id == id)
+    elif isinstance(id, list):
+        rows = model.query.filter(model.id.in_(id))
+    else:
+        rows = model.query.filter(model.id.in_(id.subquery()))
+
+    values = {getattr(model, column): getattr(model, column) + delta
+              for column, delta in deltas.items()}
+    values[model.version] = model.version + 1
+    rows.update(values, synchronize_session=False)
+
+
+# On Postgres a like or unlike is one statement: the likes row is
+# inserted/deleted, and the liker's and message's counters move only if it
+# was, returning the message's new like count and its author (no row: no
+# such message, or it's been deleted).
+LIKE_SQL = db.text("""
+    WITH changed AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id FROM messages
+        WHERE id = :message_id AND deleted_at IS NULL
+          AND user_id NOT IN (SELECT id FROM users WHERE deleted_at IS NOT NULL)
+        ON CONFLICT DO NOTHING
+        RETURNING message_id
+    ), liker AS (
+        UPDATE users SET likes_count = likes_count + 1, version = version + 1
+        WHERE id = :user_id AND EXISTS (SELECT 1 FROM changed)
+    )
+    UPDATE messages SET like_count = like_count + (SELECT count(*) FROM changed),
+                        version = version + (SELECT count(*) FROM changed)
+    WHERE id = :message_id AND deleted_at IS NULL
+      AND user_id NOT IN (SELECT id FROM users WHERE deleted_at IS NOT NULL)
+    RETURNING like_count, user_id
+""")
+
+UNLIKE_SQL = db.text("""
+    WITH changed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING message_id
+    ), liker AS (
+        UPDATE users SET likes_count = likes_count - 1, version = version + 1
+        WHERE id = :user_id AND EXISTS (SELECT 1 FROM changed)
+    )
+    UPDATE messages SET like_count = like_count - (SELECT count(*) FROM changed),
+                        version = version + (SELECT count(*) FROM changed)
+    WHERE id = :message_id AND deleted_at IS NULL
+      AND user_id NOT IN (SELECT id FROM users WHERE deleted_at IS NOT NULL)
+    RETURNING like_count, user_id
+""")
+
+
+LikeChange = namedtuple('LikeChange', ['like_count', 'author_id'])
+
+
+def like_message(user_id, message_id):
+    """Have `user_id` like `message_id`, if they don't already.
+
+    Returns the message's (like_count, author_id), or None if there's no
+    such message. Liking twice is harmless.
+    """
+
+    return _change_like(LIKE_SQL, user_id, message_id, 1)
+
+
+def unlike_message(user_id, message_id):
+    """Have `user_id` stop liking `message_id`, if they do.
+
+    Returns the message's (like_count, author_id), or None if there's no
+    such message.
+    """
+
+    return _change_like(UNLIKE_SQL, user_id, message_id, -1)
+
+
+def _change_like(sql, user_id, message_id, delta):
+    params = dict(user_id=user_id, message_id=message_id)
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(sql, params).first()
+        return row and LikeChange(*row)
+
+    # Elsewhere (e.g. SQLite in development) take the long way round
+    if delta > 0:
+        changed = db.session.execute(
+            Like.__table__.insert().prefix_with('OR IGNORE')
+            .from_select(['user_id', 'message_id'],
+                         db.select([db.literal(user_id), Message.id])
+                         .where(Message.id == message_id)
+                         .where(Message.deleted_at.is_(None))
+                         .where(Message.user_id.notin_(tombstoned_users))))
+    else:
+        changed = db.session.execute(
+            Like.__table__.delete()
+            .where(Like.user_id == user_id)
+            .where(Like.message_id == message_id))
+    if changed.rowcount:
+        increment_counters(Message, message_id, like_count=delta)
+        increment_counters(User, user_id, likes_count=delta)
+    row = (db.session
+           .query(Message.like_count, Message.user_id)
+           .filter(Message.id == message_id)
+           .first())
+    return row and LikeChange(*row)
+
+
+def follow_states(viewer_id, user_ids):
+    """Map each of `user_ids` to whether `viewer_id` follows them.
+
+    One query on the follows primary key, however many users there are,
+    so a page of Follow/Unfollow buttons costs the same as one button.
+    A `viewer_id` of None (logged out) follows nobody.
+    """
+
+    user_ids = set(user_ids)
+    followed = set()
+    if viewer_id is not None and user_ids:
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == viewer_id,
+                        Follows.user_following_id.in_(user_ids)))
+        followed = {id for id, in rows}
+    return {id: id in followed for id in user_ids}
+
+
+def follow_list(user_id, columns, followers=False, limit=30, before=None):
+    """Up to `limit` of the users `user_id` follows (or, with `followers`,
+    who follow them), most recently followed first, starting below the
+    (followed_at, id) cursor `before` if given.
+
+    Rows of `columns` (of users, including User.id as 'id') and
+    `followed_at`, read off the follows index without loading the whole
+    relationship.
+    """
+
+    if followers:
+        user_column = Follows.user_following_id
+        other_column = Follows.user_being_followed_id
+    else:
+        user_column = Follows.user_being_followed_id
+        other_column = Follows.user_following_id
+
+    query = (db.session
+             .query(*columns, Follows.created_at.label('followed_at'))
+             .select_from(Follows)
+             .join(User, User.id == other_column)
+             .filter(user_column == user_id))
+    if before:
+        query = query.filter(older_than(Follows.created_at, other_column,
+                                        before))
+    return (query
+            .order_by(Follows.created_at.desc(), other_column.desc())
+            .limit(limit)
+            .all())
+
+
+def repair_counters():
+    """Recompute every denormalized counter from the underlying rows."""
+
+    def count(column, key, *criteria):
+        return (db.session
+                .query(db.func.count())
+                .filter(column == key, *criteria)
+                .correlate(key.class_)
+                .as_scalar())
+
+    User.query.update({
+        User.messages_count: count(Message.user_id, User.id,
+                                   Message.deleted_at.is_(None)),
+        User.following_count: count(Follows.user_being_followed_id, User.id),
+        User.followers_count: count(Follows.user_following_id, User.id),
+        User.likes_count: count(Like.user_id, User.id),
+        User.version: User.version + 1,
+    }, synchronize_session=False)
+
+    Message.query.update({
+        Message.like_count: count(Like.message_id, Message.id),
+        Message.version: Message.version + 1,
+    }, synchronize_session=False)
+
+
+# Ids of tombstoned users (Core, so hide_tombstoned leaves it alone)
+tombstoned_users = (db.select([User.__table__.c.id])
+                    .where(User.__table__.c.deleted_at.isnot(None)))
+
+
+@db.event.listens_for(Query, 'before_compile', retval=True)
+def hide_tombstoned(query):
+    """Leave tombstoned users and messages, and tombstoned users' messages,
+    out of ORM queries for them (or their columns).
+
+    Core statements and bulk updates and deletes still see them.
+    """
+
+    entities = {desc['entity'] for desc in query.column_descriptions}
+    if User in entities:
+        query = (query
+                 .enable_assertions(False)
+                 .filter(User.deleted_at.is_(None)))
+    if Message in entities:
+        query = (query
+                 .enable_assertions(False)
+                 .filter(Message.deleted_at.is_(None),
+                         Message.user_id.notin_(tombstoned_users)))
+    return query
+
+
+@db.event.listens_for(User, 'before_update')
+@db.event.listens_for(Message, 'before_update')
+def bump_version(mapper, connection, target):
+    """Bump the version stamp of rows edited through the ORM."""
+
+    if object_session(target).is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
 
 
 def connect_db(app):
@@ -0,0 +1,68 @@
+"""Keyset (cursor) pagination for Warbler timelines.
+
+A page is addressed by the (timestamp, id) of the last row already shown,
+packed into an opaque url-safe token. The next page is then an index range
+read starting just below that key, so page 1000 costs the same as page 1,
+unlike an OFFSET scan. Ranked results use a (score, id) key instead, and
+lists ordered by id alone an (id, id) key.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(key, id):
+    """Pack a (timestamp, id), (score, id) or (id, id) sort key into an
+    opaque token."""
+
+    if isinstance(key, datetime):
+        raw = f"t{key.isoformat()}|{id}"
+    elif isinstance(key, int):
+        raw = f"i{key}|{id}"
+    else:
+        raw = f"f{float(key)!r}|{id}"
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Unpack a token from `encode_cursor` into its (key, id).
+
+    Raises ValueError if the token is malformed.
+    """
+
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        key, id = urlsafe_b64decode(padded).decode('UTF-8').split('|')
+        if key.startswith('t'):
+            return datetime.fromisoformat(key[1:]), int(id)
+        if key.startswith('f'):
+            return float(key[1:]), int(id)
+        if key.startswith('i'):
+            return int(key[1:]), int(id)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        pass
+    raise ValueError(f"Invalid cursor: {token!r}")
+
+
+def older_than(key_col, id_col, cursor):
+    """Filter clause for rows that sort strictly after `cursor` in
+    (key DESC, id DESC) order."""
+
+    return tuple_(key_col, id_col) < tuple_(*cursor)
+
+
+def split_page(rows, limit, sort_key):
+    """Split a `limit + 1` row fetch into (page rows, next cursor).
+
+    The extra row only signals that another page exists; the cursor is
+    None on the last page.
+    """
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(*sort_key(rows[-1]))
@@ -0,0 +1,147 @@
+"""Password hashing for Warbler, off the request threads.
+
+bcrypt is deliberately slow (~250ms at the default cost), so hashing and
+checking run in a small process pool. A bounded number of jobs may be
+in flight at once; past that, callers get HasherBusy straight away
+instead of queueing behind a login burst and stalling every worker.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made at a different
+cost are upgraded the next time their owner logs in.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from multiprocessing import get_context
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already in progress."""
+
+
+def hash_password(password, rounds):
+    """bcrypt hash of `password` at cost `rounds`, as text."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('UTF-8'), salt).decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+def hash_cost(hashed):
+    """Work factor a bcrypt hash was made with ($2b$<cost>$...)."""
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool with a cap on pending jobs.
+
+    With `workers` set to 0 hashing runs inline on the calling thread,
+    which is handy for tests and one-off scripts.
+    """
+
+    def __init__(self, rounds=12, workers=None, max_pending=None,
+                 timeout=10):
+        self._pool = None
+        self._pool_lock = Lock()
+        self._pending = 0
+        self.configure(rounds, workers, max_pending, timeout)
+
+    def init_app(self, app):
+        """Configure from BCRYPT_LOG_ROUNDS, PASSWORD_HASH_WORKERS,
+        PASSWORD_HASH_MAX_PENDING and PASSWORD_HASH_TIMEOUT."""
+
+        self.configure(
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            workers=app.config.get('PASSWORD_HASH_WORKERS'),
+            max_pending=app.config.get('PASSWORD_HASH_MAX_PENDING'),
+            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 10),
+        )
+
+    def configure(self, rounds=12, workers=None, max_pending=None,
+                  timeout=10):
+        """Set the work factor, pool size (None for one per CPU), cap on
+        pending jobs (default four per worker) and seconds to wait for a
+        result.
+
+        A pool already started at another size is shut down, to be started
+        afresh at this one. Raises RuntimeError if jobs are still pending,
+        as they hold slots under the old cap.
+        """
+
+        workers = os.cpu_count() if workers is None else workers
+        with self._pool_lock:
+            if self._pending:
+                raise RuntimeError(f"can't reconfigure the password hasher "
+                                   f"with {self._pending} jobs pending")
+            if self._pool is not None and workers != self.workers:
+                self._pool.shutdown()
+                self._pool = None
+            self.rounds = rounds
+            self.workers = workers
+            self.max_pending = max_pending or 4 * max(self.workers, 1)
+            self.timeout = timeout
+            self._slots = BoundedSemaphore(self.max_pending)
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a cost other than the configured one?"""
+
+        return hash_cost(hashed) != self.rounds
+
+    def _run(self, fn, *args):
+        with self._pool_lock:
+            slots = self._slots
+            if not slots.acquire(blocking=False):
+                raise HasherBusy()
+            self._pending += 1
+
+        def release(_=None):
+            with self._pool_lock:
+                self._pending -= 1
+            slots.release()
+
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                release()
+        try:
+            future = self._executor().submit(fn, *args)
+        except BaseException:
+            release()
+            raise
+        # The slot is held until the job is done, not just until we stop
+        # waiting for it, so timed-out jobs still count against the cap
+        future.add_done_callback(release)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+
+    def _executor(self):
+        # Started on first use so each forked gunicorn worker gets its own
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=get_context('spawn'))
+        return self._pool
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,84 @@
+"""The logged-in user, without a full User query on every request.
+
+Each request only needs a handful of the current user's columns (for the
+navbar, the home page card and ownership checks), so those are kept as a
+Principal in a per-process TTL/LRU cache keyed by user id. The full User
+row is loaded only when a route or template asks for something else.
+
+Cached principals are dropped when their user changes their profile or
+password, deletes their account, or makes any other change through the
+app; other processes pick up changes once the entry's TTL runs out.
+"""
+
+from collections import namedtuple
+
+from cache import TTLCache
+from models import db, User, follow_states
+
+Principal = namedtuple('Principal', [
+    'id', 'username', 'image_url', 'header_image_url', 'messages_count',
+    'following_count', 'followers_count', 'likes_count', 'version',
+])
+
+principal_cache = TTLCache(maxsize=10000, ttl=30)
+
+
+def init_app(app):
+    """Size the cache from PRINCIPAL_CACHE_SIZE and PRINCIPAL_CACHE_TTL."""
+
+    principal_cache.maxsize = app.config.get('PRINCIPAL_CACHE_SIZE', 10000)
+    principal_cache.ttl = app.config.get('PRINCIPAL_CACHE_TTL', 30)
+
+
+class CurrentUser:
+    """The logged-in user.
+
+    Principal fields are answered from the cache. Anything else (email,
+    relationships, methods) loads the User row on first use and is
+    delegated to it; `instance` is that row, for passing to the ORM.
+    """
+
+    def __init__(self, principal):
+        self._principal = principal
+        self._instance = None
+
+    @property
+    def instance(self):
+        if self._instance is None:
+            self._instance = User.query.get(self._principal.id)
+        return self._instance
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`? (No need to load the row.)"""
+
+        return follow_states(self.id, [other_user.id])[other_user.id]
+
+    def __getattr__(self, name):
+        if name in Principal._fields:
+            return getattr(self._principal, name)
+        return getattr(self.instance, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def load_current_user(user_id):
+    """CurrentUser for `user_id`, or None if there's no such user."""
+
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        row = (db.session
+               .query(*(getattr(User, field) for field in Principal._fields))
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+        principal = Principal(*row)
+        principal_cache.set(user_id, principal)
+    return CurrentUser(principal)
+
+
+def forget_principal(user_id):
+    """Drop `user_id`'s cached principal after they've changed."""
+
+    principal_cache.delete(user_id)
@@ -0,0 +1,172 @@
+"""Streamed and compressed responses for Warbler.
+
+`stream_template` renders a template as it's sent: the page head goes
+out as soon as it's rendered, so the browser can start on the
+stylesheets and scripts while the rest of the page is produced, and the
+full page is never held in memory.
+
+`compress` gzips or brotli-compresses text responses for clients that
+accept it, streamed ones included: each chunk is flushed through the
+compressor as it comes, so streaming still gets the page out early.
+Responses smaller than COMPRESS_MIN_SIZE are sent as they are, and so
+are event streams, whose events mustn't wait for a buffer to fill.
+"""
+
+import zlib
+
+from flask import (Response, before_render_template, current_app,
+                   get_flashed_messages, request, stream_with_context,
+                   template_rendered)
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only without it
+    brotli = None
+
+# Send the first chunk once the head is out, then in pieces about this big
+STREAM_CHUNK_SIZE = 8192
+
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript',
+                      'application/xml', 'image/svg+xml'}
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but a streamed Response.
+
+    Flashed messages are taken from the session up front: by the time the
+    template gets to them the session cookie has already been sent.
+    """
+
+    app = current_app._get_current_object()
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        buffered, size, head_sent = [], 0, False
+        for piece in template.generate(context):
+            buffered.append(piece)
+            size += len(piece)
+            if (size >= STREAM_CHUNK_SIZE
+                    or (not head_sent and '</head>' in piece)):
+                yield ''.join(buffered)
+                buffered, size, head_sent = [], 0, True
+        if buffered:
+            yield ''.join(buffered)
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()))
+
+
+class Compress:
+    """Compresses responses according to the request's Accept-Encoding."""
+
+    def init_app(self, app):
+        """Compress responses from `app` of at least COMPRESS_MIN_SIZE
+        bytes, at COMPRESS_LEVEL (gzip) or COMPRESS_BROTLI_QUALITY."""
+
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_BROTLI_QUALITY', 4)
+        app.after_request(self.after_request)
+
+    def after_request(self, resp):
+        if not self._compressible(resp):
+            return resp
+        encoding = self._encoding()
+        if encoding is None:
+            return resp
+        resp.vary.add('Accept-Encoding')
+        config = current_app.config
+        min_size = config['COMPRESS_MIN_SIZE']
+
+        if not resp.is_streamed:
+            data = resp.get_data()
+            if len(data) < min_size:
+                return resp
+            compressor = self._compressor(encoding, config)
+            resp.set_data(compressor.compress(data) + compressor.finish())
+        else:
+            # Read ahead to the threshold to see if it's worth it
+            chunks = iter(resp.response)
+            head, size = [], 0
+            for chunk in chunks:
+                chunk = _to_bytes(chunk, resp.charset)
+                head.append(chunk)
+                size += len(chunk)
+                if size >= min_size:
+                    break
+            else:
+                resp.set_data(b''.join(head))
+                return resp
+            resp.response = self._stream(
+                self._compressor(encoding, config), head, chunks,
+                resp.charset, getattr(resp.response, 'close', None))
+            resp.headers.pop('Content-Length', None)
+
+        resp.headers['Content-Encoding'] = encoding
+        return resp
+
+    def _compressible(self, resp):
+        return (resp.status_code == 200
+                and not resp.direct_passthrough
+                and 'Content-Encoding' not in resp.headers
+                and resp.mimetype != 'text/event-stream'
+                and (resp.mimetype.startswith('text/')
+                     or resp.mimetype in COMPRESSIBLE_TYPES))
+
+    def _encoding(self):
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def _compressor(self, encoding, config):
+        if encoding == 'br':
+            return _BrotliCompressor(config['COMPRESS_BROTLI_QUALITY'])
+        return _GzipCompressor(config['COMPRESS_LEVEL'])
+
+    def _stream(self, compressor, head, chunks, charset, close):
+        try:
+            yield compressor.compress(b''.join(head))
+            for chunk in chunks:
+                yield compressor.compress(_to_bytes(chunk, charset))
+            yield compressor.finish()
+        finally:
+            if close is not None:
+                close()
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """Compressed `data`, flushed so the client can decode it now."""
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._zlib.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._brotli = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        """Compressed `data`, flushed so the client can decode it now."""
+        return self._brotli.process(data) + self._brotli.flush()
+
+    def finish(self):
+        return self._brotli.finish()
+
+
+def _to_bytes(chunk, charset):
+    return chunk.encode(charset) if isinstance(chunk, str) else chunk
+
+
+compress = Compress()
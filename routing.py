@@ -0,0 +1,153 @@
+"""Database engines for Warbler: read replicas and connection pools.
+
+`RoutingSQLAlchemy` is Flask-SQLAlchemy with:
+
+- Read replicas. Views wrapped in `db.reads_from_replica` send their
+  SELECTs to one of SQLALCHEMY_REPLICA_URIS, picked at random per request;
+  flushes and other statements still go to the primary. Once a visitor has
+  committed a write, their reads stay on the primary for
+  REPLICA_STICKY_SECONDS (longer than replication lag), so they always see
+  their own writes. The deadline is kept in their session cookie, so it
+  holds whichever worker serves them next.
+
+- Explicit pools. SQLALCHEMY_POOL_SIZE, SQLALCHEMY_MAX_OVERFLOW,
+  SQLALCHEMY_POOL_RECYCLE, SQLALCHEMY_POOL_TIMEOUT and
+  SQLALCHEMY_POOL_PRE_PING apply to every engine, and
+  SQLALCHEMY_REPLICA_POOL_OPTIONS overrides them for replicas. Pools
+  report how long checkouts wait, and how many connections are out, to
+  /metrics (see metrics.py).
+"""
+
+import random
+import time
+from functools import wraps
+
+import sqlalchemy
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+from metrics import metrics
+
+# Session key holding the time until which reads stay on the primary
+STICKY_KEY = '_primary_until'
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool reporting its checkout waits to metrics under `label`."""
+
+    label = 'primary'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        metrics.track_pool(self.label, self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe_pool_wait(self.label,
+                                      time.perf_counter() - start)
+
+
+def timed_pool(label):
+    """A TimedQueuePool class for the engine called `label`."""
+
+    return type(f'TimedQueuePool_{label}', (TimedQueuePool,),
+                {'label': label})
+
+
+class RoutingSession(SignallingSession):
+    """Sends reads to this request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('_replica') if has_request_context() else None
+        if (replica is not None
+                and not self._flushing
+                and isinstance(clause, Select)):
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with read replicas and tuned, measured pools."""
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_POOL_OPTIONS', {})
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', True)
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        super().init_app(app)
+        app.after_request(self._stick_to_primary)
+
+    def create_session(self, options):
+        session_factory = orm.sessionmaker(class_=RoutingSession, db=self,
+                                           **options)
+
+        @sqlalchemy.event.listens_for(session_factory, 'after_commit')
+        def wrote(session):
+            if has_request_context():
+                g._wrote = True
+
+        return session_factory
+
+    def apply_pool_defaults(self, app, options):
+        super().apply_pool_defaults(app, options)
+        options['pool_pre_ping'] = app.config['SQLALCHEMY_POOL_PRE_PING']
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # SQLite gets no queue pool (see the superclass); nothing to size
+            for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(option, None)
+        else:
+            options.setdefault('poolclass', timed_pool('primary'))
+        super().apply_driver_hacks(app, info, options)
+
+    def get_replicas(self, app=None):
+        """Engines for the app's SQLALCHEMY_REPLICA_URIS, made on first use
+        (and again if the setting changes)."""
+
+        app = self.get_app(app)
+        state = get_state(app)
+        uris = tuple(app.config['SQLALCHEMY_REPLICA_URIS'])
+        if getattr(state, 'replica_uris', None) != uris:
+            for engine in getattr(state, 'replicas', []):
+                engine.dispose()
+            state.replicas = [self._create_replica(app, uri, f'replica{i}')
+                              for i, uri in enumerate(uris)]
+            state.replica_uris = uris
+        return state.replicas
+
+    def _create_replica(self, app, uri, label):
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        options.update(app.config['SQLALCHEMY_REPLICA_POOL_OPTIONS'])
+        options['poolclass'] = timed_pool(label)
+        self.apply_driver_hacks(app, info, options)
+        if app.config['SQLALCHEMY_ECHO']:
+            options['echo'] = True
+        return sqlalchemy.create_engine(info, **options)
+
+    def reads_from_replica(self, view):
+        """Decorate a read-only view to have its SELECTs go to a replica,
+        unless the visitor has written something recently."""
+
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            replicas = self.get_replicas()
+            if replicas and session.get(STICKY_KEY, 0) <= time.time():
+                g._replica = random.choice(replicas)
+            return view(*args, **kwargs)
+        return decorated_function
+
+    def _stick_to_primary(self, resp):
+        if g.pop('_wrote', False) and self.get_replicas():
+            session[STICKY_KEY] = (
+                time.time() + current_app.config['REPLICA_STICKY_SECONDS'])
+        return resp
@@ -0,0 +1,246 @@
+"""Schema migrations for Warbler.
+
+Run from the repo root:
+
+    python schema.py status             # applied and pending migrations
+    python schema.py upgrade            # apply everything pending
+    python schema.py upgrade 3          # ... up to and including 0003
+    python schema.py downgrade 2        # undo those after 0002 (0 for all)
+
+Migrations are the scripts in migrations/, named NNNN_description.py and
+applied in order. Each has `upgrade(connection)` and
+`downgrade(connection)`; the applied ones are listed in the
+schema_migrations table. A migration runs in a transaction of its own,
+unless it sets `transactional = False` (e.g. to build indexes
+CONCURRENTLY, which PostgreSQL won't do in one); it's then recorded only
+once it's done, and should be safe to run again after a failure.
+
+An empty database is created straight from the models, which are always
+the latest schema, and every migration is recorded as applied. Databases
+from before migrations (made by `db.create_all()`) have every migration
+applied to them, starting with 0001, which brings that original schema up
+to the models of the time.
+"""
+
+import argparse
+import importlib.util
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import inspect
+
+from models import db
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'migrations')
+
+Migration = namedtuple('Migration', ['version', 'name', 'module'])
+
+_FILENAME = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+
+def migrations(directory=MIGRATIONS):
+    """Every Migration in `directory`, in order."""
+
+    found = []
+    for filename in sorted(os.listdir(directory)):
+        match = _FILENAME.match(filename)
+        if not match:
+            continue
+        spec = importlib.util.spec_from_file_location(
+            f'migrations.{filename[:-3]}', os.path.join(directory, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        found.append(Migration(int(match.group(1)), match.group(2), module))
+    return found
+
+
+class Migrator:
+    """Applies and undoes migrations over `connection`."""
+
+    def __init__(self, connection, directory=MIGRATIONS):
+        self.connection = connection
+        self.migrations = migrations(directory)
+
+    def applied(self):
+        """Versions recorded as applied."""
+
+        with self.connection.begin():
+            self._create_table()
+            return {version for (version,) in self.connection.execute(
+                "SELECT version FROM schema_migrations")}
+
+    def upgrade(self, target=None):
+        """Apply pending migrations up to `target` (default: all),
+        returning those applied."""
+
+        if self._is_empty():
+            with self.connection.begin():
+                db.metadata.create_all(self.connection)
+                self._create_table()
+                for migration in self.migrations:
+                    self._record(migration)
+            return self.migrations
+
+        applied = self.applied()
+        done = []
+        for migration in self.migrations:
+            if migration.version in applied:
+                continue
+            if target is not None and migration.version > target:
+                break
+            self._run(migration, migration.module.upgrade,
+                      lambda: self._record(migration))
+            done.append(migration)
+        return done
+
+    def downgrade(self, target):
+        """Undo applied migrations after `target`, newest first, returning
+        those undone."""
+
+        applied = self.applied()
+        done = []
+        for migration in reversed(self.migrations):
+            if migration.version <= target:
+                break
+            if migration.version not in applied:
+                continue
+            self._run(migration, migration.module.downgrade,
+                      lambda: self._forget(migration))
+            done.append(migration)
+        return done
+
+    def _run(self, migration, step, record):
+        if getattr(migration.module, 'transactional', True):
+            with self.connection.begin():
+                step(self.connection)
+                record()
+        else:
+            # On a connection of its own, as the pool resets its isolation
+            # level when it's returned
+            with self.connection.engine.connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    connection = connection.execution_options(
+                        isolation_level='AUTOCOMMIT')
+                step(connection)
+            with self.connection.begin():
+                record()
+
+    def _is_empty(self):
+        # In a transaction, so it's over before any CONCURRENTLY index
+        # build, which would otherwise wait for it
+        with self.connection.begin():
+            return not inspect(self.connection).get_table_names()
+
+    def _create_table(self):
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL)")
+
+    def _record(self, migration):
+        self.connection.execute(
+            db.text("INSERT INTO schema_migrations "
+                    "(version, name, applied_at) "
+                    "VALUES (:version, :name, :applied_at)"),
+            version=migration.version, name=migration.name,
+            applied_at=datetime.utcnow())
+
+    def _forget(self, migration):
+        self.connection.execute(
+            db.text("DELETE FROM schema_migrations WHERE version = :version"),
+            version=migration.version)
+
+
+##############################################################################
+# Helpers for migrations
+
+
+def add_column(connection, table, column, definition):
+    """ALTER TABLE `table` ADD `column` `definition`, unless it's there."""
+
+    columns = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column not in columns:
+        connection.execute(
+            f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def drop_column(connection, table, column):
+    """ALTER TABLE `table` DROP `column`, if it's there."""
+
+    columns = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column in columns:
+        connection.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+
+
+def create_index(connection, name, table, columns, where=None, using=None):
+    """CREATE INDEX `name` ON `table` (`columns`), unless it's there; with
+    `where`, a partial index of the rows matching it, and with `using`, of
+    that kind (e.g. 'gin').
+
+    On PostgreSQL it's built CONCURRENTLY, so writes carry on meanwhile (the
+    migration must set `transactional = False`); an invalid index left by
+    an earlier failed attempt is dropped and rebuilt.
+    """
+
+    predicate = f" WHERE {where}" if where else ''
+    method = f" USING {using}" if using else ''
+    if connection.dialect.name != 'postgresql':
+        connection.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table}{method} "
+            f"({columns}){predicate}")
+        return
+
+    valid = connection.execute(db.text(
+        "SELECT indisvalid FROM pg_index "
+        "WHERE indexrelid = to_regclass(:name)"), name=name).scalar()
+    if valid is False:
+        connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    connection.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+        f"ON {table}{method} ({columns}){predicate}")
+
+
+def drop_index(connection, name):
+    """DROP INDEX `name` if it's there (CONCURRENTLY on PostgreSQL)."""
+
+    concurrently = (' CONCURRENTLY'
+                    if connection.dialect.name == 'postgresql' else '')
+    connection.execute(f"DROP INDEX{concurrently} IF EXISTS {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['status', 'upgrade', 'downgrade'])
+    parser.add_argument('version', nargs='?', type=int,
+                        help="last migration to leave applied "
+                             "(required for downgrade)")
+    args = parser.parse_args()
+    if args.command == 'downgrade' and args.version is None:
+        parser.error("downgrade needs the version to go back to")
+
+    from app import app
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            migrator = Migrator(connection)
+            if args.command == 'status':
+                applied = migrator.applied()
+                for migration in migrator.migrations:
+                    state = ('applied' if migration.version in applied
+                             else 'pending')
+                    print(f"{migration.version:04d} {migration.name}: "
+                          f"{state}")
+            elif args.command == 'upgrade':
+                for migration in migrator.upgrade(args.version):
+                    print(f"applied {migration.version:04d} "
+                          f"{migration.name}")
+            else:
+                for migration in migrator.downgrade(args.version):
+                    print(f"undid {migration.version:04d} {migration.name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""Search for Warbler.
+
+User search uses PostgreSQL's pg_trgm extension when it's installed: a GIN
+trigram index serves ranked fuzzy and substring matches, and a
+text_pattern_ops btree serves prefix lookups for autocomplete. Elsewhere
+(SQLite, or PostgreSQL without the extension) an in-memory trigram index
+gives the same answers, kept current by mapper events on User.
+
+Message search uses a tsvector column with a GIN index on PostgreSQL, and
+an in-memory inverted index elsewhere. Both rank matches and page through
+them by (score, id).
+"""
+
+import re
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from threading import Lock
+
+from sqlalchemy import cast, event, func
+from sqlalchemy.orm import Session, joinedload
+
+from models import db, Message, User
+from pagination import older_than
+
+# Matches below this similarity only count if the query is a substring;
+# the same default pg_trgm uses for its `%` operator.
+SIMILARITY_THRESHOLD = 0.3
+
+# Text search configuration used to build and query message documents.
+MESSAGE_SEARCH_CONFIG = 'english'
+
+
+##############################################################################
+# Index DDL
+
+
+@event.listens_for(User.__table__, 'after_create')
+def create_user_search_indexes(target, connection, **kw):
+    """Add the username search indexes when the users table is created."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+        "ON users (lower(username) text_pattern_ops)")
+
+    available = connection.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    ).scalar()
+    if available:
+        connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+            "ON users USING gin (username gin_trgm_ops)")
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def create_message_search_index(target, connection, **kw):
+    """Add the full-text index when the messages table is created."""
+
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_messages_search_vector "
+            "ON messages USING gin (search_vector)")
+
+
+##############################################################################
+# Trigram helpers
+
+
+def trigrams(text):
+    """Set of trigrams in `text`, extracted the way pg_trgm does it:
+    lower-cased, per word, with each word padded by two leading spaces and
+    one trailing space."""
+
+    grams = set()
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(a, b):
+    """pg_trgm-style similarity of two trigram sets, from 0 to 1."""
+
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input (with backslash as escape)."""
+
+    return re.sub(r'([\\%_])', r'\\\1', text)
+
+
+class TrigramIndex:
+    """In-memory trigram and prefix index over (id, text) pairs."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._texts = {}
+        self._grams = {}
+        self._postings = defaultdict(set)
+        self._sorted = []
+
+    def add(self, id, text):
+        with self._lock:
+            self._remove(id)
+            grams = trigrams(text)
+            self._texts[id] = text
+            self._grams[id] = grams
+            for gram in grams:
+                self._postings[gram].add(id)
+            insort(self._sorted, (text.lower(), id))
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        text = self._texts.pop(id, None)
+        if text is None:
+            return
+        for gram in self._grams.pop(id):
+            self._postings[gram].discard(id)
+        del self._sorted[bisect_left(self._sorted, (text.lower(), id))]
+
+    def search(self, query):
+        """Ids matching `query` by substring or trigram similarity, best
+        match first."""
+
+        needle = query.lower()
+        query_grams = trigrams(query)
+        with self._lock:
+            if len(needle) < 3:
+                candidates = set(self._texts)
+            else:
+                candidates = set()
+                for gram in query_grams:
+                    candidates |= self._postings.get(gram, set())
+
+            scored = []
+            for id in candidates:
+                text = self._texts[id]
+                score = similarity(query_grams, self._grams[id])
+                if score >= SIMILARITY_THRESHOLD or needle in text.lower():
+                    scored.append((-score, text, id))
+
+        return [id for _, _, id in sorted(scored)]
+
+    def prefix(self, query, limit=None):
+        """Up to `limit` (default: all) ids whose text starts with `query`,
+        in order."""
+
+        needle = query.lower()
+        with self._lock:
+            start = bisect_left(self._sorted, (needle,))
+            end = None if limit is None else start + limit
+            ids = []
+            for text, id in self._sorted[start:end]:
+                if not text.startswith(needle):
+                    break
+                ids.append(id)
+        return ids
+
+
+def words(text):
+    """Lower-cased words of `text`, in order."""
+
+    return re.findall(r'\w+', text.lower())
+
+
+class InvertedIndex:
+    """In-memory inverted index from words to the ids of texts using them.
+
+    Texts match a query if they contain every word in it, and score by how
+    much of the text those words make up.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._postings = defaultdict(dict)
+        self._counts = {}
+        self._lengths = {}
+
+    def add(self, id, text):
+        counts = Counter(words(text))
+        with self._lock:
+            self._remove(id)
+            self._counts[id] = counts
+            self._lengths[id] = sum(counts.values()) or 1
+            for word, count in counts.items():
+                self._postings[word][id] = count
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        for word in self._counts.pop(id, ()):
+            del self._postings[word][id]
+        self._lengths.pop(id, None)
+
+    def search(self, query):
+        """(score, id) of every text matching `query`, best first."""
+
+        terms = set(words(query))
+        if not terms:
+            return []
+
+        with self._lock:
+            postings = sorted((self._postings.get(term, {}) for term in terms),
+                              key=len)
+            ids = set(postings[0])
+            for posting in postings[1:]:
+                ids &= posting.keys()
+            scored = [(sum(posting[id] for posting in postings)
+                       / self._lengths[id], id)
+                      for id in ids]
+
+        return sorted(scored, reverse=True)
+
+
+##############################################################################
+# User search backends
+
+
+class PostgresUserSearch:
+    """User search answered by pg_trgm and prefix indexes."""
+
+    def search(self, query, limit, offset=0):
+        """Users matching `query`, most similar first."""
+
+        pattern = f"%{escape_like(query)}%"
+        return (User
+                .query
+                # `%%` reaches PostgreSQL as pg_trgm's `%` similarity operator
+                .filter(User.username.op('%%')(query)
+                        | User.username.ilike(pattern, escape='\\'))
+                .order_by(func.similarity(User.username, query).desc(),
+                          User.username)
+                .offset(offset)
+                .limit(limit)
+                .all())
+
+    def autocomplete(self, query, limit):
+        """(id, username, image_url) of up to `limit` users whose username
+        starts with `query`."""
+
+        pattern = f"{escape_like(query.lower())}%"
+        return (db.session
+                .query(User.id, User.username, User.image_url)
+                .filter(func.lower(User.username).like(pattern, escape='\\'))
+                .order_by(func.lower(User.username))
+                .limit(limit)
+                .all())
+
+
+class MemoryUserSearch:
+    """User search answered by an in-process TrigramIndex.
+
+    The index is built from the users table on first use.
+    """
+
+    def __init__(self):
+        self.index = None
+        self._lock = Lock()
+
+    def search(self, query, limit, offset=0):
+        """Users matching `query`, most similar first."""
+
+        ids = self._index().search(query)
+        return _visible_page(User.query, User.id, ids, limit, offset)
+
+    def autocomplete(self, query, limit):
+        """(id, username, image_url) of up to `limit` users whose username
+        starts with `query`."""
+
+        ids = self._index().prefix(query)
+        rows = db.session.query(User.id, User.username, User.image_url)
+        return _visible_page(rows, User.id, ids, limit)
+
+    def _index(self):
+        with self._lock:
+            if self.index is None:
+                index = TrigramIndex()
+                for id, username in db.session.query(User.id, User.username):
+                    index.add(id, username)
+                self.index = index
+        return self.index
+
+
+##############################################################################
+# Message search backends
+
+
+class PostgresMessageSearch:
+    """Message search answered by the tsvector GIN index."""
+
+    def search(self, query, limit, before=None):
+        """(message, score) of up to `limit` messages matching `query`, best
+        first, starting below the (score, id) cursor `before` if given."""
+
+        tsquery = func.plainto_tsquery(MESSAGE_SEARCH_CONFIG, query)
+        # Ranks are float4; widen them so cursors round-trip exactly
+        rank = cast(func.ts_rank_cd(Message.search_vector, tsquery),
+                    db.Float)
+        rows = (db.session
+                .query(Message, rank)
+                .options(joinedload(Message.user))
+                .filter(Message.search_vector.op('@@')(tsquery)))
+        if before:
+            rows = rows.filter(older_than(rank, Message.id, before))
+        return (rows
+                .order_by(rank.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+
+    def reindex(self):
+        """Build documents for messages inserted without one, e.g. by
+        bulk loads."""
+
+        (Message
+         .query
+         .filter(Message.search_vector.is_(None))
+         .update({Message.search_vector:
+                  func.to_tsvector(MESSAGE_SEARCH_CONFIG, Message.text)},
+                 synchronize_session=False))
+
+
+class MemoryMessageSearch:
+    """Message search answered by an in-process InvertedIndex.
+
+    The index is built from the messages table on first use.
+    """
+
+    def __init__(self):
+        self.index = None
+        self._lock = Lock()
+
+    def search(self, query, limit, before=None):
+        """(message, score) of up to `limit` messages matching `query`, best
+        first, starting below the (score, id) cursor `before` if given."""
+
+        scored = self._index().search(query)
+        if before:
+            scored = [hit for hit in scored if hit < before]
+
+        messages = (Message
+                    .query
+                    .options(joinedload(Message.user)))
+        found = _visible_page(messages, Message.id,
+                              [id for _, id in scored], limit)
+        scores = {id: score for score, id in scored}
+        return [(msg, scores[msg.id]) for msg in found]
+
+    def reindex(self):
+        """Rebuild the index from the database on next use."""
+
+        self.index = None
+
+    def _index(self):
+        with self._lock:
+            if self.index is None:
+                index = InvertedIndex()
+                for id, text in db.session.query(Message.id, Message.text):
+                    index.add(id, text)
+                self.index = index
+        return self.index
+
+
+_memory_user_search = MemoryUserSearch()
+_memory_message_search = MemoryMessageSearch()
+_has_pg_trgm = None
+
+
+def user_search():
+    """The user search backend for the current database."""
+
+    global _has_pg_trgm
+    if db.engine.dialect.name != 'postgresql':
+        return _memory_user_search
+
+    if _has_pg_trgm is None:
+        _has_pg_trgm = db.session.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        ).scalar() is not None
+    return PostgresUserSearch() if _has_pg_trgm else _memory_user_search
+
+
+def message_search():
+    """The message search backend for the current database."""
+
+    if db.engine.dialect.name == 'postgresql':
+        return PostgresMessageSearch()
+    return _memory_message_search
+
+
+def _visible_page(query, id_column, ids, limit, offset=0):
+    """Rows `offset` to `offset + limit` of `_in_order(query, id_column,
+    ids)`.
+
+    The index doesn't know which rows are hidden (e.g. tombstoned), but
+    `query` leaves them out, so `ids` are looked up a page's worth at a
+    time until the page is full: hidden rows are skipped before paging,
+    as the Postgres backends do in SQL, rather than leaving pages short.
+    """
+
+    wanted = offset + limit
+    if wanted <= 0:
+        return []
+    found = []
+    for start in range(0, len(ids), wanted):
+        found += _in_order(query, id_column, ids[start:start + wanted])
+        if len(found) >= wanted:
+            break
+    return found[offset:wanted]
+
+
+def _in_order(query, id_column, ids):
+    """Rows of `query` with `id_column` in `ids`, in the order of `ids`."""
+
+    if not ids:
+        return []
+    by_id = {row.id: row for row in query.filter(id_column.in_(ids))}
+    return [by_id[id] for id in ids if id in by_id]
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _index_user(mapper, connection, user):
+    if _memory_user_search.index is not None:
+        _memory_user_search.index.add(user.id, user.username)
+
+
+@event.listens_for(User, 'after_delete')
+def _unindex_user(mapper, connection, user):
+    if _memory_user_search.index is not None:
+        _memory_user_search.index.remove(user.id)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def _reset_indexes(delete_context):
+    """Query.delete() skips mapper events, so rebuild from scratch."""
+    if delete_context.primary_table is User.__table__:
+        # Deleting users cascades to their messages
+        _memory_user_search.index = None
+        _memory_message_search.index = None
+    elif delete_context.primary_table is Message.__table__:
+        _memory_message_search.index = None
+
+
+@event.listens_for(Message, 'before_insert')
+def _set_search_vector(mapper, connection, msg):
+    if connection.dialect.name == 'postgresql':
+        msg.search_vector = func.to_tsvector(MESSAGE_SEARCH_CONFIG, msg.text)
+
+
+@event.listens_for(Message, 'after_insert')
+def _index_message(mapper, connection, msg):
+    if _memory_message_search.index is not None:
+        _memory_message_search.index.add(msg.id, msg.text)
+
+
+@event.listens_for(Message, 'after_delete')
+def _unindex_message(mapper, connection, msg):
+    if _memory_message_search.index is not None:
+        _memory_message_search.index.remove(msg.id)
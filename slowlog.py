@@ -0,0 +1,231 @@
+"""Slow-query log for Warbler.
+
+SQL statements taking at least SLOW_QUERY_MS are logged to the
+"warbler.slow_queries" logger, with the route and the line of our own
+code that ran them. Statements are grouped by fingerprint (the statement
+with literals and parameters blanked out), and each log line carries the
+running count and total time for its fingerprint. `slow_queries.top()`
+returns the worst offenders.
+
+If SLOW_QUERY_EXPLAIN_FILE is set, a sample of slow SELECTs
+(SLOW_QUERY_EXPLAIN_SAMPLE of them, and at most one per fingerprint every
+SLOW_QUERY_EXPLAIN_INTERVAL seconds) is re-run under Postgres's
+EXPLAIN (ANALYZE, BUFFERS). SELECTs that ANALYZE running again would do
+something twice (lock rows FOR UPDATE/SHARE, call pg_notify and the like,
+or call functions without reading a table) get a plain EXPLAIN instead.
+The plans go to that file, which is rotated as it grows.
+"""
+
+import hashlib
+import logging
+import os
+import random
+import re
+import time
+import traceback
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.slow_queries')
+plan_logger = logging.getLogger('warbler.slow_queries.plans')
+plan_logger.propagate = False
+
+_NORMALIZERS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+# What makes a SELECT more than a read: row locks, and functions with side
+# effects
+_NOT_READ_ONLY = re.compile(
+    r"\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b"
+    r"|\b(?:pg_notify|nextval|setval|pg_advisory_\w+|pg_try_advisory_\w+"
+    r"|pg_terminate_backend|pg_cancel_backend|dblink\w*)\s*\(",
+    re.IGNORECASE)
+
+
+def normalize(statement):
+    """`statement` with literals, parameters and IN lists blanked out."""
+
+    for pattern, replacement in _NORMALIZERS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+def fingerprint(statement):
+    """Short id for statements that differ only in their values."""
+
+    return hashlib.sha1(normalize(statement).encode()).hexdigest()[:12]
+
+
+def read_only(normalized):
+    """Is the normalized SELECT `normalized` safe to run again under
+    EXPLAIN ANALYZE, reading tables without locking or changing
+    anything?"""
+
+    return (re.search(r"\bFROM\b", normalized, re.IGNORECASE) is not None
+            and _NOT_READ_ONLY.search(normalized) is None)
+
+
+class QueryStats:
+    """Running totals for one fingerprint."""
+
+    def __init__(self, fingerprint, statement):
+        self.fingerprint = fingerprint
+        self.statement = statement
+        self.count = 0
+        self.total_seconds = 0
+        self.max_seconds = 0
+        self.route = None
+        self.call_site = None
+        self.explained_at = None
+
+
+class SlowQueryLog:
+    """Watches every engine's statements and logs the slow ones."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._engine_hooked = False
+        self.threshold = None
+        self.root = None
+        self.explain_sample = 0
+        self.explain_interval = 300
+        self.stats = {}
+
+    def init_app(self, app):
+        """Configure from SLOW_QUERY_MS (unset or 0: off),
+        SLOW_QUERY_EXPLAIN_FILE, SLOW_QUERY_EXPLAIN_SAMPLE,
+        SLOW_QUERY_EXPLAIN_INTERVAL, SLOW_QUERY_EXPLAIN_MAX_BYTES and
+        SLOW_QUERY_EXPLAIN_BACKUPS."""
+
+        ms = app.config.get('SLOW_QUERY_MS')
+        self.threshold = ms / 1000 if ms else None
+        self.root = app.root_path
+        self.explain_sample = app.config.get('SLOW_QUERY_EXPLAIN_SAMPLE', 0.1)
+        self.explain_interval = app.config.get(
+            'SLOW_QUERY_EXPLAIN_INTERVAL', 300)
+
+        for handler in list(plan_logger.handlers):
+            plan_logger.removeHandler(handler)
+            handler.close()
+        plan_file = app.config.get('SLOW_QUERY_EXPLAIN_FILE')
+        if plan_file:
+            handler = RotatingFileHandler(
+                plan_file,
+                maxBytes=app.config.get('SLOW_QUERY_EXPLAIN_MAX_BYTES',
+                                        10 * 1024 * 1024),
+                backupCount=app.config.get('SLOW_QUERY_EXPLAIN_BACKUPS', 5))
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            plan_logger.addHandler(handler)
+            plan_logger.setLevel(logging.INFO)
+
+        if not self._engine_hooked:
+            event.listen(Engine, 'before_cursor_execute', self._started)
+            event.listen(Engine, 'after_cursor_execute', self._finished)
+            self._engine_hooked = True
+
+    def top(self, n=20):
+        """The `n` fingerprints with the most total time."""
+
+        with self._lock:
+            return sorted(self.stats.values(),
+                          key=lambda stats: stats.total_seconds,
+                          reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def _started(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if self.threshold is not None:
+            context._slowlog_start = time.perf_counter()
+
+    def _finished(self, conn, cursor, statement, parameters, context,
+                  executemany):
+        start = getattr(context, '_slowlog_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed < self.threshold:
+            return
+
+        normalized = normalize(statement)
+        key = hashlib.sha1(normalized.encode()).hexdigest()[:12]
+        route = (f"{request.method} {request.endpoint}"
+                 if has_request_context() else None)
+        call_site = self._call_site()
+
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = QueryStats(key, normalized)
+            stats.count += 1
+            stats.total_seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            stats.route, stats.call_site = route, call_site
+            explain = (plan_logger.handlers
+                       and not executemany
+                       and conn.dialect.name == 'postgresql'
+                       and normalized[:6].upper() == 'SELECT'
+                       and random.random() < self.explain_sample
+                       and (stats.explained_at is None
+                            or time.monotonic() - stats.explained_at
+                            >= self.explain_interval))
+            if explain:
+                stats.explained_at = time.monotonic()
+
+        logger.warning("slow query %s: %.1f ms (%d so far, %.3f s total) "
+                       "in %s at %s: %s", key, elapsed * 1000, stats.count,
+                       stats.total_seconds, route, call_site,
+                       normalized[:500])
+        if explain:
+            self._explain(cursor, key, statement, parameters, call_site,
+                          analyze=read_only(normalized))
+
+    def _call_site(self):
+        """file:line of the innermost frame in our own code."""
+
+        for frame in reversed(traceback.extract_stack()[:-2]):
+            path = frame.filename
+            if (path.startswith(self.root)
+                    and 'site-packages' not in path
+                    and path != __file__):
+                return f"{os.path.relpath(path, self.root)}:{frame.lineno}"
+        return None
+
+    def _explain(self, cursor, key, statement, parameters, call_site,
+                 analyze=True):
+        # Straight through the DBAPI connection, inside a savepoint so a
+        # failure can't abort the request's transaction. The savepoint
+        # doesn't undo what ANALYZE can't take back (notifications, row
+        # locks), so it's only for read-only statements.
+        options = "(ANALYZE, BUFFERS) " if analyze else ""
+        explain_cursor = cursor.connection.cursor()
+        try:
+            explain_cursor.execute("SAVEPOINT slowlog_explain")
+            try:
+                explain_cursor.execute(
+                    "EXPLAIN " + options + statement, parameters)
+                plan = "\n".join(row[0] for row in explain_cursor.fetchall())
+            except Exception:
+                explain_cursor.execute(
+                    "ROLLBACK TO SAVEPOINT slowlog_explain")
+                logger.exception("couldn't EXPLAIN slow query %s", key)
+                return
+            explain_cursor.execute("RELEASE SAVEPOINT slowlog_explain")
+        finally:
+            explain_cursor.close()
+        plan_logger.info("%s at %s\n%s\n%s\n", key, call_site, statement,
+                         plan)
+
+
+slow_queries = SlowQueryLog()
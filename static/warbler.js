@@ -41,4 +41,85 @@ $("ul").on("click", ".fa-heart", async function(e) {
         likeCount.text(res);
     }
     heart.toggleClass("fas far")
-});
\ No newline at end of file
+});
+
+// Infinite scroll: when the "Older warbles" link comes near the bottom of
+// the viewport, fetch the next page of messages and append it in place.
+// If a fetch fails, the link stays as it was (it still works when clicked)
+// and scrolling tries again after a pause.
+const PAGE_RETRY_MS = 5000;
+let loadingPage = false;
+let retryPageAt = 0;
+
+$(window).on("scroll", async function() {
+    let nextPage = $("#next-page");
+    if (loadingPage || !nextPage.length || Date.now() < retryPageAt) {
+        return;
+    }
+    if (nextPage.offset().top > $(window).scrollTop() + $(window).height() + 300) {
+        return;
+    }
+    loadingPage = true;
+    try {
+        let xhr = $.get(nextPage.attr("href"));
+        let items = await xhr;
+        $("#messages").append(items);
+        let next = xhr.getResponseHeader("X-Next-Page");
+        if (next) {
+            nextPage.attr("href", next);
+        } else {
+            nextPage.remove();
+        }
+    } catch (err) {
+        retryPageAt = Date.now() + PAGE_RETRY_MS;
+    } finally {
+        loadingPage = false;
+    }
+});
+
+
+// Live updates: the server pushes new warbles from the authors on this page
+// and changed like counts. New warbles aren't inserted under the reader's
+// nose; a link at the top of the list offers them.
+let liveList = $("#messages[data-events]");
+
+if (liveList.length && window.EventSource) {
+    let source = new EventSource(liveList.data("events"));
+    let unseen = 0;
+
+    source.addEventListener("warble", function() {
+        unseen += 1;
+        let notice = $("#new-warbles");
+        if (!notice.length) {
+            notice = $("<a>").attr({id: "new-warbles", href: window.location.pathname})
+                .addClass("list-group-item list-group-item-action text-center text-primary");
+            liveList.prepend(notice);
+        }
+        notice.text(`Show ${unseen} new warble${unseen === 1 ? "" : "s"}`);
+    });
+
+    source.addEventListener("likes", function(e) {
+        let change = JSON.parse(e.data);
+        $(`#count-${change.id}`).text(change.like_count);
+    });
+}
+
+
+// Navbar search suggestions: ask the server for usernames starting with
+// what's been typed so far, once typing pauses.
+let searchTimer = null;
+
+$("#search").on("input", function(e) {
+    clearTimeout(searchTimer);
+    let q = $(e.target).val().trim();
+    searchTimer = setTimeout(async function() {
+        let suggestions = $("#search-suggestions").empty();
+        if (!q) {
+            return;
+        }
+        let users = await $.getJSON("/users/autocomplete", {q: q});
+        for (let user of users) {
+            suggestions.append($("<option>").attr("value", user.username));
+        }
+    }, 150);
+});
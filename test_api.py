@@ -0,0 +1,169 @@
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message, Follows, Like
+from test_timeline import count_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from principal import principal_cache
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Test the /api/v1 JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        principal_cache.clear()
+        self.client = app.test_client()
+
+        reader = User(email="reader@test.com", username="reader",
+                      password="HASHED_PASSWORD")
+        writer = User(email="writer@test.com", username="writer",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([reader, writer])
+        db.session.commit()
+        start = datetime(2019, 1, 1)
+        db.session.add_all([Message(text=f"API warble {i}", user_id=writer.id,
+                                    timestamp=start + timedelta(minutes=i))
+                            for i in range(5)])
+        # reader follows writer
+        db.session.add(Follows(user_being_followed_id=reader.id,
+                               user_following_id=writer.id))
+        db.session.commit()
+        timeline.rebuild_timelines(app.config['TIMELINE_FANOUT_LIMIT'])
+        self.newest = Message.query.filter_by(text="API warble 4").one().id
+        db.session.add(Like(user_id=reader.id, message_id=self.newest))
+        db.session.commit()
+        self.reader_id, self.writer_id = reader.id, writer.id
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def test_timeline_pages(self):
+        """Do cursors walk the home timeline, newest first?"""
+        with self.client as c:
+            self.login(c)
+            first = c.get("/api/v1/timeline?limit=3").get_json()
+            self.assertEqual([m['text'] for m in first['data']],
+                             ["API warble 4", "API warble 3", "API warble 2"])
+            self.assertEqual(first['data'][0]['username'], "writer")
+            self.assertEqual(first['data'][0]['timestamp'],
+                             "2019-01-01T00:04:00Z")
+            self.assertTrue(first['data'][0]['liked'])
+            self.assertFalse(first['data'][1]['liked'])
+
+            rest = c.get(f"/api/v1/timeline?limit=3&before={first['next']}")
+            rest = rest.get_json()
+            self.assertEqual([m['text'] for m in rest['data']],
+                             ["API warble 1", "API warble 0"])
+            self.assertIsNone(rest['next'])
+
+    def test_timeline_needs_login(self):
+        """Is the home timeline a JSON 401 when logged out?"""
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+
+    def test_sparse_fields(self):
+        """Does ?fields= limit both the payload and the columns read?"""
+        with count_queries() as counter:
+            resp = self.client.get(
+                f"/api/v1/users/{self.writer_id}/messages?fields=text")
+        self.assertEqual(resp.get_json()['data'][0], {'text': "API warble 4"})
+        self.assertNotIn("like_count", counter.statements[-1])
+
+        resp = self.client.get(f"/api/v1/messages/{self.newest}?fields=nope")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_message_and_user(self):
+        """Are single messages and profiles served, and 404s JSON?"""
+        msg = self.client.get(f"/api/v1/messages/{self.newest}").get_json()
+        self.assertEqual(msg['data']['like_count'], 0)
+        self.assertEqual(msg['data']['user_id'], self.writer_id)
+
+        user = self.client.get(f"/api/v1/users/{self.writer_id}").get_json()
+        self.assertEqual(user['data']['username'], "writer")
+        self.assertNotIn('email', user['data'])
+        self.assertFalse(user['data']['followed'])
+
+        resp = self.client.get("/api/v1/messages/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.get_json()['error'], "No such message")
+
+    def test_social_graph(self):
+        """Are followers, following and likes listed?"""
+        with self.client as c:
+            self.login(c)
+        followers = self.client.get(
+            f"/api/v1/users/{self.writer_id}/followers").get_json()
+        self.assertEqual([u['username'] for u in followers['data']],
+                         ["reader"])
+        following = self.client.get(
+            f"/api/v1/users/{self.reader_id}/following?fields=id").get_json()
+        self.assertEqual(following['data'], [{'id': self.writer_id}])
+        likes = self.client.get(
+            f"/api/v1/users/{self.reader_id}/likes?fields=id").get_json()
+        self.assertEqual(likes['data'], [{'id': self.newest}])
+        resp = self.client.get("/api/v1/users/0/followers")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_social_graph_by_recency(self):
+        """Are followers and likes listed most recent first, a page at a
+        time?"""
+        start = datetime(2020, 1, 1)
+        fans = [User(email=f"fan{i}@test.com", username=f"fan{i}",
+                     password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(fans)
+        db.session.flush()
+        # The first to sign up followed last (reader followed in setUp, so
+        # after all of them)
+        db.session.add_all(Follows(user_being_followed_id=fan.id,
+                                   user_following_id=self.writer_id,
+                                   created_at=start - timedelta(days=i))
+                           for i, fan in enumerate(fans))
+        older = Message.query.filter_by(text="API warble 0").one().id
+        db.session.add(Like(user_id=self.reader_id, message_id=older,
+                            created_at=datetime.utcnow() + timedelta(days=1)))
+        db.session.commit()
+        with self.client as c:
+            self.login(c)
+
+        url = f"/api/v1/users/{self.writer_id}/followers?fields=username"
+        first = self.client.get(f"{url}&limit=2").get_json()
+        rest = self.client.get(
+            f"{url}&limit=2&before={first['next']}").get_json()
+        self.assertEqual([u['username'] for u in first['data']],
+                         ["reader", "fan0"])
+        self.assertEqual([u['username'] for u in rest['data']],
+                         ["fan1", "fan2"])
+        self.assertIsNone(rest['next'])
+
+        likes = self.client.get(
+            f"/api/v1/users/{self.reader_id}/likes?fields=id").get_json()
+        self.assertEqual(likes['data'], [{'id': older}, {'id': self.newest}])
+
+    def test_social_graph_needs_login(self):
+        """Are followers, following and likes hidden when logged out, as
+        their pages are?"""
+        for path in ("followers", "following", "likes"):
+            resp = self.client.get(f"/api/v1/users/{self.reader_id}/{path}")
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn('error', resp.get_json())
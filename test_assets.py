@@ -0,0 +1,91 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app
+from assets import assets, build, brotli
+
+
+class AssetsTestCase(TestCase):
+    """Test the static asset build and /assets/."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.static = os.path.join(self.dir, 'static')
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+        self.write('images/bg.png', b'\x89PNG fake')
+        self.write('app.js', b'console.log("warble");\n' * 50)
+        self.write('stylesheets/site.css',
+                   b'body { background: url("/static/images/bg.png"); }\n')
+        self.manifest = build(self.static)
+        self.old_dist = assets.dist
+        assets.dist = os.path.join(self.static, 'dist')
+        assets.load()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        assets.dist = self.old_dist
+        assets.load()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.static, name), 'wb') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.static, 'dist', name), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """Are files fingerprinted, precompressed and linked up?"""
+        js = self.manifest['app.js']
+        self.assertRegex(js, r'^app\.[0-9a-f]{10}\.js$')
+        self.assertEqual(gzip.decompress(self.read(js + '.gz')),
+                         self.read(js))
+        if brotli:
+            self.assertEqual(brotli.decompress(self.read(js + '.br')),
+                             self.read(js))
+        # Too small to bother compressing
+        css = self.manifest['stylesheets/site.css']
+        self.assertFalse(os.path.exists(
+            os.path.join(self.static, 'dist', css + '.gz')))
+        self.assertIn(f'url("/assets/{self.manifest["images/bg.png"]}")'
+                      .encode(), self.read(css))
+
+    def test_serve_precompressed(self):
+        """Is the best accepted encoding served, cached for a year?"""
+        url = "/assets/" + self.manifest['app.js']
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', resp.mimetype)
+        self.assertEqual(gzip.decompress(resp.data),
+                         self.read(self.manifest['app.js']))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.data, self.read(self.manifest['app.js']))
+        resp.close()
+
+        self.assertEqual(self.client.get("/assets/../app.js").status_code,
+                         404)
+
+    def test_static_url(self):
+        """Does static_url() prefer the fingerprinted file?"""
+        with app.test_request_context():
+            self.assertEqual(assets.url('app.js'),
+                             "/assets/" + self.manifest['app.js'])
+            self.assertEqual(assets.url('unbuilt.js'), "/static/unbuilt.js")
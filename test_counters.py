@@ -0,0 +1,109 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, Like, repair_counters
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from deletions import deletions
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class CounterTestCase(TestCase):
+    """Test denormalized user and message counters."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        u1 = User.signup("counter1", "counter1@test.com", "PASSWORD", None)
+        u2 = User.signup("counter2", "counter2@test.com", "PASSWORD", None)
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_follow_counters(self):
+        """Do follows and unfollows adjust both users' counters?"""
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_repeated_unfollow(self):
+        """Does unfollowing again leave the counters alone?"""
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/users/follow/{self.u2_id}")
+            for _ in range(3):
+                resp = c.post(f"/users/stop-following/{self.u2_id}")
+                self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+            resp = c.post("/users/stop-following/0")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_message_and_like_counters(self):
+        """Do posting, liking, unliking and deleting keep counts right?"""
+        with self.client as c:
+            self.login(c, self.u2_id)
+            c.post("/messages/new", data={"text": "count me"})
+            msg_id = Message.query.one().id
+            self.assertEqual(User.query.get(self.u2_id).messages_count, 1)
+
+            self.login(c, self.u1_id)
+            resp = c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(resp.json, 1)
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            resp = c.post(f"/messages/{msg_id}/unlike")
+            self.assertEqual(resp.json, 0)
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+            c.post(f"/messages/{msg_id}/like")
+            self.login(c, self.u2_id)
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(User.query.get(self.u2_id).messages_count, 0)
+            # Likes go when the message is purged, in the background
+            deletions.join()
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_repair_counters(self):
+        """Does repair_counters fix counters that have drifted?"""
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        msg = Message(text="drift")
+        u2.messages.append(msg)
+        u1.following.append(u2)
+        db.session.flush()
+        db.session.add(Like(message_id=msg.id, user_id=u1.id))
+        db.session.commit()
+
+        repair_counters()
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual((u1.following_count, u1.likes_count), (1, 1))
+        self.assertEqual((u2.followers_count, u2.messages_count), (1, 1))
+        self.assertEqual(Message.query.one().like_count, 1)
@@ -0,0 +1,264 @@
+"""Background deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletions.py
+
+
+import os
+from unittest import TestCase
+from models import (db, User, Message, Follows, Like, TimelineEntry,
+                    DeletionJob, repair_counters)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from deletions import deletions, purge, purge_likes, LocalQueue
+from principal import principal_cache
+from timeline import rebuild_timelines
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class HeldQueue:
+    """Keeps jobs instead of running them, to look at tombstones."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, job_id):
+        self.jobs.append(job_id)
+
+
+class DeletionTestCase(TestCase):
+    """Test tombstoning, and purging in batches."""
+
+    def setUp(self):
+        """Create a user with messages, likes and follows both ways."""
+        deletions.join()
+        DeletionJob.query.delete()
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        principal_cache.clear()
+        self.client = app.test_client()
+        self.config = dict(app.config)
+        app.config.update(DELETION_BATCH_SIZE=2, DELETION_PAUSE=0)
+        self.queue = deletions.queue
+
+        users = [User(email=f"{name}@test.com", username=name,
+                      password="HASHED_PASSWORD")
+                 for name in ("leaving", "fan", "friend")]
+        db.session.add_all(users)
+        db.session.flush()
+        leaving, fan, friend = users
+        messages = [Message(text=f"Bye {n}", user_id=leaving.id)
+                    for n in range(5)]
+        kept = Message(text="Still here", user_id=friend.id)
+        db.session.add_all(messages + [kept])
+        db.session.flush()
+        db.session.add_all(
+            [Like(user_id=fan.id, message_id=msg.id) for msg in messages]
+            + [Like(user_id=leaving.id, message_id=kept.id),
+               Follows(user_being_followed_id=fan.id,
+                       user_following_id=leaving.id),
+               Follows(user_being_followed_id=friend.id,
+                       user_following_id=leaving.id),
+               Follows(user_being_followed_id=leaving.id,
+                       user_following_id=friend.id)])
+        db.session.commit()
+        repair_counters()
+        rebuild_timelines(app.config['TIMELINE_FANOUT_LIMIT'])
+        db.session.commit()
+
+        self.leaving_id, self.fan_id, self.friend_id = (
+            leaving.id, fan.id, friend.id)
+        self.message_ids = [msg.id for msg in messages]
+        self.kept_id = kept.id
+
+    def tearDown(self):
+        deletions.queue = self.queue
+        deletions.join()
+        app.config.clear()
+        app.config.update(self.config)
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def rows(self, model, **filters):
+        """Rows in `model`'s table, tombstoned or not."""
+        table = model.__table__
+        query = db.select([db.func.count()]).select_from(table)
+        for column, value in filters.items():
+            query = query.where(table.c[column] == value)
+        return db.session.execute(query).scalar()
+
+    def counters(self):
+        return {user.id: (user.messages_count, user.following_count,
+                          user.followers_count, user.likes_count)
+                for user in User.query}
+
+    def assertCountersRepaired(self):
+        """Are the counters what recounting them would make them?"""
+        counters = self.counters()
+        like_counts = dict(db.session.query(Message.id, Message.like_count))
+        repair_counters()
+        self.assertEqual(self.counters(), counters)
+        self.assertEqual(
+            dict(db.session.query(Message.id, Message.like_count)),
+            like_counts)
+        db.session.rollback()
+
+    def test_account_hidden_at_once(self):
+        """Is a deleted account, and all it wrote, hidden before it's
+        purged?"""
+        deletions.queue = HeldQueue()
+        with self.client as c:
+            self.login(c, self.leaving_id)
+            resp = c.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+        (job_id,) = deletions.queue.jobs
+
+        self.assertIsNone(User.query.get(self.leaving_id))
+        self.assertEqual(Message.query.filter_by(
+            user_id=self.leaving_id).count(), 0)
+        self.assertEqual(self.rows(Message, user_id=self.leaving_id), 5)
+        with self.client as c:
+            self.login(c, self.fan_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertNotIn("Bye", html)
+            self.assertEqual(c.get(f"/users/{self.leaving_id}").status_code,
+                             404)
+            resp = c.post(f"/messages/{self.message_ids[0]}/like")
+            self.assertEqual(resp.status_code, 404)
+
+            status = c.get(f"/deletions/{job_id}").json
+        self.assertEqual((status['kind'], status['state']), ('user', 'queued'))
+
+    def test_account_purged(self):
+        """Does the purge delete everything of the account's, keeping
+        everyone else's counters right?"""
+        with self.client as c:
+            self.login(c, self.leaving_id)
+            c.post("/users/delete")
+        deletions.join()
+
+        self.assertEqual(self.rows(User, id=self.leaving_id), 0)
+        self.assertEqual(self.rows(Message, user_id=self.leaving_id), 0)
+        self.assertEqual(self.rows(Like, user_id=self.fan_id), 0)
+        self.assertEqual(self.rows(Follows), 0)
+        self.assertEqual(self.rows(TimelineEntry), 0)
+        self.assertEqual(self.rows(Message), 1)
+        self.assertCountersRepaired()
+        fan = User.query.get(self.fan_id)
+        self.assertEqual((fan.likes_count, fan.following_count), (0, 0))
+        self.assertEqual(Message.query.get(self.kept_id).like_count, 0)
+
+        job = DeletionJob.query.one()
+        # 5 messages, with 5 likes and 10 timeline entries; 1 like,
+        # 3 follows, and 1 timeline entry
+        self.assertEqual((job.state, job.rows_deleted), ('done', 25))
+        self.assertIsNotNone(job.finished_at)
+        with self.client as c:
+            self.assertEqual(c.get(f"/deletions/{job.id}").json['state'],
+                             'done')
+
+    def test_batches(self):
+        """Are rows purged at most DELETION_BATCH_SIZE at a time?"""
+        db.session.add_all([Like(user_id=self.leaving_id, message_id=id)
+                            for id in self.message_ids])
+        db.session.commit()
+        with app.app_context():
+            batches = list(purge_likes(self.leaving_id))
+        self.assertEqual(batches, [2, 2, 2])
+
+    def test_bulk_message_delete(self):
+        """Can a user delete several of their messages at once?"""
+        ids = self.message_ids[:3] + [self.kept_id]
+        with self.client as c:
+            self.login(c, self.leaving_id)
+            resp = c.post("/messages/delete", data={"message_id": ids})
+            self.assertEqual(resp.status_code, 202)
+            self.assertEqual(
+                Message.query.filter_by(user_id=self.leaving_id).count(), 2)
+            self.assertEqual(
+                User.query.get(self.leaving_id).messages_count, 2)
+
+            deletions.join()
+            status = c.get(resp.json['status']).json
+        self.assertEqual((status['kind'], status['state']),
+                         ('messages', 'done'))
+        # 3 messages, the fan's likes of them, and their followers'
+        # timeline entries for them
+        self.assertEqual(status['rows_deleted'], 12)
+        self.assertEqual(self.rows(Message), 3)
+        self.assertIsNotNone(Message.query.get(self.kept_id))
+        self.assertEqual(User.query.get(self.fan_id).likes_count, 2)
+        self.assertCountersRepaired()
+
+    def test_others_messages(self):
+        """Are other users' messages left alone, and their deletions'
+        status private?"""
+        with self.client as c:
+            self.login(c, self.friend_id)
+            resp = c.post("/messages/delete",
+                          data={"message_id": self.message_ids})
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post("/messages/delete",
+                          data={"message_id": [self.kept_id]})
+            self.assertEqual(resp.status_code, 202)
+            self.login(c, self.fan_id)
+            self.assertEqual(c.get(resp.json['status']).status_code, 404)
+        self.assertEqual(Message.query.count(), 5)
+
+    def test_unfinished_jobs_resumed(self):
+        """Does a new queue pick up jobs a restart left unfinished?"""
+        deletions.queue = HeldQueue()
+        with app.test_request_context():
+            job = deletions.delete_user(self.leaving_id)
+            job.state = 'running'
+            db.session.commit()
+            job_id = job.id
+
+        queue = LocalQueue(deletions._run, deletions._unfinished)
+        queue.put(0)
+        queue.join()
+        self.assertEqual(DeletionJob.query.get(job_id).state, 'done')
+        self.assertEqual(self.rows(User, id=self.leaving_id), 0)
+
+    def test_failed_job(self):
+        """Is a job that fails marked so, and can it be rerun?"""
+        app.config['DELETION_BATCH_SIZE'] = 'lots'
+        with self.client as c:
+            self.login(c, self.leaving_id)
+            c.post("/users/delete")
+        deletions.join()
+
+        job_id, state = db.session.query(DeletionJob.id,
+                                         DeletionJob.state).one()
+        self.assertEqual(state, 'failed')
+        self.assertEqual(self.rows(User, id=self.leaving_id), 1)
+
+        # Once fixed, it can be run again
+        app.config['DELETION_BATCH_SIZE'] = 2
+        with app.app_context():
+            purge(job_id)
+        self.assertEqual(DeletionJob.query.get(job_id).state, 'done')
+        self.assertEqual(self.rows(User, id=self.leaving_id), 0)
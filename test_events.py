@@ -0,0 +1,174 @@
+import json
+import os
+import runpy
+from unittest import TestCase, mock
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from events import events, LocalBroker, PostgresBroker
+from principal import principal_cache
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class BrokerTestCase(TestCase):
+    """Test publish/subscribe."""
+
+    def test_local_broker(self):
+        """Do subscribers get just their channels' events?"""
+        broker = LocalBroker(queue_size=2)
+        subscription = broker.subscribe(["a", "b"])
+        broker.publish("a", "ping", 1)
+        broker.publish("c", "ping", 2)
+        self.assertEqual(subscription.get(0), ("ping", 1))
+        self.assertIsNone(subscription.get(0))
+
+        subscription.close()
+        broker.publish("a", "ping", 3)
+        self.assertIsNone(subscription.get(0))
+
+    def test_slow_subscriber_is_dropped(self):
+        """Is a subscriber whose queue overflows closed?"""
+        broker = LocalBroker(queue_size=1)
+        subscription = broker.subscribe(["a"])
+        broker.publish("a", "ping", 1)
+        broker.publish("a", "ping", 2)
+        self.assertTrue(subscription.closed)
+
+    def test_postgres_broker(self):
+        """Do events go through LISTEN/NOTIFY?"""
+        broker = PostgresBroker(db.engine)
+        subscription = broker.subscribe(["author:1"])
+        # The listener may not be listening yet; keep publishing till it is
+        for attempt in range(50):
+            broker.publish("author:1", "ping", {"n": attempt})
+            event = subscription.get(0.1)
+            if event:
+                break
+        self.assertEqual(event[0], "ping")
+        subscription.close()
+
+
+class GunicornBrokerTestCase(TestCase):
+    """Test that several gunicorn workers share live updates."""
+
+    def load_config(self, **env):
+        """gunicorn.conf.py's settings, read with `env` set, and the
+        EVENTS_BROKER it leaves for the app."""
+        with mock.patch.dict(os.environ, env):
+            if 'EVENTS_BROKER' not in env:
+                os.environ.pop('EVENTS_BROKER', None)
+            config = runpy.run_path(os.path.join(app.root_path,
+                                                 'gunicorn.conf.py'))
+            return config, os.environ.get('EVENTS_BROKER')
+
+    def test_postgres_by_default_for_several_workers(self):
+        """Do several workers share events through Postgres by default?"""
+        config, broker = self.load_config(WEB_CONCURRENCY='2')
+        self.assertEqual(broker, 'postgres')
+        config, broker = self.load_config(WEB_CONCURRENCY='1')
+        self.assertIsNone(broker)
+
+    def test_local_refused_for_several_workers(self):
+        """Does gunicorn refuse to start several workers on 'local'?"""
+        config, broker = self.load_config(WEB_CONCURRENCY='2',
+                                          EVENTS_BROKER='local')
+        self.assertEqual(broker, 'local')
+        with self.assertRaises(RuntimeError):
+            config['check_events_broker'](2, broker)
+        config['check_events_broker'](1, broker)
+
+
+class LiveEventsViewTestCase(TestCase):
+    """Test the /events stream."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        principal_cache.clear()
+        events.heartbeat = 0.01
+
+        reader = User(email="live@test.com", username="live",
+                      password="HASHED_PASSWORD")
+        author = User(email="poster@test.com", username="poster",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([reader, author])
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=reader.id,
+                               user_following_id=author.id))
+        db.session.commit()
+        self.reader_id, self.author_id = reader.id, author.id
+
+    def tearDown(self):
+        events.heartbeat = app.config['EVENTS_HEARTBEAT']
+
+    def next_event(self, body):
+        """The next event in a stream, skipping keep-alives."""
+        for chunk in body:
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if chunk.startswith("event:"):
+                event, data = chunk.strip().split("\n")
+                return event[len("event: "):], json.loads(data[len("data: "):])
+        return None
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_followees_warbles_and_likes(self):
+        """Does the home stream get followees' new warbles and likes?"""
+        reader, author = app.test_client(), app.test_client()
+        self.login(reader, self.reader_id)
+        self.login(author, self.author_id)
+
+        resp = reader.get("/events", headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.mimetype, "text/event-stream")
+        self.assertNotIn('Content-Encoding', resp.headers)
+        body = iter(resp.response)
+        self.assertIn("retry:", next(body).decode())
+
+        author.post("/messages/new", data={"text": "Live warble"})
+        event, data = self.next_event(body)
+        self.assertEqual(event, "warble")
+        self.assertEqual(data['text'], "Live warble")
+
+        reader.post(f"/messages/{data['id']}/like")
+        self.assertEqual(self.next_event(body),
+                         ("likes", {"id": data['id'], "like_count": 1}))
+        resp.close()
+
+    def test_anonymous_needs_authors(self):
+        """Is the home stream for logged-in users only?"""
+        client = app.test_client()
+        self.assertEqual(client.get("/events").status_code, 401)
+        resp = client.get(f"/events?user={self.author_id}")
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
+
+    def test_authors_capped(self):
+        """Is a stream naming more than EVENTS_MAX_AUTHORS authors refused?"""
+        client = app.test_client()
+        limit = app.config['EVENTS_MAX_AUTHORS']
+        query = "&".join(f"user={n}" for n in range(1, limit + 2))
+        self.assertEqual(client.get(f"/events?{query}").status_code, 400)
+
+        # Repeats of the same author count once
+        resp = client.get("/events?" + f"user={self.author_id}&" * (limit + 1))
+        self.assertEqual(resp.status_code, 200)
+        resp.close()
@@ -0,0 +1,204 @@
+"""Message card cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from models import db, User, Message, Follows, Like, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from fragments import fragments, SLOT
+from principal import principal_cache
+from timeline import TimelineItem
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class DictBackend(dict):
+    """A shared cache, as memcached or Redis would be, storing bytes."""
+
+    def get(self, key):
+        return super().get(key)
+
+    def set(self, key, value):
+        self[key] = value.encode()
+
+
+class BrokenBackend:
+    def get(self, key):
+        raise ConnectionError("cache is down")
+
+    def set(self, key, value):
+        raise ConnectionError("cache is down")
+
+
+class FragmentTestCase(TestCase):
+    """Test the cached message cards."""
+
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        principal_cache.clear()
+        fragments.clear()
+        self.client = app.test_client()
+        self.renders = []
+        self.render = fragments.app.jinja_env.get_template
+
+        users = [User(email=f"{name}@test.com", username=name,
+                      password="HASHED_PASSWORD")
+                 for name in ("author", "fan", "other")]
+        db.session.add_all(users)
+        db.session.flush()
+        self.author, self.fan, self.other = users
+        self.msg = Message(text="Hello <b>world</b>", user_id=self.author.id)
+        db.session.add(self.msg)
+        db.session.commit()
+        self.author_id, self.fan_id, self.other_id = (
+            self.author.id, self.fan.id, self.other.id)
+        self.msg_id = self.msg.id
+        with self.client as c:
+            self.login(c, self.fan_id)
+            c.post(f"/messages/{self.msg_id}/like")
+
+    def tearDown(self):
+        fragments.backend = None
+        fragments.clear()
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def profile(self, user_id=None):
+        """The author's profile page, as `user_id` sees it."""
+        with self.client as c:
+            if user_id:
+                self.login(c, user_id)
+            return c.get(f"/users/{self.author_id}").get_data(as_text=True)
+
+    def count_renders(self):
+        """Count renders of the card template from here on."""
+        def get_template(name, *args, **kwargs):
+            self.renders.append(name)
+            return self.render(name, *args, **kwargs)
+        fragments.app.jinja_env.get_template = get_template
+        self.addCleanup(delattr, fragments.app.jinja_env, 'get_template')
+
+    def test_viewer_buttons(self):
+        """Does each viewer get their own like button on a shared card?"""
+        fan = self.profile(self.fan_id)
+        other = self.profile(self.other_id)
+        author = self.profile(self.author_id)
+        anonymous = self.profile()
+
+        self.assertIn(f'action="/messages/{self.msg_id}/unlike"', fan)
+        self.assertNotIn(f'action="/messages/{self.msg_id}/like"', fan)
+        self.assertIn(f'action="/messages/{self.msg_id}/like"', other)
+        self.assertNotIn(f'action="/messages/{self.msg_id}/unlike"', other)
+        for html in (author, anonymous):
+            self.assertNotIn(f'/messages/{self.msg_id}/like"', html)
+            self.assertNotIn(f'/messages/{self.msg_id}/unlike"', html)
+        for html in (fan, other, author, anonymous):
+            self.assertIn("Hello &lt;b&gt;world&lt;/b&gt;", html)
+            self.assertIn(f'<i id="count-{self.msg_id}">1</i>', html)
+            self.assertNotIn(SLOT, html)
+
+    def test_rendered_once(self):
+        """Is the card rendered once for all viewers?"""
+        self.count_renders()
+        self.profile(self.fan_id)
+        self.profile(self.other_id)
+        self.profile()
+        with self.client as c:
+            self.login(c, self.other_id)
+            c.get(f"/users/{self.fan_id}/likes")
+        self.assertEqual(self.renders.count('messages/_card.html'), 1)
+
+    def test_changes_rerender(self):
+        """Do likes and the author's profile changes show at once?"""
+        self.profile(self.other_id)
+        with self.client as c:
+            self.login(c, self.other_id)
+            c.post(f"/messages/{self.msg_id}/like")
+        self.assertIn(f'<i id="count-{self.msg_id}">2</i>',
+                      self.profile(self.fan_id))
+
+        User.query.get(self.author_id).username = "renamed"
+        db.session.commit()
+        self.assertIn("@renamed", self.profile(self.fan_id))
+
+    def test_author_activity_keeps_card(self):
+        """Is the card kept when only the author's counters change?"""
+        self.profile(self.other_id)
+        self.count_renders()
+        with self.client as c:
+            self.login(c, self.other_id)
+            c.post(f"/users/follow/{self.author_id}")
+            self.login(c, self.author_id)
+            c.post(f"/users/follow/{self.fan_id}")
+        self.profile(self.fan_id)
+        self.assertEqual(self.renders.count('messages/_card.html'), 0)
+
+    def test_slot_in_text(self):
+        """Can a message's text pass for a slot marker?"""
+        msg = Message.query.get(self.msg_id)
+        msg.text = f"sneaky {SLOT} text"
+        db.session.commit()
+        html = self.profile(self.other_id)
+        self.assertIn("sneaky &lt;!--like-button--&gt; text", html)
+        self.assertIn(f'action="/messages/{self.msg_id}/like"', html)
+
+    def test_bounded(self):
+        """Is the local cache kept to FRAGMENT_CACHE_SIZE cards?"""
+        maxsize = fragments.local.maxsize
+        fragments.local.maxsize = 2
+        self.addCleanup(setattr, fragments.local, 'maxsize', maxsize)
+        author = User.query.get(self.author_id)
+        with app.app_context():
+            for n in range(5):
+                msg = Message(id=1000 + n, text=f"Warble {n}",
+                              user_id=author.id, like_count=0, version=1,
+                              timestamp=datetime(2020, 1, 1))
+                fragments.message_card(TimelineItem(msg, author, False))
+        self.assertEqual(len(fragments.local), 2)
+
+    def test_shared_backend(self):
+        """Are cards shared through the backend, between processes?"""
+        fragments.backend = DictBackend()
+        self.profile(self.other_id)
+        self.assertEqual(len(fragments.backend), 1)
+
+        # As another process would, with nothing cached locally
+        fragments.clear()
+        self.count_renders()
+        html = self.profile(self.fan_id)
+        self.assertEqual(self.renders.count('messages/_card.html'), 0)
+        self.assertIn(f'action="/messages/{self.msg_id}/unlike"', html)
+
+    def test_backend_down(self):
+        """Do pages still render when the shared cache is down?"""
+        fragments.backend = BrokenBackend()
+        with self.assertLogs('warbler.fragments', 'ERROR'):
+            html = self.profile(self.other_id)
+        self.assertIn("Hello &lt;b&gt;world&lt;/b&gt;", html)
@@ -0,0 +1,170 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from flask import template_rendered
+from app import app, CURR_USER_KEY
+from principal import principal_cache
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class VersionStampTestCase(TestCase):
+    """Test that writes bump version stamps."""
+
+    def setUp(self):
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        user = User(email="stamped@test.com", username="stamped",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def version(self):
+        return db.session.query(User.version).filter_by(
+            id=self.user_id).scalar()
+
+    def test_orm_edits_bump_version(self):
+        """Does changing a column through the ORM bump the version?"""
+        user = User.query.get(self.user_id)
+        user.bio = "New bio"
+        db.session.commit()
+        self.assertEqual(self.version(), 2)
+
+        # Flushing an unchanged row doesn't
+        db.session.add(User.query.get(self.user_id))
+        db.session.commit()
+        self.assertEqual(self.version(), 2)
+
+
+class ConditionalViewsTestCase(TestCase):
+    """Test ETags and 304s on the cached pages."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        principal_cache.clear()
+        self.client = app.test_client()
+
+        viewer = User(email="viewer@test.com", username="viewer",
+                      password="HASHED_PASSWORD")
+        author = User(email="author@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        db.session.add_all([viewer, author])
+        db.session.commit()
+        msg = Message(text="Cache me", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.viewer_id, self.author_id = viewer.id, author.id
+        self.msg_id = msg.id
+
+    def get(self, client, url, etag=None):
+        """GET `url`, returning the response and the templates rendered."""
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+
+        headers = {'If-None-Match': etag} if etag else {}
+        with template_rendered.connected_to(record, app):
+            resp = client.get(url, headers=headers)
+        return resp, rendered
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def test_unchanged_page_is_not_rendered(self):
+        """Does a matching If-None-Match get a bare 304?"""
+        for url in [f"/users/{self.author_id}", f"/messages/{self.msg_id}",
+                    "/users"]:
+            with self.client as c:
+                self.login(c)
+                resp, _ = self.get(c, url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.headers['ETag'].startswith('W/"'))
+                self.assertEqual(resp.headers['Cache-Control'],
+                                 'private, no-cache')
+
+                again, rendered = self.get(c, url, resp.headers['ETag'])
+                self.assertEqual(again.status_code, 304)
+                self.assertEqual(again.data, b"")
+                self.assertEqual(rendered, [])
+
+    def test_writes_change_etag(self):
+        """Do likes, follows and new messages make pages stale?"""
+        with self.client as c:
+            self.login(c)
+            profile, _ = self.get(c, f"/users/{self.author_id}")
+            message, _ = self.get(c, f"/messages/{self.msg_id}")
+            directory, _ = self.get(c, "/users")
+
+            c.post(f"/messages/{self.msg_id}/like")
+            resp, _ = self.get(c, f"/messages/{self.msg_id}",
+                               message.headers['ETag'])
+            self.assertEqual(resp.status_code, 200)
+            resp, _ = self.get(c, f"/users/{self.author_id}",
+                               profile.headers['ETag'])
+            self.assertEqual(resp.status_code, 200)
+
+            c.post(f"/users/follow/{self.author_id}")
+            resp, _ = self.get(c, "/users", directory.headers['ETag'])
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Unfollow", resp.data)
+
+    def test_other_viewers_get_their_own_etag(self):
+        """Is the viewer part of the ETag?"""
+        url = f"/users/{self.author_id}"
+        anonymous, _ = self.get(self.client, url)
+        self.assertEqual(anonymous.headers['Cache-Control'],
+                         'public, no-cache')
+        with self.client as c:
+            self.login(c)
+            resp, _ = self.get(c, url, anonymous.headers['ETag'])
+            self.assertEqual(resp.status_code, 200)
+
+    def test_anonymous_home_last_modified(self):
+        """Does the anonymous home page answer If-Modified-Since?"""
+        resp = self.client.get("/")
+        self.assertIn('Last-Modified', resp.headers)
+        again = self.client.get("/", headers={
+            'If-Modified-Since': resp.headers['Last-Modified']})
+        self.assertEqual(again.status_code, 304)
+
+    def test_pending_flash_is_rendered(self):
+        """Is a page with a flash message waiting always rendered?"""
+        url = f"/users/{self.author_id}"
+        with self.client as c:
+            self.login(c)
+            resp, _ = self.get(c, url)
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('message', "Hello!")]
+            again, _ = self.get(c, url, resp.headers['ETag'])
+            self.assertEqual(again.status_code, 200)
+            self.assertIn(b"Hello!", again.data)
+
+    def test_static_files_are_cacheable(self):
+        """Do static files keep their max-age?"""
+        resp = self.client.get("/static/warbler.js")
+        self.assertNotIn('no-store', resp.headers['Cache-Control'])
+        self.assertIn('max-age', resp.headers['Cache-Control'])
+        resp.close()
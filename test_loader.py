@@ -0,0 +1,142 @@
+import io
+import os
+from unittest import TestCase
+from sqlalchemy import event
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app, for its side effect of connecting `db` to that
+# database (these tests only use `db` and the loader)
+import app  # noqa: F401
+from loader import Loader
+from schema import Migrator
+
+USERS = """email,username,image_url,password,bio,header_image_url,location
+a@test.com,alpha,/a.png,HASHED_PASSWORD,,/ha.png,Here
+b@test.com,bravo,/b.png,HASHED_PASSWORD,Hi,/hb.png,There
+c@test.com,charlie,/c.png,HASHED_PASSWORD,,/hc.png,
+"""
+
+MESSAGES = """text,timestamp,user_id
+one,2017-01-01 00:00:01,1
+two,2017-01-01 00:00:02,2
+three,2017-01-01 00:00:03,2
+four,2017-01-01 00:00:04,3
+five,2017-01-01 00:00:05,1
+"""
+
+# 1 follows 2 and 3; 2 follows 1
+FOLLOWS = """user_being_followed_id,user_following_id
+1,2
+1,3
+2,1
+"""
+
+
+def interrupted(text, lines):
+    """Yield the first `lines` lines of `text`, then fail."""
+    yield from io.StringIO(text).readlines()[:lines]
+    raise KeyboardInterrupt()
+
+
+class LoaderTestCase(TestCase):
+    """Test bulk loading."""
+
+    def setUp(self):
+        # Don't leave the session's locks in the way of dropping tables
+        db.session.remove()
+        self.connection = db.engine.connect()
+        self.loader = Loader(self.connection, chunk_rows=2, out=io.StringIO())
+        self.loader.start(['users', 'messages', 'follows'])
+
+    def tearDown(self):
+        db.session.remove()
+        self.connection.close()
+
+    def test_load(self):
+        """Are rows loaded, and indexes, keys and derived data rebuilt?"""
+        for table, text in [('users', USERS), ('messages', MESSAGES),
+                            ('follows', FOLLOWS)]:
+            self.loader.load(table, io.StringIO(text))
+        self.loader.finish(fanout_limit=10000)
+
+        self.assertEqual(User.query.get(2).username, "bravo")
+        self.assertIsNone(User.query.get(1).bio)
+        self.assertEqual(User.query.get(1).following_count, 2)
+        self.assertEqual(User.query.get(2).messages_count, 2)
+        self.assertEqual(Follows.query.count(), 3)
+
+        indexes = {name for name, in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'users'")}
+        self.assertIn("ix_users_username_prefix", indexes)
+        foreign_keys = db.session.execute(
+            "SELECT count(*) FROM pg_constraint WHERE contype = 'f' "
+            "AND conrelid = 'follows'::regclass").scalar()
+        self.assertEqual(foreign_keys, 2)
+
+        # New rows carry on after the loaded ids
+        user = User(email="d@test.com", username="delta",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.assertEqual(user.id, 4)
+
+    def test_search_index_after_reindex(self):
+        """Is the search index put back only once the messages' search
+        documents are filled in?"""
+        for table, text in [('users', USERS), ('messages', MESSAGES)]:
+            self.loader.load(table, io.StringIO(text))
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        record)
+        self.loader.finish(fanout_limit=10000)
+
+        def position(text):
+            return next(n for n, statement in enumerate(statements)
+                        if text in statement)
+
+        self.assertLess(position("SET search_vector"),
+                        position("CREATE INDEX ix_messages_search_vector"))
+        self.assertLess(position("CREATE INDEX ix_messages_user_timestamp"),
+                        position("UPDATE users SET messages_count"))
+
+    def test_migrations_recorded(self):
+        """Is a loaded database's schema recorded as fully migrated?"""
+        # As in a database never migrated before
+        self.connection.execute("DROP TABLE schema_migrations")
+        self.loader.start(['users'])
+        self.loader.load('users', io.StringIO(USERS))
+        self.loader.finish(fanout_limit=10000)
+
+        migrator = Migrator(self.connection)
+        self.assertEqual(migrator.applied(),
+                         {m.version for m in migrator.migrations})
+        self.assertEqual(migrator.upgrade(), [])
+
+    def test_resume(self):
+        """Does a resumed load pick up after the last committed chunk?"""
+        self.loader.load('users', io.StringIO(USERS))
+        with self.assertRaises(KeyboardInterrupt):
+            self.loader.load('messages', interrupted(MESSAGES, 4))
+
+        resumed = Loader(self.connection, chunk_rows=2, out=io.StringIO())
+        for table, text in [('users', USERS), ('messages', MESSAGES),
+                            ('follows', FOLLOWS)]:
+            resumed.load(table, io.StringIO(text))
+        resumed.finish(fanout_limit=10000)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual([(m.id, m.text) for m in
+                          Message.query.order_by(Message.id)],
+                         [(1, "one"), (2, "two"), (3, "three"),
+                          (4, "four"), (5, "five")])
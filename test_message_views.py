@@ -3,7 +3,8 @@
 
 import os
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Like, like_message
+from test_timeline import count_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -36,25 +37,75 @@ class MessageViewTestCase(TestCase):
                                     password="testuser",
                                     image_url=None)
         db.session.commit()
+        self.testuser_id = self.testuser.id
         with self.client as c:
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser.id
+                sess[CURR_USER_KEY] = self.testuser_id
+
+    def add_message(self, text="Hello"):
+        msg = Message(text=text, user_id=self.testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
 
     def test_add_message(self):
         """Can a user add a message?"""
+        with self.client as c:
             resp = c.post("/messages/new", data={"text": "Hello"})
-            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.status_code, 200)
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
     def test_show_message(self):
         """Is a user able to view a page detailing a single message?"""
+        msg_id = self.add_message()
+        with self.client as c:
+            resp = c.get(f"/messages/{msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Hello", resp.get_data(as_text=True))
 
     def test_delete_message(self):
         """Is a user able to delete a message?"""
+        msg_id = self.add_message()
+        with self.client as c:
+            resp = c.post(f"/messages/{msg_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(Message.query.get(msg_id))
 
     def test_like_message(self):
-        """Is a user able to like a message?"""
+        """Is a user able to like a message, and is liking twice harmless?"""
+        msg_id = self.add_message()
+        with self.client as c:
+            self.assertEqual(c.post(f"/messages/{msg_id}/like").json, 1)
+            self.assertEqual(c.post(f"/messages/{msg_id}/like").json, 1)
+            self.assertEqual(c.post("/messages/0/like").status_code, 404)
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 1)
 
     def test_unlike_message(self):
-        """Is a user able to unlike a message?"""
\ No newline at end of file
+        """Is a user able to unlike a message, and is unliking twice
+        harmless?"""
+        msg_id = self.add_message()
+        with self.client as c:
+            c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(c.post(f"/messages/{msg_id}/unlike").json, 0)
+            self.assertEqual(c.post(f"/messages/{msg_id}/unlike").json, 0)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(User.query.get(self.testuser_id).likes_count, 0)
+
+    def test_like_is_one_statement(self):
+        """Does a like cost the same however many likes the message has?"""
+        msg_id = self.add_message()
+        others = [User(email=f"fan{i}@test.com", username=f"fan{i}",
+                       password="HASHED_PASSWORD") for i in range(10)]
+        db.session.add_all(others)
+        db.session.commit()
+        for user in others:
+            like_message(user.id, msg_id)
+        db.session.commit()
+
+        with self.client as c:
+            c.get("/")
+            with count_queries() as counter:
+                self.assertEqual(c.post(f"/messages/{msg_id}/like").json, 11)
+        self.assertEqual(counter.count, 1)
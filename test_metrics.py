@@ -0,0 +1,101 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from metrics import metrics, Histogram
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class HistogramTestCase(TestCase):
+    """Test histogram bucketing."""
+
+    def test_buckets_are_cumulative(self):
+        """Does each bucket count everything at or below its bound?"""
+        histogram = Histogram((1, 5))
+        for value in [0.5, 1, 3, 7]:
+            histogram.observe(value)
+        samples = list(histogram.samples("h", {}))
+        self.assertEqual([value for _, _, value in samples],
+                         [2, 3, 4, 11.5, 4])
+        self.assertEqual(samples[2][1], {"le": "+Inf"})
+
+
+class MetricsViewTestCase(TestCase):
+    """Test request instrumentation and the /metrics endpoint."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        user = User(email="metered@test.com", username="metered",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        metrics.reset()
+        app.config['METRICS_ENABLED'] = True
+
+    def tearDown(self):
+        app.config.update(SERVER_TIMING=False, METRICS_ENABLED=False,
+                          METRICS_TOKEN=None)
+
+    def test_requests_are_recorded(self):
+        """Are latency, SQL, rendering and size recorded per endpoint?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.get("/")
+            c.get("/")
+            text = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_requests_total{endpoint="homepage",'
+                      'method="GET",status="200"} 2', text)
+        self.assertIn('warbler_request_duration_seconds_count'
+                      '{endpoint="homepage",method="GET"} 2', text)
+        self.assertIn('warbler_response_size_bytes_bucket'
+                      '{endpoint="homepage",le="+Inf"} 2', text)
+        self.assertIn('warbler_sql_statements_total{endpoint="homepage"}',
+                      text)
+        self.assertIn('warbler_template_render_seconds_total'
+                      '{endpoint="homepage"}', text)
+
+    def test_server_timing(self):
+        """Is the Server-Timing header sent only when turned on?"""
+        with self.client as c:
+            self.assertNotIn("Server-Timing", c.get("/").headers)
+            app.config['SERVER_TIMING'] = True
+            header = c.get("/").headers["Server-Timing"]
+        self.assertIn("sql;dur=", header)
+        self.assertIn("render;dur=", header)
+        self.assertIn("total;dur=", header)
+
+    def test_endpoint_guarded(self):
+        """Is /metrics hidden unless turned on, and kept to scrapers with
+        the token once one is set?"""
+        app.config['METRICS_ENABLED'] = False
+        with self.client as c:
+            self.assertEqual(c.get("/metrics").status_code, 404)
+
+            app.config.update(METRICS_ENABLED=True, METRICS_TOKEN="s3cret")
+            self.assertEqual(c.get("/metrics").status_code, 403)
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(resp.status_code, 403)
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("warbler_requests_total", resp.get_data(as_text=True))
@@ -0,0 +1,87 @@
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from pagination import encode_cursor, decode_cursor
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class PaginationTestCase(TestCase):
+    """Test keyset pagination of timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+
+        user = User(email="pager@test.com", username="pager",
+                    password="HASHED_PASSWORD")
+        start = datetime(2019, 1, 1)
+        # Two messages share a timestamp so the id tie-breaker matters
+        for i, minutes in enumerate([0, 1, 1, 2, 3]):
+            user.messages.append(
+                Message(text=f"msg {i}",
+                        timestamp=start + timedelta(minutes=minutes)))
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        app.config['TIMELINE_PAGE_SIZE'] = 20
+
+    def test_cursor_round_trip(self):
+        """Does a cursor decode back to the key it was made from?"""
+        key = (datetime(2019, 5, 4, 3, 2, 1, 123), 42)
+        self.assertEqual(decode_cursor(encode_cursor(*key)), key)
+        self.assertEqual(decode_cursor(encode_cursor(7, 7)), (7, 7))
+        with self.assertRaises(ValueError):
+            decode_cursor("not-a-cursor")
+
+    def test_profile_pages_cover_every_message_once(self):
+        """Does following X-Next-Page walk every message exactly once?"""
+        seen = []
+        url = f"/users/{self.user_id}"
+        with self.client as c:
+            while url:
+                resp = c.get(url, headers={"X-Requested-With":
+                                           "XMLHttpRequest"})
+                self.assertEqual(resp.status_code, 200)
+                seen += [f"msg {i}" for i in range(5)
+                         if f"<p>msg {i}</p>" in resp.get_data(as_text=True)]
+                url = resp.headers.get("X-Next-Page")
+
+        self.assertEqual(sorted(seen), [f"msg {i}" for i in range(5)])
+        self.assertEqual(len(seen), 5)
+
+    def test_first_page_links_to_next(self):
+        """Does the full page render only a page of messages and a link?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            resp = c.get(f"/users/{self.user_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('id="next-page"', html)
+            self.assertIn("<p>msg 4</p>", html)
+            self.assertNotIn("<p>msg 0</p>", html)
+
+    def test_bad_cursor(self):
+        """Is a malformed cursor rejected?"""
+        with self.client as c:
+            resp = c.get(f"/users/{self.user_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,123 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app
+from passwords import (PasswordHasher, HasherBusy, hasher, hash_password,
+                       hash_cost)
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing passwords off the request thread."""
+
+    def test_pool_round_trip(self):
+        """Do hashes made in the pool check out?"""
+        pool = PasswordHasher(rounds=4, workers=1)
+        hashed = pool.hash("hunter22")
+        self.assertEqual(hash_cost(hashed), 4)
+        self.assertTrue(pool.check(hashed, "hunter22"))
+        self.assertFalse(pool.check(hashed, "hunter23"))
+
+    def test_fast_fail_when_full(self):
+        """Are jobs refused rather than queued once the pool is full?"""
+        inline = PasswordHasher(rounds=4, workers=0, max_pending=1)
+        inline._slots.acquire()
+        with self.assertRaises(HasherBusy):
+            inline.hash("hunter22")
+        inline._slots.release()
+        self.assertTrue(inline.hash("hunter22"))
+
+    def test_timed_out_job_keeps_slot(self):
+        """Does a job still running after its caller gave up still count
+        against the cap?"""
+        pool = PasswordHasher(rounds=12, workers=1, max_pending=1,
+                              timeout=0.001)
+        with self.assertRaises(HasherBusy):
+            pool.hash("hunter22")
+        self.assertFalse(pool._slots.acquire(blocking=False))
+
+        # Once the job finishes, its slot is free again
+        pool._pool.shutdown()
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+    def test_reconfigure_resizes_pool(self):
+        """Is a started pool replaced when the number of workers changes?"""
+        pool = PasswordHasher(rounds=4, workers=1)
+        hashed = pool.hash("hunter22")
+        old = pool._pool
+
+        pool.configure(rounds=4, workers=2)
+        self.assertIsNone(pool._pool)
+        self.assertTrue(pool.check(hashed, "hunter22"))
+        self.assertEqual(pool._pool._max_workers, 2)
+        with self.assertRaises(RuntimeError):
+            old.submit(hash_cost, hashed)
+        pool._pool.shutdown()
+
+    def test_no_reconfigure_while_pending(self):
+        """Is reconfiguring refused while jobs still hold slots?"""
+        pool = PasswordHasher(rounds=12, workers=1, max_pending=1,
+                              timeout=0.001)
+        with self.assertRaises(HasherBusy):
+            pool.hash("hunter22")
+        with self.assertRaises(RuntimeError):
+            pool.configure(rounds=4, workers=1)
+
+        pool._pool.shutdown()
+        pool.configure(rounds=4, workers=1)
+        self.assertEqual(pool.rounds, 4)
+
+
+class LoginHashingTestCase(TestCase):
+    """Test how logins use the hasher."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        hasher.configure(rounds=5, workers=0, max_pending=1)
+
+    def tearDown(self):
+        hasher.init_app(app)
+
+    def test_rehash_on_login(self):
+        """Is an old-cost hash replaced when its owner logs in?"""
+        db.session.add(User(username="oldhash", email="old@test.com",
+                            password=hash_password("hunter22", 4)))
+        db.session.commit()
+
+        user = User.authenticate("oldhash", "hunter22")
+        db.session.commit()
+        self.assertEqual(hash_cost(user.password), 5)
+        self.assertTrue(User.authenticate("oldhash", "hunter22"))
+
+    def test_busy_is_a_503(self):
+        """Does a full pool turn into a retryable error for the client?"""
+        db.session.add(User(username="busy", email="busy@test.com",
+                            password=hash_password("hunter22", 4)))
+        db.session.commit()
+
+        hasher._slots.acquire()
+        try:
+            with app.test_client() as c:
+                resp = c.post("/login", data={"username": "busy",
+                                              "password": "hunter22"})
+        finally:
+            hasher._slots.release()
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
@@ -0,0 +1,118 @@
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows
+from test_timeline import count_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from cache import TTLCache
+from principal import principal_cache
+from passwords import hasher
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class TTLCacheTestCase(TestCase):
+    """Test the TTL/LRU cache."""
+
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, clock=lambda: self.now)
+
+    def test_entries_expire(self):
+        """Are entries dropped once their TTL is up?"""
+        self.cache.set("a", 1)
+        self.now = 9
+        self.assertEqual(self.cache.get("a"), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_least_recently_used_is_evicted(self):
+        """Does a full cache make room by dropping the stalest entry?"""
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(len(self.cache), 2)
+
+
+class PrincipalViewsTestCase(TestCase):
+    """Test the cached logged-in user."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        principal_cache.clear()
+        hasher.configure(rounds=4, workers=0)
+        self.client = app.test_client()
+        user = User.signup(username="cached", email="cached@test.com",
+                           password="hunter22", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        hasher.init_app(app)
+        db.session.rollback()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_user_is_not_queried_every_request(self):
+        """Is the logged-in user loaded once, then served from the cache?"""
+        with self.client as c:
+            self.login(c)
+            with count_queries() as first:
+                c.get("/users/autocomplete?q=")
+            with count_queries() as second:
+                c.get("/users/autocomplete?q=")
+        self.assertEqual(first.count, 1)
+        self.assertEqual(second.count, 0)
+
+    def test_profile_change_shows_immediately(self):
+        """Is the cached principal dropped when the profile is edited?"""
+        with self.client as c:
+            self.login(c)
+            c.get("/")
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "cached@test.com",
+                                           "password": "hunter22"})
+            html = c.get("/").get_data(as_text=True)
+        self.assertIn("@renamed", html)
+
+    def test_own_counters_are_fresh(self):
+        """Does posting a message update the user's own counters?"""
+        with self.client as c:
+            self.login(c)
+            c.get("/")
+            c.post("/messages/new", data={"text": "hello"})
+            c.get("/")
+        self.assertEqual(principal_cache.get(self.user_id).messages_count, 1)
+
+    def test_deleted_user_is_logged_out(self):
+        """Does a session for a deleted account stop being logged in?"""
+        with self.client as c:
+            self.login(c)
+            c.post("/users/delete")
+            self.login(c)
+            resp = c.get("/")
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+        self.assertIn("Sign up", resp.get_data(as_text=True))
+        self.assertIsNone(principal_cache.get(self.user_id))
@@ -0,0 +1,110 @@
+import gzip
+import os
+import re
+from unittest import TestCase
+from models import db, User, Message, Follows, Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from metrics import metrics
+from responses import stream_template, brotli
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class StreamTemplateTestCase(TestCase):
+    """Test streamed rendering."""
+
+    def test_head_is_sent_first(self):
+        """Does the first chunk end once the page head is out?"""
+        with app.test_request_context("/"):
+            app.preprocess_request()
+            resp = stream_template('home-anon.html')
+            chunks = list(resp.response)
+        self.assertTrue(resp.is_streamed)
+        self.assertIn("</head>", chunks[0])
+        self.assertNotIn("</body>", chunks[0])
+        self.assertIn("</body>", chunks[-1])
+
+
+class CompressionTestCase(TestCase):
+    """Test streamed timelines and response compression."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        self.client = app.test_client()
+        user = User(email="squeezed@test.com", username="squeezed",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([Message(text=f"Warble {i}", user_id=user.id)
+                            for i in range(20)])
+        db.session.commit()
+        self.user_id = user.id
+
+    def test_streamed_page_is_gzipped(self):
+        """Is a streamed profile page compressed chunk by chunk?"""
+        resp = self.client.get(f"/users/{self.user_id}",
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b"Warble 19", gzip.decompress(resp.data))
+
+    def test_brotli_preferred(self):
+        """Is brotli used when it's accepted and available?"""
+        if brotli is None:
+            self.skipTest("brotli isn't installed")
+        resp = self.client.get(f"/users/{self.user_id}",
+                               headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertIn(b"Warble 19", brotli.decompress(resp.data))
+
+    def test_not_compressed(self):
+        """Are small responses, and clients that don't ask, left alone?"""
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b"Warble 19", resp.data)
+
+        resp = self.client.get("/users/autocomplete?q=zzz",
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_flash_consumed(self):
+        """Is a flash message shown once on a streamed page?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+                sess['_flashes'] = [('message', "Only once")]
+            self.assertIn(b"Only once",
+                          c.get(f"/users/{self.user_id}/likes").data)
+            self.assertNotIn(b"Only once",
+                             c.get(f"/users/{self.user_id}/likes").data)
+
+    def test_streamed_request_metrics(self):
+        """Are streamed responses recorded once they're sent?"""
+        metrics.reset()
+        resp = self.client.get(f"/users/{self.user_id}",
+                               headers={'Accept-Encoding': 'gzip'})
+        size = len(resp.data)
+        text = metrics.render()
+        self.assertIn('warbler_requests_total{endpoint="users_show",'
+                      'method="GET",status="200"} 1', text)
+        self.assertIn('warbler_response_size_bytes_sum'
+                      f'{{endpoint="users_show"}} {size}', text)
+        render = re.search(r'warbler_template_render_seconds_total'
+                           r'\{endpoint="users_show"\} (\S+)', text)
+        self.assertGreater(float(render.group(1)), 0)
@@ -0,0 +1,154 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_routing.py
+#
+# They use a second database as the "replica": createdb warbler-test-replica
+
+
+import os
+import time
+from unittest import TestCase
+from models import db, User, Message, Follows, Like, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from metrics import metrics
+from principal import principal_cache
+from routing import STICKY_KEY
+from schema import Migrator
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test which database pages read from."""
+
+    def setUp(self):
+        """Point the app at a replica holding different data from the
+        primary, so pages show which one they read."""
+
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [REPLICA_URL]
+        (self.replica,) = db.get_replicas(app)
+        with self.replica.connect() as connection:
+            Migrator(connection).upgrade()
+
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        principal_cache.clear()
+
+        viewer = User(email="viewer@test.com", username="viewer",
+                      password="HASHED_PASSWORD")
+        on_primary = User(email="primary@test.com", username="on-primary",
+                          password="HASHED_PASSWORD")
+        db.session.add_all([viewer, on_primary])
+        db.session.commit()
+        self.viewer_id = viewer.id
+
+        with self.replica.begin() as connection:
+            for table in ('timeline_entries', 'likes', 'messages', 'follows',
+                          'users'):
+                connection.execute(f"DELETE FROM {table}")
+            connection.execute(User.__table__.insert(), [
+                dict(id=viewer.id, email="viewer@test.com",
+                     username="viewer", password="HASHED_PASSWORD"),
+                dict(id=on_primary.id + 1000, email="replica@test.com",
+                     username="on-replica", password="HASHED_PASSWORD"),
+            ])
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = []
+        db.session.rollback()
+
+    def users_page(self, c):
+        return c.get("/users").get_data(as_text=True)
+
+    def test_reads_go_to_replica(self):
+        """Do the read-only pages read from the replica?"""
+        with self.client as c:
+            html = self.users_page(c)
+        self.assertIn("on-replica", html)
+        self.assertNotIn("on-primary", html)
+
+    def test_other_routes_use_primary(self):
+        """Do routes that aren't marked for replicas read the primary?"""
+        with self.client as c:
+            resp = c.get("/users/autocomplete?q=on-")
+        self.assertEqual([user['username'] for user in resp.json],
+                         ["on-primary"])
+
+    def test_reads_stick_to_primary_after_write(self):
+        """After a write, does the writer read from the primary until the
+        sticky period is over?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            with c.session_transaction() as sess:
+                self.assertGreater(sess[STICKY_KEY], time.time())
+            html = self.users_page(c)
+            self.assertIn("on-primary", html)
+            self.assertNotIn("on-replica", html)
+
+            # Reads that aren't followed by a write don't extend it
+            with c.session_transaction() as sess:
+                sess[STICKY_KEY] = 0
+            self.assertIn("on-replica", self.users_page(c))
+            self.assertIn("on-replica", self.users_page(c))
+
+        # Nor does anyone else's write send them to the primary
+        with app.test_client() as other:
+            self.assertIn("on-replica", self.users_page(other))
+
+    def test_writes_go_to_primary(self):
+        """Are writes made on the primary, with replicas configured?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+            c.post("/messages/new", data={"text": "Hello"})
+
+        self.assertEqual(Message.query.count(), 1)
+        with self.replica.connect() as connection:
+            self.assertEqual(
+                connection.execute("SELECT count(*) FROM messages").scalar(),
+                0)
+
+    def test_pool_metrics(self):
+        """Do the pools report checkout waits and connections in use?"""
+        metrics.reset()
+        app.config['METRICS_ENABLED'] = True
+        self.addCleanup(app.config.update, METRICS_ENABLED=False)
+        with self.client as c:
+            self.users_page(c)
+            text = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_db_pool_wait_seconds_count{engine="replica0"}',
+                      text)
+        self.assertNotIn(
+            'warbler_db_pool_wait_seconds_count{engine="primary"}', text)
+        self.assertRegex(text,
+                         r'warbler_db_pool_checked_out{engine="primary"} \d')
+        self.assertIn('warbler_db_pool_checked_out{engine="replica0"} 0',
+                      text)
@@ -0,0 +1,388 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_schema.py
+
+
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from sqlalchemy import (create_engine, event, inspect, Column, DateTime,
+                        ForeignKey, Integer, MetaData, String, Table, Text)
+from models import db, User, Message, Follows, Like, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+from principal import principal_cache
+from schema import Migrator
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+HOT_PATH_INDEXES = {
+    'messages': 'ix_messages_user_timestamp',
+    'follows': 'ix_follows_user_following_id',
+    'likes': 'ix_likes_user_message',
+}
+
+# The schema `db.create_all()` made before migrations, which 0001 starts from
+ORIGINAL = MetaData()
+
+Table('users', ORIGINAL,
+      Column('id', Integer, primary_key=True),
+      Column('email', Text, nullable=False, unique=True),
+      Column('username', Text, nullable=False, unique=True),
+      Column('image_url', Text),
+      Column('header_image_url', Text),
+      Column('bio', Text),
+      Column('location', Text),
+      Column('password', Text, nullable=False))
+
+Table('messages', ORIGINAL,
+      Column('id', Integer, primary_key=True),
+      Column('text', String(140), nullable=False),
+      Column('timestamp', DateTime, nullable=False),
+      Column('user_id', Integer,
+             ForeignKey('users.id', ondelete='CASCADE'), nullable=False))
+
+Table('follows', ORIGINAL,
+      Column('user_being_followed_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+      Column('user_following_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+
+Table('likes', ORIGINAL,
+      Column('message_id', Integer,
+             ForeignKey('messages.id', ondelete='cascade'), primary_key=True),
+      Column('user_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+
+
+def index_names(connection, table):
+    return {index['name'] for index in inspect(connection).get_indexes(table)}
+
+
+class MigrationTestCase(TestCase):
+    """Test applying and undoing migrations."""
+
+    def setUp(self):
+        # Index builds wait for open transactions, such as the session's
+        db.session.remove()
+        self.connection = db.engine.connect()
+        self.migrator = Migrator(self.connection)
+        self.migrator.upgrade()
+
+    def tearDown(self):
+        self.migrator.upgrade()
+        self.connection.close()
+
+    def test_downgrade_and_upgrade(self):
+        """Do the hot path indexes come and go with their migration?"""
+        versions = [m.version for m in self.migrator.migrations]
+        self.assertEqual(self.migrator.applied(), set(versions))
+
+        undone = self.migrator.downgrade(0)
+        self.assertEqual([m.version for m in undone], versions[::-1])
+        self.assertEqual(self.migrator.applied(), set())
+        for table, name in HOT_PATH_INDEXES.items():
+            self.assertNotIn(name, index_names(self.connection, table))
+
+        applied = self.migrator.upgrade(2)
+        self.assertEqual([m.version for m in applied], [1, 2])
+        for table, name in HOT_PATH_INDEXES.items():
+            self.assertIn(name, index_names(self.connection, table))
+
+        applied = self.migrator.upgrade()
+        self.assertEqual([m.version for m in applied], versions[2:])
+        # Nothing left to do
+        self.assertEqual(self.migrator.upgrade(), [])
+
+    def test_follows_index_replaced(self):
+        """Does 0004's followers index take over from 0002's?"""
+        follows = index_names(self.connection, 'follows')
+        self.assertIn('ix_follows_user_following_created', follows)
+        self.assertNotIn('ix_follows_user_following_id', follows)
+
+        self.migrator.downgrade(3)
+        follows = index_names(self.connection, 'follows')
+        self.assertNotIn('ix_follows_user_following_created', follows)
+        self.assertIn('ix_follows_user_following_id', follows)
+
+    def test_tombstones(self):
+        """Do the tombstone columns and the jobs table come and go with
+        their migration?"""
+        def columns(table):
+            return {c['name'] for c in
+                    inspect(self.connection).get_columns(table)}
+
+        self.migrator.downgrade(2)
+        self.assertNotIn('deleted_at', columns('users'))
+        self.assertNotIn('deleted_at', columns('messages'))
+        self.assertNotIn('deletion_jobs',
+                         inspect(self.connection).get_table_names())
+
+        self.migrator.upgrade()
+        self.assertIn('deleted_at', columns('users'))
+        self.assertIn('deleted_at', columns('messages'))
+        self.assertIn('ix_users_tombstoned',
+                      index_names(self.connection, 'users'))
+
+    def test_invalid_index_rebuilt(self):
+        """Is an index left invalid by a failed concurrent build redone?"""
+        self.migrator.downgrade(0)
+        with self.connection.begin():
+            self.connection.execute(
+                "CREATE INDEX ix_likes_user_message "
+                "ON likes (user_id, message_id)")
+            self.connection.execute(
+                "UPDATE pg_index SET indisvalid = false WHERE indexrelid = "
+                "'ix_likes_user_message'::regclass")
+
+        self.migrator.upgrade()
+        valid = self.connection.execute(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = "
+            "'ix_likes_user_message'::regclass").scalar()
+        self.assertTrue(valid)
+
+    def test_original_schema(self):
+        """Is a database made by `db.create_all()` before migrations
+        brought up to the models, with its derived data filled in?"""
+        # In a schema of its own, made before connecting to it so that it's
+        # the engine's default
+        db.engine.execute("DROP SCHEMA IF EXISTS original CASCADE; "
+                          "CREATE SCHEMA original")
+        self.addCleanup(db.engine.execute, "DROP SCHEMA original CASCADE")
+        engine = create_engine(
+            "postgresql:///warbler-test",
+            connect_args={'options': '-csearch_path=original'})
+        self.addCleanup(engine.dispose)
+
+        with engine.connect() as connection:
+            with connection.begin():
+                ORIGINAL.create_all(connection)
+                tables = ORIGINAL.tables
+                connection.execute(tables['users'].insert(), [
+                    dict(id=n, email=f"{name}@test.com", username=name,
+                         password="HASHED_PASSWORD")
+                    for n, name in enumerate(("reader", "author", "quiet"),
+                                             1)])
+                start = datetime(2020, 1, 1)
+                connection.execute(tables['messages'].insert(), [
+                    dict(id=n, text=f"Warble {n}", user_id=2,
+                         timestamp=start + timedelta(hours=n))
+                    for n in range(1, 4)])
+                connection.execute(tables['follows'].insert(), [
+                    dict(user_being_followed_id=1, user_following_id=2),
+                    dict(user_being_followed_id=3, user_following_id=2)])
+                connection.execute(tables['likes'].insert(),
+                                   dict(user_id=1, message_id=3))
+
+            migrator = Migrator(connection)
+            applied = migrator.upgrade()
+            self.assertEqual([m.version for m in applied],
+                             [m.version for m in migrator.migrations])
+
+            inspector = inspect(connection)
+            for table in db.metadata.sorted_tables:
+                self.assertEqual(
+                    {c['name'] for c in inspector.get_columns(table.name)},
+                    set(table.columns.keys()), table.name)
+                self.assertLessEqual(
+                    {index.name for index in table.indexes},
+                    index_names(connection, table.name), table.name)
+            self.assertIn('ix_messages_search_vector',
+                          index_names(connection, 'messages'))
+
+            self.assertEqual(connection.execute(
+                "SELECT id, messages_count, following_count, "
+                "followers_count, likes_count, version FROM users "
+                "ORDER BY id").fetchall(),
+                [(1, 0, 1, 0, 1, 1), (2, 3, 0, 2, 0, 1), (3, 0, 1, 0, 0, 1)])
+            self.assertEqual(connection.execute(
+                "SELECT id, like_count FROM messages ORDER BY id").fetchall(),
+                [(1, 0), (2, 0), (3, 1)])
+            self.assertEqual(connection.execute(
+                "SELECT count(*) FROM messages "
+                "WHERE search_vector @@ to_tsquery('english', 'warble')"
+            ).scalar(), 3)
+            self.assertEqual(connection.execute(
+                "SELECT user_id, message_id FROM timeline_entries "
+                "ORDER BY user_id, timestamp DESC").fetchall(),
+                [(1, 3), (1, 2), (1, 1), (3, 3), (3, 2), (3, 1)])
+
+    def test_empty_database(self):
+        """Is an empty database created from the models, with every
+        migration recorded?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/warbler.db")
+            with engine.connect() as connection:
+                migrator = Migrator(connection)
+                migrator.upgrade()
+                self.assertEqual(migrator.applied(),
+                                 {m.version for m in migrator.migrations})
+                self.assertIn('ix_messages_user_timestamp',
+                              index_names(connection, 'messages'))
+
+                migrator.downgrade(0)
+                self.assertNotIn('ix_messages_user_timestamp',
+                                 index_names(connection, 'messages'))
+            engine.dispose()
+
+
+class QueryPlanTestCase(TestCase):
+    """Test that the timeline and list pages don't scan whole tables."""
+
+    # Tables that grow with activity
+    LARGE_TABLES = {'messages', 'follows', 'likes', 'timeline_entries'}
+
+    @classmethod
+    def setUpClass(cls):
+        """Seed a few thousand rows, so the planner has statistics."""
+        db.session.rollback()
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        users = [dict(id=n, email=f"user{n}@test.com", username=f"user{n}",
+                      password="HASHED_PASSWORD") for n in range(1, 201)]
+        start = datetime(2020, 1, 1)
+        messages = [dict(id=n, text=f"Warble {n}", user_id=n % 200 + 1,
+                         timestamp=start + timedelta(minutes=n))
+                    for n in range(1, 4001)]
+        follows = [dict(user_being_followed_id=n % 200 + 1,
+                        user_following_id=(n * 7) % 200 + 1)
+                   for n in range(1, 4001) if n % 200 != (n * 7) % 200]
+        follows = list({(f['user_being_followed_id'],
+                         f['user_following_id']): f
+                        for f in follows}.values())
+        likes = list({(n % 200 + 1, (n * 13) % 4000 + 1):
+                      dict(user_id=n % 200 + 1, message_id=(n * 13) % 4000 + 1)
+                      for n in range(1, 4001)}.values())
+        db.session.execute(User.__table__.insert(), users)
+        db.session.execute(Message.__table__.insert(), messages)
+        db.session.execute(Follows.__table__.insert(), follows)
+        db.session.execute(Like.__table__.insert(), likes)
+        db.session.execute(
+            "SELECT setval('users_id_seq', 200), "
+            "setval('messages_id_seq', 4000)")
+        db.session.commit()
+        with app.app_context():
+            from timeline import rebuild_timelines
+            from models import repair_counters
+            repair_counters()
+            rebuild_timelines(app.config['TIMELINE_FANOUT_LIMIT'])
+            db.session.commit()
+        with db.engine.connect() as connection:
+            connection.execution_options(
+                isolation_level='AUTOCOMMIT').execute("ANALYZE")
+
+    def setUp(self):
+        principal_cache.clear()
+        self.client = app.test_client()
+        self.statements = []
+
+    def capture(self, conn, cursor, statement, parameters, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.statements.append((statement, parameters))
+
+    def full_scans(self, cursor, plan):
+        """(node type, table) of plan nodes reading a large table whole:
+        sequential scans, or index scans not limited by the index's first
+        column (which read the whole index)."""
+
+        found = []
+        relation = plan.get('Relation Name')
+        index = plan.get('Index Name')
+        if plan['Node Type'] == 'Seq Scan' and relation in self.LARGE_TABLES:
+            found.append(('Seq Scan', relation))
+        elif index:
+            cursor.execute(
+                "SELECT indrelid::regclass::text, attname FROM pg_index "
+                "JOIN pg_attribute ON attrelid = indrelid "
+                "AND attnum = indkey[0] WHERE indexrelid = %s::regclass",
+                (index,))
+            table, leading = cursor.fetchone()
+            condition = plan.get('Index Cond', '')
+            if (table in self.LARGE_TABLES
+                    and not re.search(rf'\b{leading}\b', condition)):
+                found.append((plan['Node Type'], index))
+        for child in plan.get('Plans', []):
+            found.extend(self.full_scans(cursor, child))
+        return found
+
+    def assertNoFullScans(self, url, **config):
+        """Request `url` as user 2 and EXPLAIN every SELECT it ran, with
+        sequential scans discouraged so any index that could serve is
+        used."""
+        old = {key: app.config[key] for key in config}
+        app.config.update(config)
+        event.listen(db.engine, 'before_cursor_execute', self.capture)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 2
+                resp = c.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', self.capture)
+            app.config.update(old)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.statements)
+
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SET enable_seqscan = off")
+            for statement, parameters in self.statements:
+                cursor.execute("EXPLAIN (FORMAT JSON) " + statement,
+                               parameters)
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                self.assertEqual(
+                    self.full_scans(cursor, plan[0]['Plan']), [], statement)
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def test_home_timeline(self):
+        self.assertNoFullScans("/")
+
+    def test_home_timeline_celebrities(self):
+        """Followees' messages merged in at read time"""
+        self.assertNoFullScans("/", TIMELINE_FANOUT_LIMIT=0)
+
+    def test_profile(self):
+        self.assertNoFullScans("/users/3")
+
+    def test_followers(self):
+        self.assertNoFullScans("/users/3/followers")
+
+    def test_following(self):
+        self.assertNoFullScans("/users/3/following")
+
+    def test_likes(self):
+        self.assertNoFullScans("/users/2/likes")
+
+    def test_api_likes(self):
+        self.assertNoFullScans("/api/v1/users/2/likes")
+
+    def test_api_followers(self):
+        self.assertNoFullScans("/api/v1/users/2/followers")
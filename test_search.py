@@ -0,0 +1,214 @@
+import os
+from datetime import datetime
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app
+from search import (TrigramIndex, InvertedIndex, MemoryMessageSearch,
+                    MemoryUserSearch, trigrams, similarity)
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class TrigramIndexTestCase(TestCase):
+    """Test the in-memory trigram index."""
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        for id, name in enumerate(["warbler", "warblerfan", "sparrow",
+                                   "robin", "warbling_wren"]):
+            self.index.add(id, name)
+
+    def test_trigrams_match_pg_trgm(self):
+        """Are words padded like pg_trgm pads them?"""
+        self.assertEqual(trigrams("Cat"), {"  c", " ca", "cat", "at "})
+        self.assertEqual(similarity(trigrams("cat"), trigrams("cat")), 1)
+
+    def test_search_ranks_closest_first(self):
+        """Does the exact match come first, and substrings still match?"""
+        self.assertEqual(self.index.search("warbler")[:2], [0, 1])
+        self.assertIn(2, self.index.search("arro"))
+        self.assertNotIn(3, self.index.search("warbler"))
+
+    def test_prefix_and_remove(self):
+        """Are prefix lookups ordered, and do removed ids disappear?"""
+        self.assertEqual(self.index.prefix("WARB", 10), [0, 1, 4])
+        self.assertEqual(self.index.prefix("warb", 2), [0, 1])
+        self.index.remove(1)
+        self.index.add(4, "robinson")
+        self.assertEqual(self.index.prefix("warb", 10), [0])
+        self.assertEqual(self.index.prefix("rob", 10), [3, 4])
+
+
+class InvertedIndexTestCase(TestCase):
+    """Test the in-memory inverted index."""
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, "the early bird gets the worm")
+        self.index.add(2, "Bird bird bird")
+        self.index.add(3, "worms are early risers")
+
+    def test_all_terms_must_match(self):
+        """Do only texts with every query word match?"""
+        self.assertEqual([id for _, id in self.index.search("early worm")],
+                         [1])
+        self.assertEqual(self.index.search("   "), [])
+
+    def test_denser_matches_rank_first(self):
+        """Does a text that's all about the query outrank a passing
+        mention, and does removing a text drop it?"""
+        self.assertEqual([id for _, id in self.index.search("BIRD")], [2, 1])
+        self.index.remove(2)
+        self.assertEqual([id for _, id in self.index.search("bird")], [1])
+
+
+class UserSearchViewTestCase(TestCase):
+    """Test the users directory and autocomplete views."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        app.config['USERS_PAGE_SIZE'] = 2
+        for name in ["hummingbird", "hummer", "humboldt", "owl"]:
+            db.session.add(User(email=f"{name}@test.com", username=name,
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['USERS_PAGE_SIZE'] = 30
+
+    def test_search_is_paginated(self):
+        """Are search results split into pages?"""
+        with self.client as c:
+            first = c.get("/users?q=hum").get_data(as_text=True)
+            second = c.get("/users?q=hum&page=2").get_data(as_text=True)
+
+        self.assertEqual(first.count("card-bio"), 2)
+        self.assertIn("page=2", first)
+        self.assertEqual(second.count("card-bio"), 1)
+        self.assertNotIn("owl", first + second)
+
+    def test_directory_without_query(self):
+        """Does the directory list everyone a page at a time?"""
+        with self.client as c:
+            html = c.get("/users?page=2").get_data(as_text=True)
+        self.assertEqual(html.count("card-bio"), 2)
+        self.assertNotIn("page=3", html)
+
+    def test_autocomplete(self):
+        """Does autocomplete return prefix matches as JSON?"""
+        with self.client as c:
+            resp = c.get("/users/autocomplete?q=hum")
+            self.assertEqual([u["username"] for u in resp.json],
+                             ["humboldt", "hummer", "hummingbird"])
+            self.assertEqual(c.get("/users/autocomplete?q=").json, [])
+
+
+class MessageSearchViewTestCase(TestCase):
+    """Test the message search view."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+        user = User(email="searcher@test.com", username="searcher",
+                    password="HASHED_PASSWORD")
+        for text in ["owls hunting at night", "night owls", "owls",
+                     "sparrows at dawn"]:
+            user.messages.append(Message(text=text))
+        db.session.add(user)
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['TIMELINE_PAGE_SIZE'] = 20
+
+    def test_search_pages_through_matches(self):
+        """Are all matches found once each, across pages?"""
+        found = []
+        url = "/messages/search?q=owls"
+        with self.client as c:
+            while url:
+                resp = c.get(url, headers={"X-Requested-With":
+                                           "XMLHttpRequest"})
+                self.assertEqual(resp.status_code, 200)
+                html = resp.get_data(as_text=True)
+                found += [text for text in ["owls hunting at night",
+                                            "night owls", "owls"]
+                          if f"<p>{text}</p>" in html]
+                self.assertNotIn("sparrows", html)
+                url = resp.headers.get("X-Next-Page")
+
+        self.assertEqual(sorted(found),
+                         ["night owls", "owls", "owls hunting at night"])
+
+    def test_no_matches(self):
+        """Is an empty result reported?"""
+        with self.client as c:
+            html = c.get("/messages/search?q=penguin").get_data(as_text=True)
+        self.assertIn("no warbles found", html)
+
+
+class MemorySearchTestCase(TestCase):
+    """Test that the in-process backends page past hidden rows."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        users = [User(email=f"hum{i}@test.com", username=f"hum{i}",
+                      password="HASHED_PASSWORD") for i in range(6)]
+        db.session.add_all(users)
+        db.session.flush()
+        for user in users:
+            user.messages.append(Message(text=f"owls by {user.username}"))
+        db.session.commit()
+        self.ids = sorted(user.id for user in users)
+
+    def tombstone(self, model, ids):
+        db.session.execute(model.__table__.update()
+                           .where(model.__table__.c.id.in_(ids))
+                           .values(deleted_at=datetime.utcnow()))
+        db.session.commit()
+
+    def test_users(self):
+        """Are pages of users full, however many are hidden?"""
+        search = MemoryUserSearch()
+        # Indexed first, then deleted, as the index never hears of it
+        search._index()
+        self.tombstone(User, self.ids[:3])
+
+        first = search.search("hum", limit=2)
+        second = search.search("hum", limit=2, offset=2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual({u.id for u in first + second}, set(self.ids[3:]))
+        self.assertEqual([row.id for row in search.autocomplete("hum", 2)],
+                         self.ids[3:5])
+
+    def test_messages(self):
+        """Are pages of messages full, however many are hidden?"""
+        search = MemoryMessageSearch()
+        search._index()
+        messages = Message.query.order_by(Message.id).all()
+        self.tombstone(Message, [msg.id for msg in messages[::2]])
+
+        found = [msg for msg, score in search.search("owls", limit=2)]
+        self.assertEqual(len(found), 2)
+        self.assertTrue(all(msg.deleted_at is None for msg in found))
@@ -0,0 +1,126 @@
+import os
+import select
+import tempfile
+from unittest import TestCase
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app
+from slowlog import slow_queries, normalize, fingerprint, read_only
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class FingerprintTestCase(TestCase):
+    """Test statement normalization."""
+
+    def test_values_are_blanked_out(self):
+        """Do statements differing only in values share a fingerprint?"""
+        self.assertEqual(
+            normalize("SELECT * FROM users\n  WHERE id IN (%(id_1)s, "
+                      "%(id_2)s) AND username = 'o''brien' LIMIT 10"),
+            "SELECT * FROM users WHERE id IN (...) AND username = ? LIMIT ?")
+        self.assertEqual(
+            fingerprint("SELECT 1 FROM messages WHERE id IN (%s, %s, %s)"),
+            fingerprint("SELECT 2 FROM messages WHERE id IN (%s)"))
+
+    def test_read_only(self):
+        """Are only plain reads safe to re-run under EXPLAIN ANALYZE?"""
+        self.assertTrue(read_only(normalize(
+            "SELECT count(*) FROM users WHERE id = %(id)s")))
+        for statement in [
+                "SELECT pg_notify(%(channel)s, %(payload)s)",
+                "SELECT id FROM messages WHERE user_id = ? LIMIT ? "
+                "FOR UPDATE SKIP LOCKED",
+                "SELECT * FROM users FOR NO KEY UPDATE",
+                "SELECT setval(pg_get_serial_sequence('users', 'id'), 1) "
+                "FROM users"]:
+            self.assertFalse(read_only(normalize(statement)), statement)
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test logging and explaining slow queries."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        db.session.commit()
+        self.plans = tempfile.NamedTemporaryFile(suffix=".log")
+        self.config = {key: app.config[key] for key in
+                       ['SLOW_QUERY_MS', 'SLOW_QUERY_EXPLAIN_FILE',
+                        'SLOW_QUERY_EXPLAIN_SAMPLE']}
+        app.config.update(SLOW_QUERY_MS=0.001,
+                          SLOW_QUERY_EXPLAIN_FILE=self.plans.name,
+                          SLOW_QUERY_EXPLAIN_SAMPLE=1)
+        slow_queries.init_app(app)
+        slow_queries.reset()
+
+    def tearDown(self):
+        app.config.update(self.config)
+        slow_queries.init_app(app)
+        self.plans.close()
+
+    def test_slow_queries_are_grouped(self):
+        """Are repeats of a statement counted together, with the route and
+        our line of code that ran them?"""
+        with self.assertLogs('warbler.slow_queries', 'WARNING'):
+            with app.test_client() as c:
+                c.get("/users")
+                c.get("/users")
+
+        stats = next(stats for stats in slow_queries.top()
+                     if 'FROM users' in stats.statement)
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.route, "GET list_users")
+        self.assertTrue(stats.call_site.startswith("app.py:"))
+
+    def test_selects_are_explained(self):
+        """Are plans captured for slow SELECTs but never for writes?"""
+        with self.assertLogs('warbler.slow_queries', 'WARNING'):
+            db.session.add(User(email="slow@test.com", username="slow",
+                                password="HASHED_PASSWORD"))
+            db.session.commit()
+            User.query.filter_by(username="slow").all()
+        db.session.commit()
+
+        with open(self.plans.name) as f:
+            plans = f.read()
+        self.assertIn("Buffers", plans)
+        self.assertIn("SELECT users.id", plans)
+        self.assertNotIn("INSERT INTO users", plans)
+
+    def test_notify_sent_once(self):
+        """Is a sampled slow pg_notify delivered once, and not re-run
+        under ANALYZE?"""
+        listener = db.engine.raw_connection()
+        self.addCleanup(listener.close)
+        listener.connection.rollback()
+        listener.connection.autocommit = True
+        listener.cursor().execute("LISTEN slowlog_test")
+
+        with self.assertLogs('warbler.slow_queries', 'WARNING'):
+            db.session.execute("SELECT pg_notify('slowlog_test', 'once')")
+            db.session.commit()
+
+        notifies = []
+        while select.select([listener.connection], [], [], 0.2)[0]:
+            listener.connection.poll()
+            notifies.extend(listener.connection.notifies)
+            listener.connection.notifies.clear()
+        self.assertEqual([n.payload for n in notifies], ["once"])
+
+        with open(self.plans.name) as f:
+            plans = f.read()
+        self.assertIn("pg_notify", plans)
+        self.assertNotIn("actual time", plans)
@@ -0,0 +1,208 @@
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+from sqlalchemy import event
+from models import (db, User, Message, Follows, Like, TimelineEntry,
+                    repair_counters)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+from app import app, CURR_USER_KEY
+import timeline
+from principal import principal_cache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+db.create_all()
+
+
+class count_queries:
+    """Context manager counting (and keeping) SQL statements sent while
+    it's active."""
+
+    def __enter__(self):
+        self.count = 0
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.callback)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, 'before_cursor_execute', self.callback)
+
+    def callback(self, conn, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+
+class TimelineTestCase(TestCase):
+    """Test materialized home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        self.client = app.test_client()
+        self.reader = User(email="reader@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        self.author = User(email="author@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.reader, self.author])
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.author_id = self.author.id
+
+    def tearDown(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_post_fans_out_to_followers(self):
+        """Does posting a message add it to each follower's timeline?"""
+        self.reader.following.append(self.author)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "fanned out"})
+
+        entry = TimelineEntry.query.one()
+        self.assertEqual(entry.user_id, self.reader_id)
+        self.assertEqual(entry.author_id, self.author_id)
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        """Do follows copy in old messages and unfollows take them out?"""
+        self.author.messages.append(Message(text="before the follow"))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(TimelineEntry.query.count(), 1)
+
+            c.post(f"/users/stop-following/{self.author_id}")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_celebrity_merged_on_read(self):
+        """Are popular authors skipped on write but still in the feed?"""
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.author_id}")
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "too popular"})
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        messages = timeline.home_timeline(self.reader_id, 0)
+        self.assertEqual([m.text for m in messages], ["too popular"])
+
+    def test_author_crosses_fanout_limit(self):
+        """Do an author's messages stay in their followers' feeds as the
+        author goes over the fan-out limit and back?"""
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        fan = User(email="fan@test.com", username="fan",
+                   password="HASHED_PASSWORD")
+        db.session.add(fan)
+        db.session.commit()
+        fan_id = fan.id
+
+        def feed():
+            return [m.text for m in timeline.home_timeline(self.reader_id, 1)]
+
+        with self.client as c:
+            self.login(c, self.reader_id)
+            c.post(f"/users/follow/{self.author_id}")
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "before"})
+            self.assertEqual(TimelineEntry.query.count(), 1)
+
+            # Over the limit: read-time pulls take over
+            self.login(c, fan_id)
+            c.post(f"/users/follow/{self.author_id}")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+            self.login(c, self.author_id)
+            c.post("/messages/new", data={"text": "during"})
+            self.assertEqual(feed(), ["during", "before"])
+
+            # Back to it: fanned out again, including what was pulled
+            self.login(c, fan_id)
+            c.post(f"/users/stop-following/{self.author_id}")
+        self.assertEqual(
+            {(entry.user_id, entry.author_id)
+             for entry in TimelineEntry.query},
+            {(self.reader_id, self.author_id)})
+        self.assertEqual(TimelineEntry.query.count(), 2)
+        self.assertEqual(feed(), ["during", "before"])
+
+    def test_rebuild_capped_per_timeline(self):
+        """Does a rebuild keep each timeline's newest BACKFILL_LIMIT
+        entries, whatever the batch size?"""
+        readers = [User(email=f"reader{n}@test.com", username=f"reader{n}",
+                        password="HASHED_PASSWORD") for n in range(3)]
+        db.session.add_all(readers)
+        db.session.flush()
+        start = datetime(2020, 1, 1)
+        self.author.messages.extend(
+            Message(text=f"Warble {n}", timestamp=start + timedelta(hours=n))
+            for n in range(5))
+        db.session.add_all(Follows(user_being_followed_id=reader.id,
+                                   user_following_id=self.author_id)
+                           for reader in readers + [self.reader])
+        db.session.commit()
+        repair_counters()
+
+        with mock.patch.object(timeline, 'BACKFILL_LIMIT', 3):
+            timeline.rebuild_timelines(10000, batch_size=2)
+        db.session.commit()
+
+        for reader in readers + [self.reader]:
+            texts = [m.text for m in timeline.home_timeline(reader.id, 10000)]
+            self.assertEqual(texts, ["Warble 4", "Warble 3", "Warble 2"])
+        self.assertEqual(TimelineEntry.query.count(), 12)
+
+    def test_home_page_queries_are_constant(self):
+        """Does the home page cost the same number of queries whether it
+        shows one message or twenty from twenty authors?"""
+
+        def add_authors(count):
+            for i in range(count):
+                author = User(email=f"a{i}-{count}@test.com",
+                              username=f"a{i}-{count}",
+                              password="HASHED_PASSWORD")
+                msg = Message(text=f"from {author.username}")
+                author.messages.append(msg)
+                db.session.add(author)
+                db.session.flush()
+                db.session.add(TimelineEntry(user_id=self.reader_id,
+                                             message_id=msg.id,
+                                             author_id=author.id,
+                                             timestamp=msg.timestamp))
+                db.session.add(Like(user_id=self.reader_id,
+                                    message_id=msg.id))
+            db.session.commit()
+
+        def home_page_queries():
+            principal_cache.clear()
+            with self.client as c:
+                self.login(c, self.reader_id)
+                with count_queries() as counter:
+                    resp = c.get("/")
+                self.assertEqual(resp.status_code, 200)
+                return counter.count
+
+        add_authors(1)
+        one = home_page_queries()
+        add_authors(19)
+        twenty = home_page_queries()
+        self.assertEqual(one, twenty)
@@ -1,6 +1,6 @@
 import os
 from unittest import TestCase
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, follow_states
 from sqlalchemy.exc import InvalidRequestError, IntegrityError as IE
 from psycopg2 import IntegrityError
 
@@ -187,4 +187,19 @@ class UserModelTestCase(TestCase):
                         "PASSWORD",
                         "http://cdn.onlinewebfonts.com/svg/img_475555.png")
         self.assertFalse(u.authenticate("invalid-password-user", "NOTRIGHT"))
-        self.assertFalse(u.authenticate("invalid-password-user", "pASSWORD"))
\ No newline at end of file
+        self.assertFalse(u.authenticate("invalid-password-user", "pASSWORD"))
+
+    def test_follow_states(self):
+        """Are follow states for many users resolved together?"""
+        users = [User(email=f"fs{i}@test.com", username=f"fs{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.user.following.append(users[1])
+        db.session.commit()
+
+        ids = [u.id for u in users]
+        self.assertEqual(follow_states(self.user.id, ids),
+                         {ids[0]: False, ids[1]: True, ids[2]: False})
+        self.assertEqual(follow_states(None, ids),
+                         dict.fromkeys(ids, False))
@@ -1,6 +1,8 @@
 import os
+import re
+from datetime import datetime, timedelta
 from unittest import TestCase
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Like
 from sqlalchemy.exc import InvalidRequestError, IntegrityError as IE
 from psycopg2 import IntegrityError
 
@@ -12,6 +14,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 from app import app, CURR_USER_KEY
+from test_timeline import count_queries
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -52,7 +55,7 @@ class UserViewTestCase(TestCase):
         db.session.add(second_user)
         db.session.commit()
 
-        resp = c.get("/users/2/following")
+        resp = c.get(f"/users/{second_user.id}/following")
         self.assertEqual(resp.status_code, 200)
     
     def test_follower_following_logged_out(self):
@@ -67,7 +70,7 @@ class UserViewTestCase(TestCase):
         db.session.add(second_user)
         db.session.commit()
         with self.client as c:
-            resp = c.get("/users/2/following")
+            resp = c.get(f"/users/{second_user.id}/following")
             self.assertEqual(resp.status_code, 302)
     
     def test_add_message_logged_out(self):
@@ -106,3 +109,132 @@ class UserViewTestCase(TestCase):
             resp = cp.post(f"/messages/{message2.id}/delete")
 
             self.assertEqual(resp.status_code, 302)
+
+    def test_directory_follow_buttons_in_one_query(self):
+        """Does the users directory cost the same however many of the listed
+        users are followed?"""
+
+        def directory_queries():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = viewer_id
+                c.get("/users")
+                with count_queries() as counter:
+                    html = c.get("/users").get_data(as_text=True)
+            return counter.count, html.count("Unfollow")
+
+        viewer_id = self.testuser.id
+        others = [User(email=f"dir{i}@test.com", username=f"dir{i}",
+                       password="HASHED_PASSWORD") for i in range(5)]
+        db.session.add_all(others)
+        db.session.commit()
+        other_ids = [u.id for u in others]
+
+        def follow(ids):
+            db.session.add_all(Follows(user_being_followed_id=viewer_id,
+                                       user_following_id=id) for id in ids)
+            db.session.commit()
+
+        follow(other_ids[:1])
+        one, unfollow_one = directory_queries()
+        follow(other_ids[1:])
+        five, unfollow_five = directory_queries()
+
+        self.assertEqual((unfollow_one, unfollow_five), (1, 5))
+        self.assertEqual(one, five)
+
+    def test_follow_lists_paginated(self):
+        """Are following and followers pages a page at a time, most recently
+        followed first?"""
+
+        viewer_id = self.testuser.id
+        others = [User(email=f"list{i}@test.com", username=f"list{i}",
+                       password="HASHED_PASSWORD") for i in range(5)]
+        db.session.add_all(others)
+        db.session.commit()
+        start = datetime(2020, 1, 1)
+        # Followed, and followed by, in the reverse order of signing up
+        db.session.add_all(
+            [Follows(user_being_followed_id=viewer_id,
+                     user_following_id=user.id,
+                     created_at=start - timedelta(days=i))
+             for i, user in enumerate(others)]
+            + [Follows(user_being_followed_id=user.id,
+                       user_following_id=viewer_id,
+                       created_at=start - timedelta(days=i))
+               for i, user in enumerate(others)])
+        db.session.commit()
+
+        def walk(url):
+            """Usernames on each page from `url` on, and the queries each
+            took."""
+            pages = []
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = viewer_id
+                c.get(url)
+                while url:
+                    with count_queries() as counter:
+                        html = c.get(url).get_data(as_text=True)
+                    pages.append((re.findall(r"<p>@(list\d)</p>", html),
+                                  counter.count))
+                    more = re.search(r'<a href="([^"]+)" class="btn btn-link',
+                                     html)
+                    url = more and more.group(1).replace("&amp;", "&")
+            return pages
+
+        old_size = app.config['USERS_PAGE_SIZE']
+        app.config['USERS_PAGE_SIZE'] = 2
+        try:
+            for url in (f"/users/{viewer_id}/following",
+                        f"/users/{viewer_id}/followers"):
+                pages = walk(url)
+                self.assertEqual([names for names, queries in pages],
+                                 [["list0", "list1"], ["list2", "list3"],
+                                  ["list4"]])
+                self.assertEqual(len({queries for names, queries in pages}),
+                                 1)
+        finally:
+            app.config['USERS_PAGE_SIZE'] = old_size
+
+    def test_liked_messages_paginated(self):
+        """Are liked messages a page at a time, most recently liked first?"""
+
+        viewer_id = self.testuser.id
+        author = User(email="author@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        db.session.add(author)
+        db.session.flush()
+        start = datetime(2020, 1, 1)
+        messages = [Message(text=f"Liked {i}", user_id=author.id,
+                            timestamp=start + timedelta(days=i))
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        # Liked in an order of their own: the oldest message most recently
+        liked_days_ago = [0, 2, 1]
+        db.session.add_all(Like(user_id=viewer_id, message_id=msg.id,
+                                created_at=start - timedelta(days=days))
+                           for msg, days in zip(messages, liked_days_ago))
+        db.session.commit()
+
+        old_size = app.config['TIMELINE_PAGE_SIZE']
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = viewer_id
+                html = c.get(f"/users/{viewer_id}/likes").get_data(
+                    as_text=True)
+                self.assertEqual(re.findall(r"Liked \d", html),
+                                 ["Liked 0", "Liked 2"])
+                next_page = re.search(r'href="([^"]+)" id="next-page"',
+                                      html).group(1).replace("&amp;", "&")
+                resp = c.get(next_page,
+                             headers={"X-Requested-With": "XMLHttpRequest"})
+                self.assertEqual(re.findall(r"Liked \d",
+                                            resp.get_data(as_text=True)),
+                                 ["Liked 1"])
+                self.assertNotIn("X-Next-Page", resp.headers)
+        finally:
+            app.config['TIMELINE_PAGE_SIZE'] = old_size
@@ -0,0 +1,330 @@
+"""Materialized home timelines for Warbler.
+
+Every user's home feed is kept as rows in `timeline_entries`, written when a
+followee posts (fan-out-on-write) and when the follow graph changes, so
+reading the feed is a single range scan over one user's entries.
+
+Authors with more followers than the fan-out limit are never copied into
+timelines; their messages are pulled at read time (fan-out-on-read) and
+merged in, so one celebrity post doesn't turn into millions of inserts.
+When an author's follower count crosses the limit their entries are moved
+over (see `followers_changed`), so no message falls between the two.
+"""
+
+from collections import namedtuple
+from heapq import merge
+from itertools import islice
+
+from sqlalchemy import literal
+from sqlalchemy.orm import joinedload
+
+from models import db, Follows, Like, Message, TimelineEntry, User
+from pagination import older_than
+
+# How many of a followee's recent messages are copied in on a new follow.
+BACKFILL_LIMIT = 100
+
+# How many users' timelines `rebuild_timelines` fills per statement.
+REBUILD_BATCH_SIZE = 1000
+
+# What the message list templates render: everything a message card needs,
+# resolved up front so rendering doesn't issue queries per message.
+TimelineItem = namedtuple('TimelineItem', ['message', 'author', 'liked'])
+
+
+def is_celebrity(user_id, fanout_limit):
+    """Is `user_id` too popular to fan out on write?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) > fanout_limit
+
+
+def fan_out_message(msg, fanout_limit):
+    """Copy a newly flushed `msg` into the timeline of each of its
+    author's followers. Skipped for authors over `fanout_limit`."""
+
+    if is_celebrity(msg.user_id, fanout_limit):
+        return
+
+    followers = (db.session
+                 .query(Follows.user_being_followed_id,
+                        literal(msg.id),
+                        literal(msg.user_id),
+                        literal(msg.timestamp, db.DateTime))
+                 .filter(Follows.user_following_id == msg.user_id))
+    _insert_entries(followers)
+
+
+def backfill(user_id, followee_id, fanout_limit):
+    """Copy `followee_id`'s recent messages into `user_id`'s timeline
+    after a new follow."""
+
+    if is_celebrity(followee_id, fanout_limit):
+        return
+
+    recent = (db.session
+              .query(literal(user_id),
+                     Message.id,
+                     Message.user_id,
+                     Message.timestamp)
+              .filter(Message.user_id == followee_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LIMIT))
+    _insert_entries(recent)
+
+
+def followers_changed(author_ids, delta, fanout_limit):
+    """Move the authors `author_ids` (an id or a list of them) between
+    fan-out on write and on read if `delta`, the change just made to their
+    follower counts, took them across `fanout_limit`.
+
+    Going over it, their entries are dropped from timelines, as reads pull
+    their messages from then on. Coming back to it, their BACKFILL_LIMIT
+    newest messages are copied to each follower, as those posted meanwhile
+    were never fanned out.
+    """
+
+    if isinstance(author_ids, int):
+        author_ids = [author_ids]
+    counts = (db.session
+              .query(User.id, User.followers_count)
+              .filter(User.id.in_(author_ids))
+              .all())
+    for author_id, followers in counts:
+        before = followers - delta
+        if before <= fanout_limit < followers:
+            (TimelineEntry
+             .query
+             .filter(TimelineEntry.author_id == author_id)
+             .delete(synchronize_session=False))
+        elif followers <= fanout_limit < before:
+            _fan_out_recent(author_id)
+
+
+def remove_followee(user_id, followee_id):
+    """Drop `followee_id`'s messages from `user_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.author_id == followee_id)
+     .delete(synchronize_session=False))
+
+
+def rebuild_timelines(fanout_limit, batch_size=REBUILD_BATCH_SIZE):
+    """Recompute every materialized timeline from follows and messages,
+    keeping each timeline's BACKFILL_LIMIT newest entries.
+
+    Done `batch_size` followers per INSERT, so no one statement has to
+    sort every follow's messages at once. Used after bulk loads, which
+    bypass the write-path hooks; run `repair_counters` first so follower
+    counts are current.
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    celebrities = (db.session
+                   .query(User.id)
+                   .filter(User.followers_count > fanout_limit))
+    follower = Follows.user_being_followed_id
+    last = None
+    while True:
+        followers = db.session.query(follower).distinct().order_by(follower)
+        if last is not None:
+            followers = followers.filter(follower > last)
+        batch = [user_id for (user_id,) in followers.limit(batch_size)]
+        if not batch:
+            return
+
+        rank = (db.func.row_number()
+                .over(partition_by=follower,
+                      order_by=(Message.timestamp.desc(), Message.id.desc()))
+                .label('rank'))
+        ranked = (db.session
+                  .query(follower.label('user_id'),
+                         Message.id.label('message_id'),
+                         Message.user_id.label('author_id'),
+                         Message.timestamp.label('timestamp'),
+                         rank)
+                  .join(Message, Message.user_id == Follows.user_following_id)
+                  .filter(follower.between(batch[0], batch[-1]),
+                          ~Follows.user_following_id.in_(celebrities))
+                  .subquery())
+        rows = (db.session
+                .query(ranked.c.user_id,
+                       ranked.c.message_id,
+                       ranked.c.author_id,
+                       ranked.c.timestamp)
+                .filter(ranked.c.rank <= BACKFILL_LIMIT))
+        _insert_entries(rows)
+        last = batch[-1]
+
+
+def home_timeline(user_id, fanout_limit, limit=100, before=None,
+                  columns=None):
+    """Up to `limit` messages from the users `user_id` follows, newest
+    first, starting below the (timestamp, id) cursor `before` if given.
+
+    Messages come loaded with their authors, or, given `columns` (of
+    messages and users, including ones labelled 'timestamp' and 'id'), as
+    rows of just those columns.
+    """
+
+    materialized = (message_query(columns)
+                    .join(TimelineEntry,
+                          TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == user_id))
+    if before:
+        materialized = materialized.filter(
+            older_than(TimelineEntry.timestamp, TimelineEntry.message_id,
+                       before))
+    materialized = (materialized
+                    .order_by(TimelineEntry.timestamp.desc(),
+                              TimelineEntry.message_id.desc())
+                    .limit(limit)
+                    .all())
+
+    celebrity_ids = _followed_celebrities(user_id, fanout_limit)
+    if not celebrity_ids:
+        return materialized
+
+    pulled = (message_query(columns)
+              .filter(Message.user_id.in_(celebrity_ids)))
+    if before:
+        pulled = pulled.filter(
+            older_than(Message.timestamp, Message.id, before))
+    pulled = (pulled
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit)
+              .all())
+
+    return list(islice(_dedupe(merge(materialized, pulled,
+                                     key=sort_key, reverse=True)),
+                       limit))
+
+
+def liked_messages(user_id, limit, before=None, columns=None):
+    """Up to `limit` messages `user_id` has liked, most recently liked
+    first, starting below the (liked_at, id) cursor `before` if given.
+
+    As `message_query(columns)`, with the like's `liked_at` added to each
+    row: (message, liked_at) pairs, or rows of `columns` and `liked_at`.
+    """
+
+    query = (message_query(columns)
+             .add_columns(Like.created_at.label('liked_at'))
+             .join(Like, Like.message_id == Message.id)
+             .filter(Like.user_id == user_id))
+    if before:
+        query = query.filter(
+            older_than(Like.created_at, Like.message_id, before))
+    return (query
+            .order_by(Like.created_at.desc(), Like.message_id.desc())
+            .limit(limit)
+            .all())
+
+
+def message_query(columns=None):
+    """Query for messages loaded with their authors, or for rows of
+    `columns` of messages joined to their authors."""
+
+    if columns is None:
+        return Message.query.options(joinedload(Message.user))
+    return (db.session
+            .query(*columns)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id))
+
+
+def build_items(messages, viewer_id):
+    """Wrap `messages` (loaded with their authors) as TimelineItems for
+    `viewer_id`, which may be None for anonymous visitors.
+
+    Whether the viewer liked each message is resolved with one query for
+    the whole page.
+    """
+
+    liked = liked_message_ids(viewer_id, [msg.id for msg in messages])
+    return [TimelineItem(msg, msg.user, msg.id in liked)
+            for msg in messages]
+
+
+def liked_message_ids(user_id, message_ids):
+    """The subset of `message_ids` that `user_id` has liked."""
+
+    if user_id is None or not message_ids:
+        return set()
+
+    rows = (db.session
+            .query(Like.message_id)
+            .filter(Like.user_id == user_id,
+                    Like.message_id.in_(message_ids))
+            .all())
+    return {message_id for (message_id,) in rows}
+
+
+def _followed_celebrities(user_id, fanout_limit):
+    """Ids of users followed by `user_id` who are over `fanout_limit`."""
+
+    rows = (db.session
+            .query(Follows.user_following_id)
+            .join(User, User.id == Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id,
+                    User.followers_count > fanout_limit)
+            .all())
+    return [followee_id for (followee_id,) in rows]
+
+
+def _fan_out_recent(author_id):
+    """Copy `author_id`'s BACKFILL_LIMIT newest messages into each of their
+    followers' timelines, where they aren't already."""
+
+    recent = (db.session
+              .query(Message.id, Message.user_id, Message.timestamp)
+              .filter(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(BACKFILL_LIMIT)
+              .subquery())
+    present = (db.session
+               .query(TimelineEntry.message_id)
+               .filter(TimelineEntry.user_id
+                       == Follows.user_being_followed_id,
+                       TimelineEntry.message_id == recent.c.id))
+    rows = (db.session
+            .query(Follows.user_being_followed_id,
+                   recent.c.id,
+                   recent.c.user_id,
+                   recent.c.timestamp)
+            .filter(Follows.user_following_id == author_id,
+                    ~present.exists()))
+    _insert_entries(rows)
+
+
+def _insert_entries(query):
+    """INSERT ... SELECT the (user_id, message_id, author_id, timestamp)
+    rows produced by `query` into timeline_entries."""
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            query.statement))
+
+
+def sort_key(msg):
+    """The (timestamp, id) key timelines are ordered and paged by."""
+
+    return (msg.timestamp, msg.id)
+
+
+def _dedupe(messages):
+    """Skip messages already seen, e.g. posted before an author crossed
+    the fan-out limit and so present in both sources."""
+
+    seen = set()
+    for msg in messages:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            yield msg